@@ -0,0 +1,29 @@
+# arrayIO.py
+# Summary: helpers for streaming large arrays to disk.  Arrays are appended to raw binary files in
+#          chunks and converted to .npy format once complete, so they never need to fit in memory.
+#          Kept free of GIS dependencies so any stage can use them
+
+# import libraries
+import os
+import shutil
+import numpy as np
+
+########## HELPER FUNCTIONS #############
+
+# convert a raw binary file of array values into .npy format without loading the values into memory
+# INPUTS:
+#    rawFile (str) - absolute filepath to the raw binary file
+#    npyFile (str) - absolute filepath where the .npy file should be written
+#    dtype (numpy dtype) - datatype of values in the raw file
+#    nValues (int) - number of values in the raw file
+def rawToNpy(rawFile,npyFile,dtype,nValues):
+    header = {
+        'descr':np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order':False,
+        'shape':(nValues,)
+    }
+    with open(npyFile,'wb') as outFile:
+        np.lib.format.write_array_header_1_0(outFile,header)
+        with open(rawFile,'rb') as inFile:
+            shutil.copyfileobj(inFile,outFile,length=16*1024*1024)
+    os.remove(rawFile)
@@ -1,22 +1,88 @@
 # createGrid.py
 # Author: Andrew Larkin
 # Date Created: March 22, 2024
-# Summary: Create a 10m grid of points covering Portland, OR city boundaries in shapefile format
+# Summary: Create a 10m grid of points covering Portland, OR city boundaries.  Grid coordinates
+#          are generated with array operations, clipped to the city boundary in bulk, and streamed
+#          to disk in chunks as .npy coordinate arrays.  A shapefile export is retained for GIS use
 # Thanks to https://spatial-dev.guru/2022/05/22/create-fishnet-grid-using-geopandas-and-shapely/
 # for demonstrating how to create a fishnet in geopandas
 
 # import libraries
+import os
+import json
+import numpy as np
 import geopandas as gpd
-from shapely import geometry
+import shapely
+import arrayIO
 
 # define global constants
 PDX_BOUNDARY_PATH = 'Absolute filepath to PDX city boundary shapefile'
 OUTPUT_PATH = 'Absolute filepath to output fishnet shapefile'
+OUTPUT_FOLDER = 'Absolute folderpath where grid coordinate arrays are stored'
 CRS = 'EPSG:3857'
 RESOLUTION = 10
+CHUNK_ROWS = 256 # number of grid rows generated and clipped at once.  Bounds peak memory use
+
+# arrays written for every grid point, and the datatype of each array
+GRID_ARRAYS = {'x':np.float64,'y':np.float64,'row':np.int32,'col':np.int32}
+GRID_META_FILE = 'gridMeta.json'
 
 ########## HELPER FUNCTIONS #############
 
+# load the city boundary and merge all boundary polygons into a single geometry
+# INPUTS:
+#    boundary (str) - absolute filepath to shapefile containing the limits of the grid extent
+#    crs (string) - coordinate reference system for the grid points
+# OUTPUTS:
+#    cityBoundary (shapely geometry) - prepared geometry for fast point in polygon tests
+def loadBoundary(boundary,crs):
+    cityBoundaries = gpd.read_file(boundary).to_crs(crs)
+    cityBoundary = shapely.union_all(cityBoundaries.geometry.values)
+    shapely.prepare(cityBoundary)
+    return(cityBoundary)
+
+# calculate the number of rows and columns in a grid covering the boundary extent. Matches
+# the point spacing of the original while loop (points are included up to and including maxX/maxY)
+# INPUTS:
+#    bounds (float array) - minX, minY, maxX, maxY of the grid extent
+#    resolution (int) - resolution of grid points, in meters
+# OUTPUTS:
+#    nRows (int), nCols (int) - dimensions of the grid
+def calcGridShape(bounds,resolution):
+    minX, minY, maxX, maxY = bounds
+    nCols = int(np.floor((maxX - minX)/resolution)) + 1
+    nRows = int(np.floor((maxY - minY)/resolution)) + 1
+    return(nRows,nCols)
+
+# generate grid points within a boundary, one block of grid rows at a time.  Points are ordered
+# first by longitude and then latitude, starting at the south west corner of the boundary extent
+# INPUTS:
+#    cityBoundary (shapely geometry) - limits of grid extent, in the grid crs
+#    resolution (int) - resolution of grid points, in meters
+#    chunkRows (int) - number of grid rows to generate at once
+# OUTPUTS:
+#    yields a dict of x, y, row, and col arrays for grid points inside the boundary
+def createGridChunks(cityBoundary,resolution,chunkRows=CHUNK_ROWS):
+    bounds = shapely.bounds(cityBoundary)
+    minX, minY = bounds[0], bounds[1]
+    nRows, nCols = calcGridShape(bounds,resolution)
+    cols = np.arange(nCols,dtype=np.int32)
+    xCoords = minX + cols*float(resolution)
+    for startRow in range(0,nRows,chunkRows):
+        rows = np.arange(startRow,min(startRow + chunkRows,nRows),dtype=np.int32)
+        rowGrid, colGrid = np.meshgrid(rows,cols,indexing='ij')
+        x = np.broadcast_to(xCoords,rowGrid.shape).ravel()
+        y = (minY + rowGrid*float(resolution)).ravel()
+
+        # clip the block of grid points to the city boundary in a single vectorized call
+        inside = shapely.intersects_xy(cityBoundary,x,y)
+        yield({
+            'x':x[inside],
+            'y':y[inside],
+            'row':rowGrid.ravel()[inside],
+            'col':colGrid.ravel()[inside]
+        })
+
 # create a grid of points within a defined boundary
 # INPUTS:
 #    boundary (shapefile) - limits of grid extent
@@ -25,40 +91,68 @@ RESOLUTION = 10
 # OUTPUTS:
 #    an array of the grid points, stored in geometry format
 def createPointGrid(boundary,resolution,crs):
-    # get cityBoundaries from input shapefile
-    cityBoundaries = gpd.read_file(boundary)
-    
-    # Reproject to projected coordinate system
-    cityBoundaries = cityBoundaries.to_crs(crs)
-    
-    # Get the extent of the shapefile
-    total_bounds = cityBoundaries.total_bounds
-
-    # Get minX, minY, maxX, maxY
-    minX, minY, maxX, maxY = total_bounds
-
-    # initialize array and first geom point
-    x, y = (minX, minY)
-    geom_array = []
-
-    # iterate through all points in the grid, first by longitude and then latitude 
-    while y <= maxY:
-        while x <= maxX:
-            geom =geometry.Point([x,y])
-            geom_array.append(geom)
-            x += resolution
-        x = minX
-        y += resolution
-    return(geom_array)
+    cityBoundary = loadBoundary(boundary,crs)
+    chunks = list(createGridChunks(cityBoundary,resolution))
+    x = np.concatenate([chunk['x'] for chunk in chunks])
+    y = np.concatenate([chunk['y'] for chunk in chunks])
+    return(gpd.points_from_xy(x,y,crs=crs))
+
+# create a point grid and stream the coordinates to disk as .npy arrays (one array per attribute).
+# Only one block of grid rows is held in memory at a time, so finer resolutions (e.g. 5m) are
+# limited by disk space rather than memory
+# INPUTS:
+#    boundary (str) - absolute filepath to shapefile containing the limits of the grid extent
+#    resolution (int) - resolution of grid points, in meters
+#    crs (string) - coordinate reference system for the grid points
+#    outputFolder (str) - absolute folderpath where grid arrays will be written
+#    chunkRows (int) - number of grid rows to generate at once
+# OUTPUTS:
+#    nPoints (int) - number of grid points within the boundary
+def createGridArrays(boundary,resolution,crs,outputFolder,chunkRows=CHUNK_ROWS):
+    if not(os.path.exists(outputFolder)):
+        os.makedirs(outputFolder)
+    cityBoundary = loadBoundary(boundary,crs)
+
+    # append each block of points to raw binary files.  The final number of points isn't known
+    # until the whole grid has been clipped, so .npy headers are written afterwards
+    rawFiles = {}
+    for name in GRID_ARRAYS:
+        rawFiles[name] = open(os.path.join(outputFolder,name + '.raw'),'wb')
+    nPoints = 0
+    for chunk in createGridChunks(cityBoundary,resolution,chunkRows):
+        for name, dtype in GRID_ARRAYS.items():
+            rawFiles[name].write(np.ascontiguousarray(chunk[name],dtype=dtype).tobytes())
+        nPoints += len(chunk['x'])
+    for name in GRID_ARRAYS:
+        rawFiles[name].close()
+        arrayIO.rawToNpy(os.path.join(outputFolder,name + '.raw'),os.path.join(outputFolder,name + '.npy'),
+                 GRID_ARRAYS[name],nPoints)
+
+    # save the grid definition so grid rows and columns can be georeferenced downstream
+    bounds = shapely.bounds(cityBoundary)
+    nRows, nCols = calcGridShape(bounds,resolution)
+    gridMeta = {
+        'crs':crs,
+        'resolution':resolution,
+        'minX':float(bounds[0]),
+        'minY':float(bounds[1]),
+        'nRows':nRows,
+        'nCols':nCols,
+        'nPoints':nPoints
+    }
+    with open(os.path.join(outputFolder,GRID_META_FILE),'w') as metaFile:
+        json.dump(gridMeta,metaFile,indent=2)
+    return(nPoints)
 
 # create a point grid in shapefile format
 def createFishnet(boundary,resolution,crs,outputFile):
     pointGrid = createPointGrid(boundary,resolution,crs)
-    fishnet = gpd.GeoDataFrame(pointGrid, columns=['geometry']).set_crs(crs)
-    fishnet.to_file(OUTPUT_PATH)
+    fishnet = gpd.GeoDataFrame(geometry=pointGrid,crs=crs)
+    fishnet.to_file(outputFile)
 
 
 ########## MAIN FUNCTION #############
-    
+
 if __name__ == '__main__':
-    createFishnet(PDX_BOUNDARY_PATH,RESOLUTION,CRS,OUTPUT_PATH)
\ No newline at end of file
+    nPoints = createGridArrays(PDX_BOUNDARY_PATH,RESOLUTION,CRS,OUTPUT_FOLDER)
+    print("created %i grid points" %(nPoints))
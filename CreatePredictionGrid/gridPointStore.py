@@ -0,0 +1,211 @@
+# gridPointStore.py
+# Summary: A single memory-mapped store of grid points.  The store holds x/y coordinates, grid
+#          row/column, stable global point ids, and screening flags as one .npy array per attribute.
+#          Points removed by screening (e.g. points within buildings) are dropped from the store before
+#          point ids are used downstream, so every stage only processes unscreened points.  Batches of
+#          grid points (e.g. b1000 for points 1000-1999) are zero-copy slices of the store rather than
+#          partitioned shapefiles
+
+# import libraries
+import os
+import json
+import numpy as np
+
+# define global constants
+BATCH_SIZE = 1000 # max number of points for each batch
+GRID_META_FILE = 'gridMeta.json'
+STORE_ARRAYS = ['pointId','x','y','row','col','flags']
+
+# screening flags.  Flags are bit masks, so a point can be flagged by more than one screening layer
+FLAG_WATER = 1
+FLAG_BUILDING = 2
+FLAG_ROAD = 4
+SCREENING_FLAGS = FLAG_WATER | FLAG_BUILDING | FLAG_ROAD
+
+########## HELPER FUNCTIONS #############
+
+# load grid metadata
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the point store
+# OUTPUTS:
+#    dict of grid metadata (crs, resolution, grid origin and shape, number of points, batch size)
+def loadMeta(storeFolder):
+    with open(os.path.join(storeFolder,GRID_META_FILE),'r') as metaFile:
+        return(json.load(metaFile))
+
+# save grid metadata
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the point store
+#    meta (dict) - grid metadata
+def saveMeta(storeFolder,meta):
+    with open(os.path.join(storeFolder,GRID_META_FILE),'w') as metaFile:
+        json.dump(meta,metaFile,indent=2)
+
+# convert grid arrays created by createGrid.py into a point store by adding global point ids
+# and screening flags.  Point ids are assigned in grid order, and reassigned once by
+# compactPointStore when screened points are dropped
+# INPUTS:
+#    gridFolder (str) - absolute folderpath containing x/y/row/col arrays and grid metadata
+#    batchSize (int) - number of points in each batch
+def createPointStore(gridFolder,batchSize=BATCH_SIZE):
+    meta = loadMeta(gridFolder)
+    nPoints = meta['nPoints']
+    np.save(os.path.join(gridFolder,'pointId.npy'),np.arange(nPoints,dtype=np.int64))
+    np.save(os.path.join(gridFolder,'flags.npy'),np.zeros(nPoints,dtype=np.uint8))
+    meta['batchSize'] = batchSize
+    saveMeta(gridFolder,meta)
+
+# create a point store from coordinate arrays (e.g. points exported from a fishnet feature class)
+# INPUTS:
+#    storeFolder (str) - absolute folderpath where the point store will be written
+#    x (float array) - x coordinate of each point, in the crs units
+#    y (float array) - y coordinate of each point, in the crs units
+#    crs (str) - coordinate reference system of the points
+#    resolution (int) - spacing between grid points, in crs units
+#    batchSize (int) - number of points in each batch
+def createPointStoreFromArrays(storeFolder,x,y,crs,resolution,batchSize=BATCH_SIZE):
+    if not(os.path.exists(storeFolder)):
+        os.makedirs(storeFolder)
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    minX, minY = float(x.min()), float(y.min())
+    col = np.rint((x - minX)/resolution).astype(np.int32)
+    row = np.rint((y - minY)/resolution).astype(np.int32)
+    for name, values in zip(['x','y','row','col'],[x,y,row,col]):
+        np.save(os.path.join(storeFolder,name + '.npy'),values)
+    saveMeta(storeFolder,{
+        'crs':crs,
+        'resolution':resolution,
+        'minX':minX,
+        'minY':minY,
+        'nRows':int(row.max()) + 1,
+        'nCols':int(col.max()) + 1,
+        'nPoints':len(x)
+    })
+    createPointStore(storeFolder,batchSize)
+
+# open a point store.  Arrays are memory-mapped, so opening the store is cheap and points are only
+# read from disk when accessed
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the point store
+#    mode (str) - memory-map mode. 'r' for read only, 'r+' to update screening flags
+# OUTPUTS:
+#    store (dict) - memory-mapped arrays for each point attribute, plus grid metadata under 'meta'
+def loadPointStore(storeFolder,mode='r'):
+    store = {'meta':loadMeta(storeFolder)}
+    for name in STORE_ARRAYS:
+        arrayMode = mode if name == 'flags' else 'r'
+        store[name] = np.load(os.path.join(storeFolder,name + '.npy'),mmap_mode=arrayMode)
+    return(store)
+
+# flag all points that fall within the features of a screening shapefile (e.g. water bodies)
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the point store
+#    shapefile (str) - absolute filepath to polygon shapefile of areas to screen
+#    flag (int) - screening flag to set for points inside the polygons
+#    chunkSize (int) - number of points to test at once
+def setScreeningFlag(storeFolder,shapefile,flag,chunkSize=1000000):
+    import geopandas as gpd
+    import shapely
+    store = loadPointStore(storeFolder,mode='r+')
+    screen = gpd.read_file(shapefile).to_crs(store['meta']['crs'])
+    screenGeom = shapely.union_all(screen.geometry.values)
+    shapely.prepare(screenGeom)
+    for start in range(0,store['meta']['nPoints'],chunkSize):
+        end = start + chunkSize
+        inside = shapely.intersects_xy(screenGeom,store['x'][start:end],store['y'][start:end])
+        store['flags'][start:end][inside] |= np.uint8(flag)
+    store['flags'].flush()
+
+# drop points flagged by screening from the store, and reassign point ids so they stay consecutive.
+# Grid row/column are kept, so predictions can still be placed on the grid.  Must be called after
+# screening and before any stage uses point ids.  Every compacted array and the metadata are written
+# under temporary names before any of them replace the store, and the metadata (written last) marks
+# the store as compacted.  If the process stops while arrays are being replaced, the next call finishes
+# replacing them rather than compacting again
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the point store
+# OUTPUTS:
+#    number of points dropped
+def compactPointStore(storeFolder):
+    metaPath = os.path.join(storeFolder,GRID_META_FILE)
+    if not(os.path.exists(metaPath + '.tmp')):
+        meta = loadMeta(storeFolder)
+        if meta.get('isCompacted',False):
+            print("point store has already been compacted")
+            return(0)
+        isKept = (np.load(os.path.join(storeFolder,'flags.npy')) & SCREENING_FLAGS) == 0
+        nKept = int(isKept.sum())
+        for name in ['x','y','row','col','flags']:
+            arrayPath = os.path.join(storeFolder,name + '.npy')
+            np.save(arrayPath + '.tmp.npy',np.load(arrayPath)[isKept])
+        np.save(os.path.join(storeFolder,'pointId.npy.tmp.npy'),np.arange(nKept,dtype=np.int64))
+        meta['nDropped'] = len(isKept) - nKept
+        meta['nPoints'] = nKept
+        meta['isCompacted'] = True
+        with open(metaPath + '.tmp','w') as metaFile:
+            json.dump(meta,metaFile,indent=2)
+
+    # every temporary file is complete once the temporary metadata exists
+    for name in STORE_ARRAYS:
+        arrayPath = os.path.join(storeFolder,name + '.npy')
+        if os.path.exists(arrayPath + '.tmp.npy'):
+            os.replace(arrayPath + '.tmp.npy',arrayPath)
+    os.replace(metaPath + '.tmp',metaPath)
+    return(loadMeta(storeFolder)['nDropped'])
+
+# convert a batch signature to the range of point ids it covers
+# INPUTS:
+#    fileSig (str) - unique identifier for a batch of grid points (e.g. b1000 for points 1000-1999)
+#    batchSize (int) - number of points in each batch
+# OUTPUTS:
+#    startId (int) - first point id in the batch (inclusive)
+#    endId (int) - last point id in the batch (exclusive)
+def batchSigToRange(fileSig,batchSize=BATCH_SIZE):
+    startId = int(fileSig[1:])
+    return(startId,startId + batchSize)
+
+# list the unique identifiers of all batches in the store
+# INPUTS:
+#    store (dict) - point store returned by loadPointStore
+# OUTPUTS:
+#    list of batch signatures (e.g. ['b0','b1000',...])
+def listBatchSigs(store):
+    batchSize = store['meta']['batchSize']
+    return(['b' + str(startId) for startId in range(0,store['meta']['nPoints'],batchSize)])
+
+# get a batch of grid points as views into the store.  No points are copied
+# INPUTS:
+#    store (dict) - point store returned by loadPointStore
+#    fileSig (str) - unique identifier for a batch of grid points (e.g. b1000 for points 1000-1999)
+# OUTPUTS:
+#    batch (dict) - point attribute arrays for the batch, plus 'FID', the position of each point
+#                   within the batch (0-999), which matches IN_FID in near tables
+def getBatch(store,fileSig):
+    startId, endId = batchSigToRange(fileSig,store['meta']['batchSize'])
+    endId = min(endId,store['meta']['nPoints'])
+    batch = {'fileSig':fileSig,'startId':startId}
+    for name in STORE_ARRAYS:
+        batch[name] = store[name][startId:endId]
+    batch['FID'] = np.arange(endId - startId,dtype=np.int32)
+    return(batch)
+
+# identify points in a batch that have not been removed by screening (e.g. points within buildings).
+# Every point passes once the store has been compacted
+# INPUTS:
+#    batch (dict) - batch of points returned by getBatch
+# OUTPUTS:
+#    boolean array, True for points that passed screening
+def isScreened(batch):
+    return((batch['flags'] & SCREENING_FLAGS) == 0)
+
+# get longitude and latitude (WGS84) of all points in a batch
+# INPUTS:
+#    store (dict) - point store returned by loadPointStore
+#    batch (dict) - batch of points returned by getBatch
+# OUTPUTS:
+#    lon (float array), lat (float array) - coordinates of each point in the batch
+def getBatchLonLat(store,batch):
+    from pyproj import Transformer
+    transformer = Transformer.from_crs(store['meta']['crs'],'EPSG:4326',always_xy=True)
+    return(transformer.transform(np.asarray(batch['x']),np.asarray(batch['y'])))
@@ -1,41 +1,41 @@
 # partitionPoints.py
 # Author: Andrew Larkin
 # Date Created: March 25th, 2024
-# Summary: Partition a grid of points into 1000 point subsets.
+# Summary: Convert a grid of points into a single memory-mapped point store and screen out points
+#          in water bodies, buildings, and roads.  Screened points are dropped from the store, so
+#          downstream stages never process them.  Batches of 1000 points (e.g. b1000 for points
+#          1000-1999) are views into the store rather than partitioned shapefiles.
 #          Purpose is to facilitate downstream data parallelism
 
 # import libraries
-import arcpy
-import os
-arcpy.env.overwriteOutput=True
+import gridPointStore
 
 # define global constants
 PARENT_FOLDER = "H:/Noise/implementation/"
-GDB = PARENT_FOLDER + "fishnet.gdb/"
-OUTPUT_FOLDER = PARENT_FOLDER + "screenedFishnet/"
-nearFolder = PARENT_FOLDER + "near/"
-N_POINTS = 6428930 # number of points in grid
+POINT_STORE_FOLDER = PARENT_FOLDER + "pointStore/" # grid arrays created by createGrid.py
+WATER_SHAPEFILE = PARENT_FOLDER + "Willamette_Columbia_High_Water/Willamette_Columbia_River_Ordinary_High_Water.shp"
+BUILDINGS_SHAPEFILE = "H:/Noise/building/buildingMergedDissolve2/buildingMergedDissolve2.shp"
+ROADS_SHAPEFILE = PARENT_FOLDER + "roadPolygons.shp"
 BATCH_SIZE = 1000 # max number of points for each subset
+
 ########## HELPER FUNCTIONS #############
 
-# copy 1000 sequential points from the fishnet and save as a new shapefile
+# add point ids to the grid arrays created by createGrid.py, flag points within water bodies,
+# buildings, and roads, and drop the flagged points from the store
 # INPUTS:
-#    FID_Min (int) - lower bound (inclusive) of the point id range to include in the subset
-#    FID_Max (int) - upper bound (exclusive) of the point id range to include in the subset
-def partitionFishnet(FID_Min,FID_Max):
-    whereClause = "OBJECTID >= " + str(FID_Min) + " AND OBJECTID < " + str(FID_Max)
-    a = arcpy.conversion.FeatureClassToFeatureClass(
-        GDB + "fishnetWithoutRiverBuildingRoadCity", 
-        OUTPUT_FOLDER,
-        whereClause
-    )
+#    storeFolder (str) - absolute folderpath to grid arrays
+def partitionFishnet(storeFolder):
+    gridPointStore.createPointStore(storeFolder,BATCH_SIZE)
+    for screenFile, flag in [(WATER_SHAPEFILE,gridPointStore.FLAG_WATER),
+                             (BUILDINGS_SHAPEFILE,gridPointStore.FLAG_BUILDING),
+                             (ROADS_SHAPEFILE,gridPointStore.FLAG_ROAD)]:
+        gridPointStore.setScreeningFlag(storeFolder,screenFile,flag)
+    nDropped = gridPointStore.compactPointStore(storeFolder)
+    print("dropped %i screened points" %(nDropped))
 
 ########## MAIN FUNCTION #############
 if __name__ == '__main__':
-    minVal = 0 # index starts at 0
-    while minVal < N_POINTS:
-        # arcpy doesn't like files that start with a number.  b is short for 'batch'
-        outputFile = 'b' + str(minVal) + '.shp' 
-        if not(os.path.exists(OUTPUT_FOLDER + outputFile)):
-            partitionFishnet(minVal,minVal + BATCH_SIZE,outputFile)
-        minVal +=BATCH_SIZE
\ No newline at end of file
+    partitionFishnet(POINT_STORE_FOLDER)
+    store = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    print("created point store with %i points in %i batches" %(
+        store['meta']['nPoints'],len(gridPointStore.listBatchSigs(store))))
@@ -1,109 +1,84 @@
 # createRasters.py
 # Author: Andrew Larkin
 # Date Created: March 27th, 2024
-# Summary: given a grid of DNL and LEQ predictions, filter records 
-#          and create a final raster interpolated for 
+# Summary: given a grid of DNL and LEQ predictions, create a final noise raster for Portland, OR.
+#          Predictions are written straight into a GeoTIFF on the prediction grid using each grid
+#          point's row and column.  Cells without predictions (e.g. building footprints) are then
+#          interpolated from neighbouring cells, values are clamped, and the raster is clipped to
+#          the city boundary
 
 # import libraries
+import os
+import sys
+import numpy as np
+import rasterio
 import arcpy
 arcpy.env.overwriteOutput=True
 
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+# predictions are written by the prediction stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PredictLEQAndDNL'))
+import predictionWriter
+
 # define global constants
 HOME_FOLDER = "H:/Noise/"
 PREDICTION_FOLDER = HOME_FOLDER + "implementation/predictions/"
-TEMP_FOLDER = PREDICTION_FOLDER + "tempFiles.gdb/"
-LEQ_POINT_FILE = PREDICTION_FOLDER + "LEQ.csv"
-LEQ_SHAPEFILE = TEMP_FOLDER + "LEQScreened4"
-DNL_POINT_FILE = PREDICTION_FOLDER + "DNL.csv"
-DNL_SHAPEFILE = TEMP_FOLDER + "DNL"
+POINT_STORE_FOLDER = HOME_FOLDER + "implementation/pointStore/"
+PREDICTION_STORE_FOLDER = PREDICTION_FOLDER + "predictionStore/" # binary predictions written by predictGridPoints.py
+LEQ_GRID_RASTER = PREDICTION_FOLDER + "LEQGrid.tif" # predictions on the 10m grid, before cleaning
+DNL_GRID_RASTER = PREDICTION_FOLDER + "DNLGrid.tif"
 LEQ_RASTER_FILE = PREDICTION_FOLDER + "LEQScreened2.tif"
 DNL_RASTER_FILE = PREDICTION_FOLDER + "DNL.tif"
-BUILDINGS_SHAPEFILE = HOME_FOLDER + "building/buildingMergedDissolve2/buildingMergedDissolve2.shp"
 WATER_SHAPEFILE = "H:/Noise/implementation/Willamette_Columbia_High_Water/Willamette_Columbia_River_Ordinary_High_Water.shp"
 CITY_BOUNDARY = HOME_FOLDER + "CityBoundary/Portland_City_Boundary/PDX_Boundary.shp"
 AIRPORT_SHAPEFILE = "C:/users/larki/downloads/PDX_Boundary/PDX_Boundary.shp"
-
-# CRS that lat/long coords are stored in
-CRS_SHAPEFILE = 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]];-400 -400 1000000000;-100000 10000;-100000 10000;8.98315284119521E-09;0.001;0.001;IsHighPrecision'
-# CRS with units in meters
-CRS_RASTER = 'PROJCS["WGS_1984_Web_Mercator_Auxiliary_Sphere",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Mercator_Auxiliary_Sphere"],PARAMETER["False_Easting",0.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",0.0],PARAMETER["Standard_Parallel_1",0.0],PARAMETER["Auxiliary_Sphere_Type",0.0],UNIT["Meter",1.0]]'
+NODATA = -9999 # value of grid cells without a prediction (e.g. screened grid points)
+SCATTER_CHUNK_SIZE = 1000000 # number of predictions placed in the raster at once.  Bounds memory use
 
 
 ####################### HELPER FUNCTIONS ##################
 
-# created a shapefile from csv and remove points contained
-# within building footprints and water bodies
+# write predictions directly into a GeoTIFF on the prediction grid.  Each grid point's row and column
+# are known from the point store, so predictions are scattered into a 2D array in the grid crs rather
+# than converted to points and rasterized.  Grid rows start at the southern edge, while raster rows
+# start at the northern edge, so rows are flipped
 # INPUTS:
-#    inCSV (str) - absoluste filepath to grid point csv
-#    outFilepath (str) - absolute filepath to where the shapefile should be written
-def createShapefile(inCSV,outFilepath):
-    tempShp = 'in_memory/tempShp' # hold the shapefile in memory until its fully screened
-
-    # create shapefile from csv.  Coords are in WGS84
-    arcpy.management.XYTableToPoint(
-        in_table=inCSV,
-        out_feature_class=tempShp,
-        x_field="longitude",
-        y_field="latitude",
-        z_field=None,
-        coordinate_system=CRS_SHAPEFILE
-    )
-    # remove points that are within water bodies
-    selectedFeatures = arcpy.management.SelectLayerByLocation(
-        in_layer=tempShp,
-        overlap_type="INTERSECT",
-        select_features=WATER_SHAPEFILE,
-        search_distance="#",
-        selection_type="NEW_SELECTION",
-        invert_spatial_relationship="INVERT"
-    )
-
-    # remove points that are within building footprints
-    selectedFeatures2 = arcpy.management.SelectLayerByLocation(
-        in_layer=selectedFeatures,
-        overlap_type="INTERSECT",
-        select_features=BUILDINGS_SHAPEFILE,
-        search_distance="#",
-        selection_type="REMOVE_FROM_SELECTION",
-        invert_spatial_relationship="NOT_INVERT"
-    )
-
-    # save filtered shapefile
-    arcpy.CopyFeatures_management(selectedFeatures2, outFilepath)
-
-    # cleanup
-    arcpy.management.Delete(tempShp)
-    arcpy.management.Delete(selectedFeatures)
-    arcpy.management.Delete(selectedFeatures2)
-
-
-# convert grid points to 10m raster, and screen raster
+#    predictions (dict) - prediction output returned by predictionWriter.loadPredictions
+#    pointStore (dict) - point store returned by gridPointStore.loadPointStore
+#    valueField (str) - name of the prediction column to write (e.g. LEQ)
+#    outputRaster (str) - absolute filepath where the GeoTIFF should be written
+def createGridRaster(predictions,pointStore,valueField,outputRaster):
+    meta = pointStore['meta']
+    resolution = meta['resolution']
+    dtype = np.int32 if np.issubdtype(predictions[valueField].dtype,np.integer) else np.float32
+    values = np.full((meta['nRows'],meta['nCols']),NODATA,dtype=dtype)
+    for start in range(0,predictions['meta']['nRows'],SCATTER_CHUNK_SIZE):
+        pointId = np.asarray(predictions['pointId'][start:start + SCATTER_CHUNK_SIZE])
+        rows = meta['nRows'] - 1 - np.asarray(pointStore['row'][pointId])
+        cols = np.asarray(pointStore['col'][pointId])
+        values[rows,cols] = predictions[valueField][start:start + SCATTER_CHUNK_SIZE]
+
+    # grid points are at cell centers, so the raster extent is half a cell wider than the grid on each side
+    transform = rasterio.Affine(resolution,0,meta['minX'] - resolution/2,
+                                0,-resolution,meta['minY'] + (meta['nRows'] - 0.5)*resolution)
+    with rasterio.open(outputRaster,'w',driver='GTiff',height=meta['nRows'],width=meta['nCols'],count=1,
+                       dtype=dtype,crs=meta['crs'],transform=transform,nodata=NODATA,compress='lzw') as dst:
+        dst.write(values,1)
+
+
+# fill gaps in a grid raster of predictions, and screen the raster
 # INPUTS:
-#    inShapefile (str) - absolute filepath to shapefile containing grid points
-#    valueField (str) - name of the attribute field that contains raster values
+#    gridRaster (str) - absolute filepath to the grid raster created by createGridRaster
 #    outputRaster (str) - aboluste filepath to where the created raster should be stored
-def makeRaster(inShapefile,valueField,outputRaster):
-
-    # hold the raster in memory until it's fully cleaned
-    rasterFilepath = 'in_memory/raster'
-
-    # create a raster from a points shapefile. Change the CRS so units of cell size are in meters
-    with arcpy.EnvManager(outputCoordinateSystem=CRS_RASTER):
-        arcpy.conversion.PointToRaster(
-            in_features=inShapefile,
-            value_field=valueField,
-            out_rasterdataset=rasterFilepath,
-            cell_assignment="MOST_FREQUENT",
-            priority_field="NONE",
-            cellsize=10,
-            build_rat="BUILD"
-        )
-
+def makeRaster(gridRaster,outputRaster):
 
-    # interpolate to fill in building footprints
-    output = arcpy.sa.Con(arcpy.sa.IsNull(rasterFilepath), 
-                 arcpy.sa.FocalStatistics(rasterFilepath,arcpy.sa.NbrCircle(2, "CELL"),"MEAN",'NODATA'),
-                 rasterFilepath)
+    # interpolate to fill in building footprints.  Cells without predictions are read as nodata
+    output = arcpy.sa.Con(arcpy.sa.IsNull(gridRaster), 
+                 arcpy.sa.FocalStatistics(gridRaster,arcpy.sa.NbrCircle(2, "CELL"),"MEAN",'NODATA'),
+                 gridRaster)
 
     # clamp maximum values t
     output = arcpy.sa.Con(output > 86, 86,output)
@@ -167,7 +142,9 @@ def makeRaster(inShapefile,valueField,outputRaster):
 
 ####################### MAIN FUNCTION ##################
 if __name__ == '__main__':
-    #createShapefile(LEQ_POINT_FILE,LEQ_SHAPEFILE)
-    makeRaster(LEQ_SHAPEFILE,'LEQ',LEQ_RASTER_FILE)
-    #createShapefile(DNL_POINT_FILE,DNL_SHAPEFILE)
-    #makeRaster(DNL_SHAPEFILE,'DNL',DNL_RASTER_FILE)
+    predictions = predictionWriter.loadPredictions(PREDICTION_STORE_FOLDER)
+    pointStore = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    createGridRaster(predictions,pointStore,'LEQ',LEQ_GRID_RASTER)
+    makeRaster(LEQ_GRID_RASTER,LEQ_RASTER_FILE)
+    #createGridRaster(predictions,pointStore,'DNL',DNL_GRID_RASTER)
+    #makeRaster(DNL_GRID_RASTER,DNL_RASTER_FILE)
@@ -0,0 +1,115 @@
+# bufferAggregation.py
+# Summary: calculate buffer statistics of road variables for many buffer distances in a single pass.
+#          Near table pairs are sorted by grid point and then by distance, so the road segments within
+#          any buffer are a prefix of each grid point's pairs.  Statistics for every buffer distance
+#          are read from cumulative sums and counts at each buffer breakpoint
+
+# import libraries
+import os
+import sys
+import numpy as np
+import roadAttributeStore
+
+# near tables are written by the preprocessing stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PreprocessPredictionDatasets'))
+import nearTableCSR
+
+# define global constants
+ROAD_VARIABLES = roadAttributeStore.ROAD_VARIABLES
+VARIABLE_CODES = ['sped','vefr','pcca','pche','pcme','emhe'] # variable code used in metric names
+CUMULATIVE_STATS = [('m','u'),('m','d'),('s','u'),('s','d')] # (statistic, weighting) pairs: mean or sum,
+                                                             # unweighted or normalized by distance
+
+# road classification codes used in metric names, and the roadType values each code includes
+ROAD_TYPES = {
+    'p':[0], # primary/secondary roads
+    't':[1], # tertiary roads
+    'r':[2], # residential roads
+    'a':[0,1,2,3] # all roads
+}
+
+########## HELPER FUNCTIONS #############
+
+# load distances from grid points to road segments in a batch and attach road variables to each pair
+# INPUTS:
+#    nearFile (str) - absolute filepath to the batch near table
+#    roadStore (dict) - road attributes returned by roadAttributeStore.loadRoadStore
+#    minDist (float) - distances less than minDist are rounded up, to avoid dividing by small distances
+# OUTPUTS:
+#    neighbours (dict) - number of grid points, and arrays with one value for each pair: grid point
+#                        (IN_FID), road segment (NEAR_FID), distance, roadType (-1 for road segments
+#                        missing from the road store), and road variables (one column for each ROAD_VARIABLES)
+def loadNeighbours(nearFile,roadStore,minDist):
+    nearTable = nearTableCSR.openNearTable(nearFile)
+    nearFid = np.asarray(nearTable['NEAR_FID'])
+    values, roadType = roadAttributeStore.gatherRoadAttributes(roadStore,nearFid)
+    neighbours = {
+        'nPoints':nearTable['nPoints'],
+        'IN_FID':nearTableCSR.getInFid(nearTable),
+        'NEAR_FID':nearFid,
+        'dist':np.maximum(np.asarray(nearTable['NEAR_DIST'],dtype=np.float64),minDist),
+        'roadType':roadType,
+        'values':values
+    }
+    return(neighbours)
+
+# identify pairs with road segments in a road classification
+# INPUTS:
+#    neighbours (dict) - pairs returned by loadNeighbours
+#    roadTypeCode (char) - road classification code (see ROAD_TYPES)
+# OUTPUTS:
+#    boolean array, True for pairs with a road segment in the classification
+def selectRoadType(neighbours,roadTypeCode):
+    return(np.isin(neighbours['roadType'],ROAD_TYPES[roadTypeCode]))
+
+# find where each buffer ends within each grid point's pairs.  Pairs must be sorted by grid point and
+# then by distance.  Pairs for point p within buffer r are stored in [starts[p], ends[p,r])
+# INPUTS:
+#    inFid (int array) - grid point for each pair
+#    dist (float array) - distance for each pair
+#    nPoints (int) - number of grid points in the batch
+#    radii (int array) - buffer distances
+# OUTPUTS:
+#    starts (int array) - first pair of each grid point
+#    ends (int array) - one past the last pair within each buffer distance (points x radii)
+def calcBufferEnds(inFid,dist,nPoints,radii):
+
+    # combine grid point and distance into one sorted key.  The key spacing between grid points is a
+    # power of two larger than any distance, so distances are represented exactly
+    span = 2.0**np.ceil(np.log2(max(np.max(dist,initial=0),np.max(radii)) + 1))
+    keys = inFid*span + dist
+    pointKeys = np.arange(nPoints)*span
+    starts = np.searchsorted(keys,pointKeys,side='left')
+    ends = np.searchsorted(keys,pointKeys[:,None] + np.asarray(radii,dtype=np.float64)[None,:],side='right')
+    return(starts,ends)
+
+# calculate the mean and sum of road variables, unweighted and normalized by distance, for every
+# buffer distance.  Missing road variable values are excluded, matching pandas groupby statistics
+# INPUTS:
+#    neighbours (dict) - pairs returned by loadNeighbours
+#    pairMask (bool array) - pairs to include (e.g. unshielded primary roads)
+#    radii (int array) - buffer distances
+# OUTPUTS:
+#    float64 array (points x radii x CUMULATIVE_STATS x ROAD_VARIABLES).  Grid points without road
+#    segments in a buffer are assigned 0
+def calcCumulativeStats(neighbours,pairMask,radii):
+    pairIndex = np.flatnonzero(pairMask)
+    dist = neighbours['dist'][pairIndex]
+    starts, ends = calcBufferEnds(neighbours['IN_FID'][pairIndex],dist,neighbours['nPoints'],radii)
+
+    # cumulative sums of unweighted and distance normalized values, and counts of non-missing values
+    values = neighbours['values'][pairIndex]
+    isValid = ~np.isnan(values)
+    values = np.where(isValid,values,0)
+    cumValues = np.zeros((len(pairIndex) + 1,2,values.shape[1]))
+    np.cumsum(values,axis=0,out=cumValues[1:,0])
+    np.cumsum(values/dist[:,None],axis=0,out=cumValues[1:,1])
+    cumCounts = np.zeros((len(pairIndex) + 1,values.shape[1]))
+    np.cumsum(isValid,axis=0,out=cumCounts[1:])
+
+    # sums and counts within each buffer are differences of cumulative values at the buffer breakpoints
+    sums = cumValues[ends] - cumValues[starts][:,None]
+    counts = (cumCounts[ends] - cumCounts[starts][:,None])[:,:,None,:]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        means = np.where(counts > 0,sums/counts,0)
+    return(np.stack([means[:,:,0],means[:,:,1],sums[:,:,0],sums[:,:,1]],axis=2))
@@ -2,108 +2,109 @@
 # Author: Andrew Larkin
 # Date Created: March 25th, 2024
 # Summary: determine whether every grid piont is shielded from each
-#          road segment within 2000m
+#          road segment within 2000m.  All point/road pairs in a batch are
+#          compared against building distances in a single pass
 
 # import libraries
 from multiprocessing import Pool
 import os
-import time
+import sys
 import random
-import pandas as ps
-import warnings
-warnings.simplefilter(action='ignore', category=FutureWarning)
+import numpy as np
+
+# near tables and angle bins are written by the preprocessing stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PreprocessPredictionDatasets'))
+import nearTableCSR
+import angularBins
 
 # define global constants
 NEAR_ROADS_FOLDER =  "Y:/noise/near/"
 NEAR_BLDGS_FOLDER = "E:/Noise/bldgDist/"
 RD_ANGLE_FOLDER = "E:/Noise/rdAngle/"
 OUTPUT_FOLDER =  "G:/Noise/shieldingBinary/"
+PAIR_CHUNK_SIZE = 2000000 # number of point/road pairs processed at once.  Bounds memory use
 N_CPUS = 32
 
 ########## HELPER FUNCTIONS #############
 
-# identify which roads a single grid point is shielded from by buildings
+# identify which roads each grid point in a batch is shielded from by buildings.  A road is shielded
+# if, in any angle the road covers, a building is at least as close to the grid point as the road
 # INPUTS:
-#    roadDists (pandas ataframe) - distance from road segments to grid point
-#    pointNum (int) - unique identifier for grid point within shapefile (e.g. 1,2,...999)
-#    bldgFile (str) - absolute filepath to file containing data for each road segment 
-#                     (e.g. speed, pavement type)
-#    rdAngleFile (str) - absolute filepath to file describing the angle of each road
-#                        segment relative to the the grid point indicted by pointNum
-#    outputFile (str) - aboluste filepath where output should be written in csv format
-def createShieldingOnePoint(roadDists,pointNum,bldgFile,rdAngleFile,outputFile):
-
-    # subset dataset to just roads within 2000m of the grid point
-    roadSubset = roadDists[roadDists['IN_FID']==pointNum]
-
-    # load datasets containing road and building angles
-    bldgShielding = ps.read_csv(bldgFile)
-    rdAngle = ps.read_csv(rdAngleFile)
-
-    # join datasets and determine if buildings within the same angle shield the grid point from 
-    # roads in the same angle
-    joined = roadSubset.merge(rdAngle,how='inner',left_on='NEAR_FID',right_on='FID_PDX10m')
-    joined = joined.merge(bldgShielding,how='inner',on='angle')
-    joined['isShielded'] = (joined['NEAR_DIST'] >= joined['dist'])*1
-
-    # subset dataaset to just the newly derived variables and save to csv
-    joined = joined[['isShielded','monitor','FID_PDX10m']]
-    joined.to_csv(outputFile,index=False)
-
-# for all grid points in a shapefile, determine which roads each grid point is shielded from
+#    roadDists (dict) - near table of distances from road segments to grid points in the batch
+#    rdAngles (int array) - start angle bin and number of bins for each near table pair, created
+#                           by calcRdAngleParallel.py
+#    bldgDists (float array) - distance to the nearest building in each angle (points x 360) for the
+#                              batch, created by calcBldgDistanceParallel.py
+#    pairChunkSize (int) - number of point/road pairs processed at once
+# OUTPUTS:
+#    uint8 array with one value for each near table pair, 1 if the road is shielded and 0 otherwise
+def calcShieldedPairs(roadDists,rdAngles,bldgDists,pairChunkSize=PAIR_CHUNK_SIZE):
+    inFid = nearTableCSR.getInFid(roadDists)
+    isShielded = np.zeros(roadDists['nPairs'],dtype=np.uint8)
+    for start in range(0,roadDists['nPairs'],pairChunkSize):
+        end = min(start + pairChunkSize,roadDists['nPairs'])
+
+        # one row for each angle covered by each pair.  Gather the building distance for the row's
+        # grid point and angle, and compare with the distance to the road
+        pairIndex, angleBin = angularBins.expandBinRanges(rdAngles[start:end,0],rdAngles[start:end,1])
+        pairIndex += start
+        isBlocked = roadDists['NEAR_DIST'][pairIndex] >= bldgDists[inFid[pairIndex],angleBin]
+        isShielded[start:end] = np.bincount(pairIndex[isBlocked] - start,minlength=end - start) > 0
+    return(isShielded)
+
+# for all grid points in a batch, determine which roads each grid point is shielded from
 # INPUTS:
-#    fileSig (str) - unique identifier corresponding to the shapefile name and grid coverage
+#    fileSig (str) - unique identifier corresponding to the batch of grid points
 #                    (e.g. b1000 corresponds to grid points 1000-1999)
 def processSingleFileSig(fileSig):
 
-    # distances to roads within 2000m of these specific grid points
-    roadFile = NEAR_ROADS_FOLDER + fileSig + ".csv"
-    outputFolder =  OUTPUT_FOLDER + fileSig + "/" 
-
-    if not os.path.exists(outputFolder):
-        os.mkdir(outputFolder)
+    # if the batch has already been processed, skip to the next batch
+    outputFile = OUTPUT_FOLDER + fileSig + ".npy"
+    if os.path.exists(outputFile):
+        print("%s has already been processed" %(fileSig))
+        return
 
-    # do not process is distance to roads has not yet been calculated 
-    if not(os.path.exists(roadFile)):
+    # do not process is distance to roads has not yet been calculated
+    roadFile = NEAR_ROADS_FOLDER + fileSig + nearTableCSR.FILE_EXTENSION
+    if not(nearTableCSR.isNearTableComplete(roadFile)):
         print("can't calculate binary shielding for fileSig %s: dist to road not available" %(fileSig))
         return
 
-    roadDists = ps.read_csv(roadFile)
-
-    # for each grid point in the shapefile (n=1000), determine which roads the grid point is shielded from
-    for pointNum in range(1000):
-        outputFile = outputFolder + "sh" + str(pointNum) + ".csv"
-
-        # if grid point has already been processed, skip to the next grid point
-        if not os.path.exists(outputFile):
-            buildingShiledingFile = NEAR_BLDGS_FOLDER + str(fileSig) + "/bldg" + str(pointNum) + ".csv"
-
-            # do not process is distance to buildings has not yet been calcualted
-            if not(os.path.exists(buildingShiledingFile)):
-                print("can't process point %i for fileSig %s: building shielding is not available" %(pointNum,fileSig))
-            else:
-                rdAngleFile = RD_ANGLE_FOLDER + fileSig + "/a" + str(pointNum) + ".csv"
-                
-                # do not process if the radial angle of each road segment relative to grid point
-                # has not yet been calcualted
-                if not(os.path.exists(rdAngleFile)):
-                    print("can't process point %i for fileSig %s: road angle is not available" %(pointNum,fileSig))
-                else:
-                    createShieldingOnePoint(roadDists,pointNum,buildingShiledingFile,rdAngleFile,outputFile)
-            
+    # do not process is distance to buildings has not yet been calcualted
+    bldgFile = NEAR_BLDGS_FOLDER + fileSig + ".npy"
+    if not(os.path.exists(bldgFile)):
+        print("can't calculate binary shielding for fileSig %s: building shielding is not available" %(fileSig))
+        return
+
+    # do not process if the radial angle of each road segment relative to grid points
+    # has not yet been calcualted for the current near table
+    roadDists = nearTableCSR.openNearTable(roadFile)
+    rdAngleFile = RD_ANGLE_FOLDER + fileSig + ".npy"
+    rdAngles = np.load(rdAngleFile,mmap_mode='r') if os.path.exists(rdAngleFile) else None
+    if rdAngles is None or len(rdAngles) != roadDists['nPairs']:
+        print("can't calculate binary shielding for fileSig %s: road angle is not available" %(fileSig))
+        return
+
+    isShielded = calcShieldedPairs(roadDists,rdAngles,np.load(bldgFile))
+
+    # write under a temporary name so partially written batches are never mistaken as complete
+    with open(outputFile + '.tmp','wb') as outFile:
+        np.save(outFile,isShielded)
+    os.replace(outputFile + '.tmp',outputFile)
+
 
 ####################### MAIN FUNCTION ##################
 
 if __name__ == '__main__':
 
-    # get list of point subset shapefiles
-    fileSigs = os.listdir(NEAR_BLDGS_FOLDER)
+    # get list of grid point batches with building distances
+    fileSigs = [fileName[:-4] for fileName in os.listdir(NEAR_BLDGS_FOLDER) if fileName[-4:] == '.npy']
 
-    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload 
+    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload
     # uniformly across cpus when the error is corrected and the script is restarted
     random.shuffle(fileSigs)
 
-    # create a pool of workers and distribute shapefiles and instructions to each worker 
+    # create a pool of workers and distribute batches and instructions to each worker
     pool = Pool(processes=N_CPUS)
     res = pool.map_async(processSingleFileSig,fileSigs)
     res.get()
@@ -8,74 +8,66 @@
 # import libraries 
 from multiprocessing import Pool
 import os
-import warnings
-warnings.simplefilter(action='ignore', category=FutureWarning)
-import pandas as ps
+import sys
+import random
+import numpy as np
+import featureStore
+
+# near tables are written by the preprocessing stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PreprocessPredictionDatasets'))
+import nearTableCSR
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
 
 # define global constants
 ABBREV = ['er','bi','tm','sl']
 BUFFER_DISTANCES = [20,20,10,20] # each variable only has one buffer size in the LUR model (1:1 match)
 MULTIPLIER = [10,10,10,1] # polyline values should be multiplied by 10 (to count as 10m of segment)
 NEAR_FOLDER = "F:/Noise/nearMisc/" # contains pre-calculated values of distance from grid points to road segments
-OUTPUT_FOLDER = "F:/Noise/miscMetrics/"
+POINT_STORE_FOLDER = "H:/Noise/implementation/pointStore/"
+FEATURE_STORE_FOLDER = "H:/Noise/implementation/featureStore/" # metrics are written to one column per metric
+N_CPUS = 16
+
+# grid metadata, loaded once per worker process
+pointMeta = None
 
 ########## HELPER FUNCTIONS #############
 
-# rename misc variables to conform to designated nomenclature scheme.  New variable names contain
-# information about the input variable, buffer distance, distance-weighting, and statistic (e.g. mean, sum)
+# load grid metadata.  Called once when each worker process starts
+def initWorker():
+    global pointMeta
+    pointMeta = gridPointStore.loadMeta(POINT_STORE_FOLDER)
+
+# create a misc variable name that conforms to the designated nomenclature scheme, e.g. sl20cuo
 # INPUTS:
-#   data (pandas dataframe) - dataset containing road metrics 
-#   bufferDist dist (int) - buffer distance used to create metrics in the dataset
-#   metricChar (char) - single character indicating whether metrics are mean, sum, or quantile
-#   weightChar (char) - single character indicating whether metrics are inverse distance weighted
-#   variable (char) - single character indicating what variable metrics were calcualted for (e.g. bus routes)
+#    variable (str) - abbreviation used to designate variable in nomenclature
+#    bufferDist (int) - buffer distance used to create the metric
+# OUTPUTS:
+#    metric name for a count ('c'), unweighted ('u') metric of other ('o') features
+def createMetricName(variable,bufferDist):
+    return(variable + str(bufferDist) + 'c' + 'u' + 'o')
+
+# list the metric names of all misc variables, in ABBREV order
 # OUTPUTS:
-#   input dataset with column names reformated to conform to designated nomenclature scheme
-def standardizeVarNomenclaturePolyline(data,bufferDist,metricChar,weightChar,variable):
-    # reduce dataset to columns with grid point id and summary statistics incorrectly named as 'NEAR_FID'
-    dataSubset = data[['IN_FID','NEAR_FID']]
-    # each misc variable only has 2 columns: grid point id and a single metric
-    varNames = ['monitor_id', variable + str(bufferDist) + metricChar + weightChar + 'o']
-    dataSubset.columns = varNames
-    return(dataSubset)
+#    list of metric names
+def listMetricNames():
+    return([createMetricName(ABBREV[index],BUFFER_DISTANCES[index]) for index in range(len(ABBREV))])
 
 # calculate metrics for a single misc variable.  Each misc variable only has one metric and 
-# buffer distance, greatly simplifying calculations
+# buffer distance: the number of features within the buffer of each grid point
 # INPUTS:
 #    bufferDist (int) - maximum allowable threshold between grid point and variable segment
-#    inData (pandas dataframe) - contains distance relationships between grid points and variables
-#    variable (str) - abbreviation used to designate varible in nomenclature
+#    nearTable (dict) - near table returned by nearTableCSR.openNearTable
 #    multiplier (int) - for polyline variables, multiply by the length of the segment (10 meters)
 # OUTPUTS:
-#    renamedData (pandas dataframe) - derived metric for the input variable with proper nomenclature
-def extractSingleBufferEstimate(bufferDist,inData,variable,multiplier):
-    filteredData = inData[inData['NEAR_DIST']<=bufferDist] # filter only for roads within the treshold
-    density = filteredData.groupby('IN_FID').count()*multiplier # multiply by length of polyline segment
-    density = density.reset_index()
-    renamedData = standardizeVarNomenclaturePolyline(density,bufferDist,'c','u',variable)
-    return(renamedData)
-
-# load data and calculate metric for a single misc feature.  
-# INPUTS:
-#    fileSig (str) - unique indentifier for each batch of grid points 
-#    (e.g. b1000 for gird points 1000-1999)
-#    featureAbbrev (str) - abbreiation used to dsignate variable in nomenclature
-#    multiplier (int) - for polyline variables, multiply by the length of the segment (10m)
-#    buffer (int) - maximum allowable threshold between grid point and variable segment
-# OUTPUTS:
-#    bufferEst (pandas dataframe) - derived metric for the input variable
-def processSingleFeature(fileSig,featureAbbrev,multiplier,buffer):
-
-    # check if near distances have been calcualted for this batch.  
-    # skip if preprocessing is not yet complete
-    nearTable = NEAR_FOLDER + featureAbbrev +"/" + fileSig + ".csv"
-    if not(os.path.exists(nearTable)):
-        print("couldn't process polyline feature %s for fileSig %s" %(featureAbbrev,fileSig))
-        return
-    nearData = ps.read_csv(nearTable)
-    bufferEst = extractSingleBufferEstimate(buffer,nearData,featureAbbrev,multiplier)
-    bufferEst = bufferEst.fillna(0)
-    return(bufferEst)
+#    float array with the metric for each grid point in the batch.  Grid points without features
+#    within the buffer are 0
+def extractSingleBufferEstimate(bufferDist,nearTable,multiplier):
+    inBuffer = np.asarray(nearTable['NEAR_DIST']) <= bufferDist # filter only for features within the treshold
+    counts = np.bincount(nearTableCSR.getInFid(nearTable)[inBuffer],minlength=nearTable['nPoints'])
+    return(counts*multiplier) # multiply by length of polyline segment
 
 # test if prerequisite processing is complete
 # INPUTS:
@@ -85,50 +77,58 @@ def processSingleFeature(fileSig,featureAbbrev,multiplier,buffer):
 #    True if preprocesing is complete, False otherwise
 def isPreprocessingComplete(fileSig):
     for ab in ABBREV:
-        testFile = NEAR_FOLDER + ab + "/" + fileSig + ".csv"
-        if(os.path.exists(testFile)==False):
+        testFile = NEAR_FOLDER + ab + "/" + fileSig + nearTableCSR.FILE_EXTENSION
+        if(nearTableCSR.isNearTableComplete(testFile)==False):
             print("preprocessing not complete for batch %s" %(fileSig))
             return False
     return True
 
-# calculate misc metrics for a single batch of grid points
+# calculate misc metrics for a single batch of grid points from the batch's near tables
+# INPUTS:
+#    fileSig (str) - unique identifier for each batch of grid points
+#    (e.g. b1000 for grid points 1000-1999)
+# OUTPUTS:
+#    dict mapping each metric name to an array with one value for each grid point in the batch
+def calcBatchMetrics(fileSig):
+    miscBuffers = {}
+    for index, metricName in enumerate(listMetricNames()):
+        nearTable = nearTableCSR.openNearTable(NEAR_FOLDER + ABBREV[index] + "/" + fileSig + nearTableCSR.FILE_EXTENSION)
+        miscBuffers[metricName] = extractSingleBufferEstimate(BUFFER_DISTANCES[index],nearTable,MULTIPLIER[index])
+    return(miscBuffers)
+
+# calculate misc metrics for a single batch of grid points, and write them to the feature store
 # INPUTS:
 #    fileSig (str) - unique identifier for each batch of grid points
 #    (e.g. b1000 for grid points 1000-1999)
 def processSingleSig(fileSig):
-    outputFile = OUTPUT_FOLDER + fileSig + ".csv"
 
     # check if metrics have already been calculated for this batch.
     # skip if already processed to reduce redundancy
-    if(os.path.exists(outputFile)):
+    startId, endId = gridPointStore.batchSigToRange(fileSig,pointMeta['batchSize'])
+    metricNames = listMetricNames()
+    if featureStore.isFeatureBatchComplete(FEATURE_STORE_FOLDER,metricNames,startId,endId):
         return
     
     # if preprocessing is not yet finished, skip this batch of grid points
     if(isPreprocessingComplete(fileSig)==False):
         return
     
-    # calculate metrics for one varible to seed the dataset
-    miscBuffers = processSingleFeature(fileSig,ABBREV[0],MULTIPLIER[0],BUFFER_DISTANCES[0])
-
-    # calculate metrics for the remaining variables
-    for index in range(1,len(BUFFER_DISTANCES)):
-        miscBuffers = miscBuffers.merge(
-            processSingleFeature(fileSig,ABBREV[index],MULTIPLIER[index],BUFFER_DISTANCES[index]),
-            how='outer',on='monitor_id'
-        )
-    
-    # grid points without varibles within the treshold have na values (e.g. no stret lights)
-    # replace NAs with 0s
-    miscBuffers = miscBuffers.fillna(0)
-    miscBuffers.to_csv(outputFile,index=False)
+    # calculate metrics for each variable from its near table
+    featureStore.writeFeatureBatch(FEATURE_STORE_FOLDER,calcBatchMetrics(fileSig),startId)
 
 ####################### MAIN FUNCTION ##################
 if __name__ == '__main__':
 
-    curNum = 0
-    while curNum < 6429000:
-        processSingleSig('b' + str(curNum))
-        print(curNum)
-        curNum +=1000
-    
-    
\ No newline at end of file
+    # create feature store columns before workers write to them
+    pointStore = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    featureStore.createFeatureColumns(FEATURE_STORE_FOLDER,listMetricNames(),pointStore['meta']['nPoints'])
+
+    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload
+    # uniformly across cpus when the error is corrected and the script is restarted
+    fileSigs = gridPointStore.listBatchSigs(pointStore)
+    random.shuffle(fileSigs)
+
+    # create a pool of workers and distribute batches to each worker
+    pool = Pool(processes=N_CPUS,initializer=initWorker)
+    res = pool.map_async(processSingleSig,fileSigs)
+    res.get()
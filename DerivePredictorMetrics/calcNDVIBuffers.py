@@ -1,65 +1,181 @@
 # calcNDVIBuffers.py
 # Author: Andrew Larkin
 # Date Created: March 25th, 2024
-# Summary: Extract values from NDVI rasters to a set of partitioned shapefiles
+# Summary: Extract values from NDVI rasters to every grid point in the point store.  Each raster is
+#          read into memory once, pixel indices for all grid points are calculated from the raster
+#          geotransform, and sampled values are written to the feature store.  In focal mode, NDVI
+#          buffers are calculated from the base NDVI raster for any list of buffer distances (see
+#          focalStatistics.py) instead of being sampled from precomputed buffer rasters.  Focal
+#          buffers are only written once they agree with the precomputed buffer rasters the
+#          regression models were fitted on, at a random sample of grid points
 
 # import libraries
-from multiprocessing import Pool
 import os
-import random
-import time
+import sys
+import numpy as np
+import rasterio
+from pyproj import Transformer
+import featureStore
+import focalStatistics
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
 
 # define global constants
-INPUT_FOLDER = "folder path where files are stored"
-GDB = 'absolute filepath to geo database where NDVI rasters are stored'
-NDVI_RASTERS = GDB + "NDVI450Raster nd450m;" + GDB + "NDVI10mRaster nd10m"
+POINT_STORE_FOLDER = "H:/Noise/implementation/pointStore/"
+FEATURE_STORE_FOLDER = "H:/Noise/implementation/featureStore/" # metrics are written to one column per metric
+NDVI_FOLDER = "absolute folderpath where NDVI rasters are stored (exported from the geodatabase as GeoTIFF)"
+NDVI_RASTERS = {
+    'nd450m':NDVI_FOLDER + "NDVI450Raster.tif",
+    'nd10m':NDVI_FOLDER + "NDVI10mRaster.tif"
+}
+POINT_CHUNK_SIZE = 1000000 # number of grid points sampled at once.  Bounds memory use
+FOCAL_MODE = False # calculate NDVI buffers from the base NDVI raster rather than sampling precomputed buffer rasters
+NDVI_BASE_RASTER = NDVI_FOLDER + "NDVIRaster.tif" # NDVI at native resolution, used in focal mode
 
-sucessfulImport = False
-# needed when using the ArcGIS license for a large # of parallel threads
-while(sucessfulImport == False):
-    try:
-        #print("try again")
-        import arcpy
-        from arcpy.ia import * 
-        from arcpy import env
-        from arcpy.sa import *
-        arcpy.env.overwriteOutput = True
-        arcpy.CheckOutExtension("Spatial")
-        sucessfulImport = True
-    except Exception as e:
-        print("couldn't import arcgis: %s" %(str(e)))
-        time.sleep(1)
+# buffer distances (meters) for focal NDVI.  Metric names are nd<radius>m, the mean NDVI of valid pixels
+# within the buffer ('m' is the mean statistic, not a unit).  The precomputed buffer rasters are focal
+# means of the same base raster, which is checked by checkFocalAgreement before focal values are written
+FOCAL_RADII = [10,450]
+N_CHECK_POINTS = 10000 # number of randomly sampled grid points compared against the precomputed buffer rasters
+FOCAL_TOLERANCE = 0.01 # absolute NDVI difference under which a grid point's values are considered equal
+MIN_AGREEMENT = 0.99 # fraction of sampled grid points that must agree before focal values are written
+RANDOM_SEED = 1 # seed for sampling grid points, so agreement checks are reproducible
 
 ########## HELPER FUNCTIONS #############
 
-# screen a list of files to find those with an "shp" extension
+# read the first band of a raster into memory
+# INPUTS:
+#    rasterFile (str) - absolute filepath to the raster
+# OUTPUTS:
+#    raster (dict) - float32 pixel values with nodata as NaN, geotransform (gdal coefficient order), and crs
+def loadRaster(rasterFile):
+    with rasterio.open(rasterFile) as src:
+        raster = {
+            'values':src.read(1,masked=True).astype(np.float32).filled(np.nan),
+            'geotransform':src.transform.to_gdal(),
+            'crs':src.crs.to_string()
+        }
+    return(raster)
+
+# sample raster values at points, using the value of the pixel containing each point (no interpolation)
 # INPUTS:
-#    filesToProcess (str array) - list of candidate files
+#    raster (dict) - raster returned by loadRaster
+#    x (float array) - x coordinates of points, in the raster crs
+#    y (float array) - y coordinates of points, in the raster crs
 # OUTPUTS:
-#    screenedFiles (str array) - candidate files with an 'shp' extension
-def processFiles(filesToProcess):
-    screenedFiles = []
-    for file in filesToProcess:
-        if file[-3:] == 'shp':
-            screenedFiles.append(file)
-    return(screenedFiles)
+#    float32 array of sampled values.  Points outside the raster or on nodata pixels are NaN
+def samplePoints(raster,x,y):
+    row, col = focalStatistics.calcPixelIndex(raster['geotransform'],x,y)
+    nRows, nCols = raster['values'].shape
+    isInside = (row >= 0) & (row < nRows) & (col >= 0) & (col < nCols)
+    values = np.full(len(col),np.nan,dtype=np.float32)
+    values[isInside] = raster['values'][row[isInside],col[isInside]]
+    return(values)
 
-# exact NDVI values to points in a shapefile
+# sample an NDVI raster at every grid point and write the values to the feature store.  Points outside
+# the raster or on nodata pixels are assigned 0, so they do not contribute to predictions
 # INPUTS:
-#    pointsFile (str) - absolute filepath to shapefile
-def extractNDVI(pointsFile):
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    metricName (str) - feature store column to write (e.g. nd450m)
+#    rasterFile (str) - absolute filepath to the NDVI raster
+def extractNDVI(store,metricName,rasterFile):
+    raster = loadRaster(rasterFile)
+    transformer = Transformer.from_crs(store['meta']['crs'],raster['crs'],always_xy=True)
+    for startId in range(0,store['meta']['nPoints'],POINT_CHUNK_SIZE):
+        endId = min(startId + POINT_CHUNK_SIZE,store['meta']['nPoints'])
+        x, y = transformer.transform(np.asarray(store['x'][startId:endId]),np.asarray(store['y'][startId:endId]))
+        values = np.nan_to_num(samplePoints(raster,x,y))
+        featureStore.writeFeatureBatch(FEATURE_STORE_FOLDER,{metricName:values},startId)
+    print("extracted %s for %i grid points" %(metricName,store['meta']['nPoints']))
 
-    arcpy.sa.ExtractMultiValuesToPoints(
-        in_point_features=INPUT_FOLDER + pointsFile,
-        in_rasters=NDVI_RASTERS,
-        bilinear_interpolate_values="NONE"
-    )
+# create the name of a focal NDVI metric, following the designated nomenclature scheme
+# INPUTS:
+#    radius (int) - buffer distance, in meters
+#    statistic (char) - 'm' for mean or 's' for sum
+# OUTPUTS:
+#    metric name (e.g. nd450m)
+def createFocalName(radius,statistic):
+    return('nd' + str(radius) + statistic)
+
+# calculate focal NDVI means around every grid point for all buffer distances.  Points outside the
+# raster or without valid NDVI pixels in the buffer are assigned 0
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    rasterFile (str) - absolute filepath to the base NDVI raster
+#    radii (int array) - buffer distances, in meters.  The raster crs must be in meters
+# OUTPUTS:
+#    metrics (dict) - maps each focal metric name (e.g. nd450m) to an array with one value for each grid point
+def calcFocalNDVI(store,rasterFile,radii):
+    raster = loadRaster(rasterFile)
+    cellSize = abs(raster['geotransform'][1])
+    transformer = Transformer.from_crs(store['meta']['crs'],raster['crs'],always_xy=True)
+
+    # pixel indices are found in chunks, then focal statistics are calculated for all points in one
+    # pass so each raster tile is convolved only once
+    nPoints = store['meta']['nPoints']
+    row = np.empty(nPoints,dtype=np.int64)
+    col = np.empty(nPoints,dtype=np.int64)
+    for startId in range(0,nPoints,POINT_CHUNK_SIZE):
+        endId = min(startId + POINT_CHUNK_SIZE,nPoints)
+        x, y = transformer.transform(np.asarray(store['x'][startId:endId]),np.asarray(store['y'][startId:endId]))
+        row[startId:endId], col[startId:endId] = focalStatistics.calcPixelIndex(raster['geotransform'],x,y)
+    sums, means = focalStatistics.calcFocalStats(raster['values'],cellSize,radii,row,col)
+    metrics = {createFocalName(radius,'m'):np.nan_to_num(means[:,radiusIndex]) for radiusIndex, radius in enumerate(radii)}
+    return(metrics)
+
+# compare focal NDVI metrics against the precomputed buffer rasters (see NDVI_RASTERS) at a random
+# sample of grid points.  Points outside a buffer raster or on its nodata pixels are not compared
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    metrics (dict) - focal metrics returned by calcFocalNDVI
+#    nPoints (int) - number of grid points to compare
+#    seed (int) - random number generator seed
+# OUTPUTS:
+#    True if every focal metric with a precomputed buffer raster agrees within FOCAL_TOLERANCE for at
+#    least MIN_AGREEMENT of the compared grid points, False otherwise
+def checkFocalAgreement(store,metrics,nPoints,seed=RANDOM_SEED):
+    rng = np.random.default_rng(seed)
+    sampleIds = np.sort(rng.choice(store['meta']['nPoints'],size=min(nPoints,store['meta']['nPoints']),replace=False))
+    isAgreement = True
+    for metricName in metrics:
+        if metricName not in NDVI_RASTERS:
+            print("%s: no precomputed buffer raster to compare against" %(metricName))
+            continue
+        raster = loadRaster(NDVI_RASTERS[metricName])
+        transformer = Transformer.from_crs(store['meta']['crs'],raster['crs'],always_xy=True)
+        x, y = transformer.transform(np.asarray(store['x'][sampleIds]),np.asarray(store['y'][sampleIds]))
+        bufferValues = samplePoints(raster,x,y)
+        isCompared = ~np.isnan(bufferValues)
+        if not(isCompared.any()):
+            print("%s: no sampled grid points fall on the precomputed buffer raster" %(metricName))
+            isAgreement = False
+            continue
+        diff = np.abs(metrics[metricName][sampleIds][isCompared] - bufferValues[isCompared])
+        fracAgree = float(np.mean(diff <= FOCAL_TOLERANCE))
+        print("%s: %i grid points, %.4f agree, mean abs diff %.6f, max abs diff %.6f" %(
+            metricName,len(diff),fracAgree,diff.mean(),diff.max()))
+        if(fracAgree < MIN_AGREEMENT):
+            isAgreement = False
+    return(isAgreement)
 
 ####################### MAIN FUNCTION ##################
-    
-if __name__ == '__main__':  
-    filesToProcess = processFiles(os.listdir(INPUT_FOLDER))
-    random.shuffle(filesToProcess)
-    pool = Pool(processes=3)
-    res = pool.map_async(extractNDVI,filesToProcess)
-    res.get()
\ No newline at end of file
+
+if __name__ == '__main__':
+    pointStore = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    if FOCAL_MODE:
+
+        # focal buffers replace model inputs, so they are only written if they reproduce the
+        # precomputed buffer rasters
+        metrics = calcFocalNDVI(pointStore,NDVI_BASE_RASTER,FOCAL_RADII)
+        if(checkFocalAgreement(pointStore,metrics,N_CHECK_POINTS)):
+            featureStore.createFeatureColumns(FEATURE_STORE_FOLDER,list(metrics.keys()),pointStore['meta']['nPoints'])
+            featureStore.writeFeatureBatch(FEATURE_STORE_FOLDER,metrics,0)
+            print("extracted %s for %i grid points" %(', '.join(metrics.keys()),pointStore['meta']['nPoints']))
+        else:
+            print("focal NDVI buffers do not agree with the precomputed buffer rasters and were not written")
+    else:
+        featureStore.createFeatureColumns(FEATURE_STORE_FOLDER,list(NDVI_RASTERS.keys()),pointStore['meta']['nPoints'])
+        for metricName, rasterFile in NDVI_RASTERS.items():
+            extractNDVI(pointStore,metricName,rasterFile)
@@ -7,20 +7,45 @@
 
 # import libraries 
 from multiprocessing import Pool
-import pandas as ps
+import numpy as np
 import os
+import sys
 import warnings
 import random
+import roadAttributeStore
+import featureStore
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-OUTPUT_FOLDER = "H:/Noise/implementation/pcca700mdp/"
+# near tables are written by the preprocessing stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PreprocessPredictionDatasets'))
+import nearTableCSR
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+POINT_STORE_FOLDER = "H:/Noise/implementation/pointStore/"
+FEATURE_STORE_FOLDER = "H:/Noise/implementation/featureStore/" # metrics are written to one column per metric
+METRICS_TO_KEEP = ['pcca700mdp'] # road metrics used in the land use regression model
 BUFFER_DISTANCES = [700] # only the 700 meter buffer is used in this script.  More buffer distances 
                          # are required for the script that calculates shield-modified road metrics
-ROADS = "H:/Noise/implementation/PDX10m.csv" # road network partitioned into 10m segments
+ROAD_STORE_FOLDER = "H:/Noise/implementation/roadStore/" # road attributes created by roadAttributeStore.py
+PRIMARY_ROAD_TYPES = [0] # roadType values for primary/secondary roads
 NEAR_FOLDER = "F:/Noise/near/" # contains pre-calculated values of distance from grid points to road segments
 N_CPUS = 2
+
+# road attributes and grid metadata, loaded once per worker process
+roadStore = None
+pointMeta = None
+
 ########## HELPER FUNCTIONS #############
 
+# load the road attribute store and grid metadata.  Called once when each worker process starts
+def initWorker():
+    global roadStore, pointMeta
+    roadStore = roadAttributeStore.loadRoadStore(ROAD_STORE_FOLDER)
+    pointMeta = gridPointStore.loadMeta(POINT_STORE_FOLDER)
+
 # normalize input data by distance to monitor 
 # INPUTS:
 #    roadMetrics (pandas dataframe) - contains road metrics to normalize, as well as distnace to monitor
@@ -81,14 +106,13 @@ def extractSingleBufferEstimate(bufferDist,roadData,roadType):
 # calculate road metrics for all buffer distances of interest
 # INPUTS:
 #    bufferDistances (array int) - contains a list of all buffer distances of interest
-#    nearDist (pandas dataframe) - distance from grid points to road segments
-#    roadMeasures (pandas dataframe) - variables for each road segment (e.g. speed, pavement type)
+#    stationMeasures (pandas dataframe) - distance from grid points to road segments, with road
+#                                         variables attached (see attachRoadAttributes)
 #    roadType (char) - single character indicator what road network subset the metrics will be calcualted
 #                      for (e.g. primary roads, residential roads, etc.)
 # OUTPUTS:
 #    bufferEst (pandas dataframe) - calculated road metrics for all buffer distances
-def extractBufferEstimatesForRoads(bufferDistances,nearDist,roadMeasures,roadType):
-    stationMeasures = nearDist.merge(roadMeasures,how='inner',left_on='NEAR_FID',right_on='OID_')
+def extractBufferEstimatesForRoads(bufferDistances,stationMeasures,roadType):
     bufferEst = extractSingleBufferEstimate(bufferDistances[0],stationMeasures,roadType)
     for buff in bufferDistances[1:]:
         bufferEst = bufferEst.merge(extractSingleBufferEstimate(buff,stationMeasures,roadType),how='outer',on='monitor_id')
@@ -98,74 +122,77 @@ def extractBufferEstimatesForRoads(bufferDistances,nearDist,roadMeasures,roadTyp
 # process dataset containing distances from grid points to road segments
 # needed to avoid issues when distance weighting by values less than 1
 # INPUTS:
-#    nearFile (pandas dataframe) - distance from grid points to road segments
+#    nearFile (str) - absolute filepath to near table of distances from grid points to road segments
 # OUTPUTS:
-#    nearFile with all distances less than 1 rounded up to 1 meter
+#    near table dataframe with all distances less than 5 rounded up to 5 meters
 def processNearData(nearFile):
-    nearData = ps.read_csv(nearFile)
-    nearData1 = nearData[nearData['NEAR_DIST']>=5]
-    nearData2 = nearData[nearData['NEAR_DIST']<5]
-    nearData2['NEAR_DIST'] = 5
-    return(ps.concat([nearData1,nearData2]))
+    nearData = nearTableCSR.nearTableToFrame(nearTableCSR.openNearTable(nearFile))
+    nearData['NEAR_DIST'] = np.maximum(nearData['NEAR_DIST'].values,5)
+    return(nearData)
 
-# load road network into memory and create road classification subsets
+# attach road variables to each pair in a near table, and keep pairs in a road classification subset
+# INPUTS:
+#    nearData (pandas dataframe) - distance from grid points to road segments
+#    roadTypes (int array) - roadType values to keep (e.g. PRIMARY_ROAD_TYPES)
+# OUTPUTS:
+#    near table dataframe with one column for each road variable, restricted to the road subset
+def attachRoadAttributes(nearData,roadTypes):
+    values, roadType = roadAttributeStore.gatherRoadAttributes(roadStore,nearData['NEAR_FID'].values)
+    for varIndex, name in enumerate(roadAttributeStore.ROAD_VARIABLES):
+        nearData[name] = values[:,varIndex]
+    return(nearData[np.isin(roadType,roadTypes)])
+
+# derive road metrics for a single batch of grid points from the batch's road near table
+# INPUTS:
+#    roadDistFile (str) - absolute filepath to the near table of distances from grid points to road segments
 # OUTPUTS:
-#    primaryRds (pandas dataframe) - subset of primary/secondary roads
-def preprocessRoadData():
-    roadData = ps.read_csv(ROADS)
-    primaryRds = roadData[roadData['roadType']==0]
-    return(primaryRds)
-
-# derive road metrics for a single grid point shapefile, containing 1000 grid points
-# save results to csv file
+#    dict mapping each metric in METRICS_TO_KEEP to an array with one value for each grid point in
+#    the batch.  Grid points without primary roads in the buffer are assigned 0
+def calcBatchMetrics(roadDistFile):
+
+    # prepare dataset containing distance from grid points to primary/secondary road segments
+    primaryRoads = attachRoadAttributes(processNearData(roadDistFile),PRIMARY_ROAD_TYPES)
+
+    # derive road metrics for primary/secondary roads
+    primaryRds = extractBufferEstimatesForRoads(BUFFER_DISTANCES,primaryRoads,'p')
+
+    # select only the variables used in the land use regression model
+    nPoints = nearTableCSR.readHeader(roadDistFile)[0]
+    metrics = {}
+    for metricName in METRICS_TO_KEEP:
+        metrics[metricName] = np.zeros(nPoints)
+        metrics[metricName][primaryRds['monitor_id'].values] = primaryRds[metricName].values
+    return(metrics)
+
+# derive road metrics for a single batch of grid points, containing 1000 grid points
+# save results to the feature store
 # INPUTS:
-#    sig (str) - unique identifier indicating which shapefile to process
-#    primaryRoads (pandas dataframe) - dataset containing information about primary/secondary roads
-#                                      (e.g. speed, pavement type)
+#    sig (str) - unique identifier indicating which batch to process
 def processSingleSig(sig):
-    outputFile = OUTPUT_FOLDER + str(sig) + ".csv"
-    
-    # if the shapefile has already been processed, return early to avoid redundant processing
-    if os.path.exists(outputFile):
+
+    # if the batch has already been processed, return early to avoid redundant processing
+    startId, endId = gridPointStore.batchSigToRange(sig,pointMeta['batchSize'])
+    if featureStore.isFeatureBatchComplete(FEATURE_STORE_FOLDER,METRICS_TO_KEEP,startId,endId):
         return
     
-    roadDistFile = NEAR_FOLDER + str(sig) + ".csv"
+    roadDistFile = NEAR_FOLDER + str(sig) + nearTableCSR.FILE_EXTENSION
 
-    # verify road distances have alraedy been preprocessed in a previous script before continuing
-    if not(os.path.exists(roadDistFile)):
+    # verify road distances have alraedy been preprocessed in a previous script before continuing.
+    # near tables are only readable once they are complete
+    if not(nearTableCSR.isNearTableComplete(roadDistFile)):
         print("cannot create shielding buffers for sig %s: road distances not available" %(sig))
         return
 
-    # prepare dataset containing distance from grid points to road segments
-    nearData = processNearData(roadDistFile)
-    # near file may not yet be complete skip for now
-    if(999 not in nearData['IN_FID']):
-        return
-    
-    primaryRoads = preprocessRoadData()
-
-    # derive road metrics for primary/secondary roads
-    primaryRds = extractBufferEstimatesForRoads(BUFFER_DISTANCES,nearData,primaryRoads,'p')
-
-    # select only the variables used in the land use regression model and save to .csv
-    primaryRds = primaryRds[["pcca700mdp",'monitor_id']]
-    primaryRds.to_csv(outputFile,index=False)
-
-# generate a list of unique indicators for each grid shapefile that needs to be processed
-# OUTPUTS:
-#    list of unique indicators
-def generateFileSigs():
-    fileSigs = []
-    curNum = 0
-    while (curNum < 6428001):
-        fileSigs.append('b' + str(curNum))
-        curNum+=1000
-    return(fileSigs)
+    # derive road metrics and write them to the feature store
+    featureStore.writeFeatureBatch(FEATURE_STORE_FOLDER,calcBatchMetrics(roadDistFile),startId)
 
 
 ####################### MAIN FUNCTION ##################
 if __name__ == '__main__':
-    fileSigs = generateFileSigs()
+    # create feature store columns before workers write to them
+    pointStore = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    featureStore.createFeatureColumns(FEATURE_STORE_FOLDER,METRICS_TO_KEEP,pointStore['meta']['nPoints'])
+    fileSigs = gridPointStore.listBatchSigs(pointStore)
 
     # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload 
     # uniformly across cpus when the error is corrected and the script is restarted
@@ -174,7 +201,7 @@ if __name__ == '__main__':
     # create a pool of workers, one worker for each free CPU.  I wouldn't recommend going above the CPU
     # count via hyperthreading, arcpy performance doesn't seem to work well when worker count goes above
     # physical core count
-    pool = Pool(processes=N_CPUS)
+    pool = Pool(processes=N_CPUS,initializer=initWorker)
     res = pool.map_async(processSingleSig,fileSigs)
     res.get()
         
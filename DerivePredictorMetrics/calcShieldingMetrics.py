@@ -1,119 +1,119 @@
-import pandas as ps
+import numpy as np
 import os
+import sys
+import random
 from multiprocessing import Pool
 
-BUFFER_DISTS = [10,20,50,250,450,1200,1400,2000]
-METRICS_TO_KEEP = ['shpche800mup','ushpcca50mup','ushpche1200sup','ushpcme1400qdp',
-                   'ushemme1200mup','ushsped250qur','ushpcca10mut','ushsped450sut',
-                   'ushpcca2000mdt','ushvefr20mua']
-ROADS = "D:/Noise/Roads/PDX10m.csv"
+# near tables are written by the preprocessing stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PreprocessPredictionDatasets'))
+import nearTableCSR
+import bufferAggregation
+import quantileEngine
+import metricPlanner
+import roadAttributeStore
+import featureStore
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+# model variables are read from the regression model specs of the prediction stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PredictLEQAndDNL'))
+import predictionEngine
+
+SHIELDING_PREFIXES = ['sh','ush'] # only shield-modified road metrics used by the model specs are calculated
+ROAD_STORE_FOLDER = "D:/Noise/Roads/roadStore/" # road attributes created by roadAttributeStore.py
 NEAR_FOLDER = "F:/Noise/near/"
 SHIELDING_FOLDER = "G:/Noise/isShielded/"
-OUTPUT_FOLDER = "G:/Noise/shielding/buffers/"
-
-
-def normalizeByDistance(roadMetrics):
-    dist = roadMetrics['NEAR_DIST']
-    roadMetrics['speed'] = roadMetrics['speed']/dist
-    roadMetrics['ADTVolume'] = roadMetrics['ADTVolume']/dist
-    roadMetrics['PctCars'] = roadMetrics['PctCars']/dist
-    roadMetrics['PctHeavyTr'] = roadMetrics['PctHeavyTr']/dist
-    roadMetrics['PctMedTruc'] = roadMetrics['PctMedTruc']/dist
-    roadMetrics['emissionHT'] = roadMetrics['emissionHT']/dist
-    return(roadMetrics)
-
-
-def standardizeVarNomenclature(data,bufferDist,metricChar,weightChar,roadType,isShielded):
-    dataSubset = data[['IN_FID','speed','ADTVolume','PctCars','PctHeavyTr',
-                       'PctMedTruc','emissionHT']]
-    
-    varNames = ['monitor_id']
-    preprefix = 'sh'
-    if(isShielded==False):
-        preprefix = 'ush'
-    for prefix in [
-        'sped','vefr','pcca','pche','pcme','emhe']:
-        varNames.append(preprefix + prefix + str(bufferDist) + metricChar + weightChar + roadType)
-    dataSubset.columns = varNames
-    return(dataSubset)
-
-
-
-def extractSingleBufferEstimate(bufferDist,roadMetrics,roadType,shielding,isShielded):
-    filteredData = roadMetrics[roadMetrics['NEAR_DIST']<=bufferDist]
-    if(isShielded):
-        filteredData = filteredData.merge(shielding,how='inner',left_on=['IN_FID','NEAR_FID'],right_on=['monitor','FID_PDX10m'])
-    else:
-        filteredData = filteredData.merge(shielding,how='left',left_on=['IN_FID','NEAR_FID'],right_on=['monitor','FID_PDX10m'])
-        filteredData = filteredData[filteredData['isShielded'].isnull()]
-    meanData = filteredData.groupby('IN_FID').mean()
-    sumData = filteredData.groupby('IN_FID').sum()
-    qData = filteredData.groupby('IN_FID').quantile([0.90])
-    meanNorm = normalizeByDistance(filteredData).groupby('IN_FID').mean()
-    #sumNorm = normalizeByDistance(filteredData).groupby('IN_FID').sum()
-    qNorm = normalizeByDistance(filteredData).groupby('IN_FID').quantile([0.90])
-    meanData = meanData.reset_index()
-    sumData = sumData.reset_index()
-    qData = qData.reset_index()
-    meanNorm = meanNorm.reset_index()
-    #sumNorm = sumNorm.reset_index()
-    qNorm = qNorm.reset_index()
-    combData = standardizeVarNomenclature(meanData,bufferDist,'m','u',roadType,isShielded)
-    combData = combData.merge(standardizeVarNomenclature(meanNorm,bufferDist,'m','d',roadType,isShielded), how = 'inner',on='monitor_id')
-    combData = combData.merge(standardizeVarNomenclature(sumData,bufferDist,'s','u',roadType,isShielded), how = 'inner',on='monitor_id')
-    #combData = combData.merge(standardizeVarNomenclature(sumNorm,bufferDist,'s','d',roadType,isShielded), how = 'inner',on='monitor_id')
-    combData = combData.merge(standardizeVarNomenclature(qData,bufferDist,'q','u',roadType,isShielded), how = 'inner',on='monitor_id')
-    combData = combData.merge(standardizeVarNomenclature(qNorm,bufferDist,'q','d',roadType,isShielded), how = 'inner',on='monitor_id')
-    return(combData)
-
-
-def extractBufferEstimatesForRoads(bufferDistances,nearDist,roadMeasures,roadType,shielded,isShielded):
-    stationMeasures = nearDist.merge(roadMeasures,how='inner',left_on='NEAR_FID',right_on='OID_')
-    bufferEst = extractSingleBufferEstimate(bufferDistances[0],stationMeasures,roadType,shielded,isShielded)
-    for buff in bufferDistances[1:]:
-        bufferEst = bufferEst.merge(extractSingleBufferEstimate(buff,stationMeasures,roadType,shielded,isShielded),how='outer',on='monitor_id')
-    bufferEst = bufferEst.fillna(0)
-    return(bufferEst)
+POINT_STORE_FOLDER = "H:/Noise/implementation/pointStore/"
+FEATURE_STORE_FOLDER = "H:/Noise/implementation/featureStore/" # metrics are written to one column per metric
+QUANTILE_SKETCH_RADIUS = None # quantiles for buffers at least this large are approximated with a sketch.  None for
+                              # exact quantiles in every buffer.  Only set once validateSketchQuantiles.py shows the
+                              # sketch agrees with exact quantiles for every quantile metric the model specs use
+
+# road attributes, grid metadata and the metric plan, loaded once per worker process
+roadStore = None
+pointMeta = None
+plan = None
+
+
+def extractQuantileEstimates(bufferDistances,neighbours,pairMask,columns,sketchRadius=QUANTILE_SKETCH_RADIUS):
+    pairIndex = np.flatnonzero(pairMask)
+    dist = neighbours['dist'][pairIndex]
+    inFid = neighbours['IN_FID'][pairIndex]
+
+    # one column for each (variable, weighting) pair requested.  Distance normalized quantiles are
+    # divided by distance twice, as in the csv version of this script (normalizeByDistance updated
+    # the pairs in place for the distance normalized mean, then again for the quantile).  The
+    # regression models were fitted on these values, so the double normalization is kept
+    values = np.empty((len(pairIndex),len(columns)))
+    for colIndex, (varIndex, weightChar) in enumerate(columns):
+        values[:,colIndex] = neighbours['values'][pairIndex,varIndex]
+        if(weightChar == 'd'):
+            values[:,colIndex] /= dist**2
+
+    # buffers smaller than the sketch radius use exact quantiles.  Large buffers contain thousands of
+    # road segments per grid point and can use the quantile sketch
+    exactRadii = [radius for radius in bufferDistances if sketchRadius is None or radius < sketchRadius]
+    sketchRadii = [radius for radius in bufferDistances if not(sketchRadius is None or radius < sketchRadius)]
+    quantiles = np.concatenate([
+        quantileEngine.calcExactQuantiles(inFid,dist,values,neighbours['nPoints'],exactRadii),
+        quantileEngine.calcSketchQuantiles(inFid,dist,values,neighbours['nPoints'],sketchRadii)
+    ],axis=1)
+    return(quantiles)
+
+
+def extractRequestedMetrics(requests,neighbours,pairMask):
+    metrics = {}
+
+    # means and sums for every requested buffer come from one pass over cumulative sums
+    cumRequests = [request for request in requests if request['statistic'] != 'q']
+    if(len(cumRequests) > 0):
+        radii = metricPlanner.listRadii(cumRequests)
+        stats = bufferAggregation.calcCumulativeStats(neighbours,pairMask,radii)
+        for request in cumRequests:
+            statIndex = bufferAggregation.CUMULATIVE_STATS.index((request['statistic'],request['weighting']))
+            metrics[request['name']] = stats[:,radii.index(request['radius']),statIndex,request['variable']]
+
+    # quantiles are only calculated for the requested variables.  Grid points without roads are assigned 0
+    qRequests = [request for request in requests if request['statistic'] == 'q']
+    if(len(qRequests) > 0):
+        radii = metricPlanner.listRadii(qRequests)
+        columns = sorted({(request['variable'],request['weighting']) for request in qRequests})
+        quantiles = np.nan_to_num(extractQuantileEstimates(radii,neighbours,pairMask,columns))
+        for request in qRequests:
+            colIndex = columns.index((request['variable'],request['weighting']))
+            metrics[request['name']] = quantiles[:,radii.index(request['radius']),colIndex]
+    return(metrics)
+
+
+def selectPairs(neighbours,roadType,shielded,prefix):
+    pairMask = bufferAggregation.selectRoadType(neighbours,roadType)
+    if(prefix == 'sh'):
+        pairMask &= shielded
+    elif(prefix == 'ush'):
+        pairMask &= ~shielded
+    return(pairMask)
 
 
 def loadIsShieldedForSig(sig):
-    dfArr = []
-    folderPath = SHIELDING_FOLDER + sig + "/"
-    filesToMerge = os.listdir(folderPath)
-    for file in filesToMerge:
-        dfArr.append(ps.read_csv(folderPath + file))
-    combDF = ps.concat(dfArr)
-    shieldedData = combDF[combDF['isShielded']==1]
-    return(shieldedData)
+    return(np.load(SHIELDING_FOLDER + sig + ".npy").astype(bool))
 
 def checkIsShieldingComplete(sig):
-    folderPath = SHIELDING_FOLDER + sig + "/"
-    filesToMerge = os.listdir(folderPath)
-    if(len(filesToMerge)==1000):
-        return(True)
-    return(False)
-
-def processNearData(nearFile):
-    nearData = ps.read_csv(nearFile)
-    nearData1 = nearData[nearData['NEAR_DIST']>=1]
-    nearData2 = nearData[nearData['NEAR_DIST']<1]
-    nearData2['NEAR_DIST'] = 1
-    return(ps.concat([nearData1,nearData2]))
-
-def preprocessRoadData():
-    roadData = ps.read_csv(ROADS)
-    primaryRds = roadData[roadData['roadType']==0]
-    tertRds = roadData[roadData['roadType']==1]
-    resRds = roadData[roadData['roadType']==2]
-    allRds = roadData[roadData['roadType']<4]
-    return([primaryRds,tertRds,resRds,allRds])
+    return(os.path.exists(SHIELDING_FOLDER + sig + ".npy"))
+
+def initWorker(metricPlan):
+    global roadStore, pointMeta, plan
+    roadStore = roadAttributeStore.loadRoadStore(ROAD_STORE_FOLDER)
+    pointMeta = gridPointStore.loadMeta(POINT_STORE_FOLDER)
+    plan = metricPlan
 
 
 def checkForFiles(sig):
 
     # check if distances to road have been calculated yet.  Skip this batch of grid points if they haven't
-    roadDistFile = NEAR_FOLDER + str(sig) + ".csv"
-    if not(os.path.exists(roadDistFile)):
+    roadDistFile = NEAR_FOLDER + str(sig) + nearTableCSR.FILE_EXTENSION
+    if not(nearTableCSR.isNearTableComplete(roadDistFile)):
         print("cannot create shielding buffers for sig %s: road distances not available" %(sig))
         return False
     
@@ -126,64 +126,52 @@ def checkForFiles(sig):
 
 
 def processSingleSig(sig):
-    
+
+    # if metrics have already been calculated for this batch, return early to avoid redundant processing
+    startId, endId = gridPointStore.batchSigToRange(sig,pointMeta['batchSize'])
+    if featureStore.isFeatureBatchComplete(FEATURE_STORE_FOLDER,metricPlanner.listMetricNames(plan),startId,endId):
+        print("%s has already been processed" %(sig))
+        return
+
     # preliminary check if scripts preprocessing data are finished for this batch of grid points
     # skip this batch is preprocessing is not yet complete
     preprocessingComplete = checkForFiles(sig)
     if(preprocessingComplete==False):
         return
     
-    # load distance from gird points to nearby roads
-    roadDistFile = NEAR_FOLDER + str(sig) + ".csv"
-    nearData = processNearData(roadDistFile)
+    # load distance from gird points to nearby roads, and attach road variables to each pair.
+    # distances less than 1m are rounded up to avoid dividing by small distances
+    roadDistFile = NEAR_FOLDER + str(sig) + nearTableCSR.FILE_EXTENSION
+    nearData = bufferAggregation.loadNeighbours(roadDistFile,roadStore,1)
 
     # load shielding filters
     shieldedData = loadIsShieldedForSig(sig)
 
-    # load road network. Look into if this data could be trimmed before hand in future updates
-    primaryRoads,tertiaryRoads,resRoads,allRoads = preprocessRoadData()
-
-    # extract buffer etimates for unshielded residential roads
-    resRdsUnshielded = extractBufferEstimatesForRoads(BUFFER_DISTS,nearData,resRoads,'r',shieldedData,False)
-
-    # extract buffer estimates for unshielded primary roads
-    primaryUnshielded = extractBufferEstimatesForRoads(BUFFER_DISTS,nearData,primaryRoads,'p',shieldedData,False)
-
-    # extract buffer estimates for shielded primary roads
-    primaryShielded = extractBufferEstimatesForRoads([800],nearData,primaryRoads,'p',shieldedData,True)
-
-    # extract buffer estimates for unshielded tertiary roads 
-    tertUnshielded = extractBufferEstimatesForRoads(BUFFER_DISTS,nearData,tertiaryRoads,'t',shieldedData,False)
+    # calculate the requested metrics for each combination of shielding and road type.  Metrics that
+    # share a combination are calculated from the same subset of pairs
+    metrics = {}
+    for (prefix, roadType), requests in plan.items():
+        pairMask = selectPairs(nearData,roadType,shieldedData,prefix)
+        metrics.update(extractRequestedMetrics(requests,nearData,pairMask))
 
-    # extract buffer estimates for unshielded all roads
-    allUnshielded = extractBufferEstimatesForRoads(BUFFER_DISTS,nearData,allRoads,'a',shieldedData,False)
-
-    # merge buffer estimates into single dataframe and save to csv
-    mergedBuffers = resRdsUnshielded.merge(primaryUnshielded,how='outer',on='monitor_id')
-    mergedBuffers = mergedBuffers.merge(primaryShielded,how='outer',on='monitor_id')
-    mergedBuffers = mergedBuffers.merge(resRdsUnshielded,how='outer',on='monitor_id')
-    mergedBuffers = mergedBuffers.merge(tertUnshielded,how='outer',on='monitor_id')
-    mergedBuffers = mergedBuffers.merge(allUnshielded,how='outer',on='monitor_id')
-    mergedBuffers = mergedBuffers[METRICS_TO_KEEP]
-    mergedBuffers.to_csv(OUTPUT_FOLDER + str(sig) + ".csv",index=False)
-
-# given an array of filenames, find only files with a 'shp' extension
-# INPUTS:
-#    filesToProcess (str array) - list of files to filter
-# OUTPUTS:
-#    list of files with an 'shp' extension
-def processFiles(filesToProcess):
-    screenedFiles = []
-    for file in filesToProcess:
-        if file[-3:] == 'shp':
-            screenedFiles.append(file)
-    return(screenedFiles)
+    # write metrics into the feature store rows for this batch
+    featureStore.writeFeatureBatch(FEATURE_STORE_FOLDER,metrics,startId)
 
 
 ####################### MAIN FUNCTION ##################
 if __name__ == '__main__':
-    
-    fileSigs = processFiles(os.listdir())
-    pool = Pool(processes=2)
+
+    # plan the shielding metrics used by the model specs, and create feature store columns for
+    # every metric before workers write to them
+    modelVariables = predictionEngine.compileModels(predictionEngine.loadModelSpecs())['variables']
+    plan = metricPlanner.planMetrics(metricPlanner.listModelMetrics(SHIELDING_PREFIXES,modelVariables))
+    pointStore = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    featureStore.createFeatureColumns(FEATURE_STORE_FOLDER,metricPlanner.listMetricNames(plan),pointStore['meta']['nPoints'])
+
+    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload
+    # uniformly across cpus when the error is corrected and the script is restarted
+    fileSigs = gridPointStore.listBatchSigs(pointStore)
+    random.shuffle(fileSigs)
+    pool = Pool(processes=2,initializer=initWorker,initargs=(plan,))
     res = pool.map_async(processSingleSig,fileSigs)
     res.get()
@@ -0,0 +1,288 @@
+# convolutionMetrics.py
+# Summary: calculate unshielded buffer metrics for every grid point in the city by convolution, without
+#          point to segment near tables.  Grid points lie on a regular grid, so counting features in a
+#          buffer (e.g. sl20cuo) is a convolution of rasterized feature counts with a disk kernel, and
+#          inverse distance weighted road means (e.g. pcca700mdp) are a convolution of rasterized road
+#          values with a 1/r disk kernel, divided by the number of road segments in the buffer.  Line
+#          features are rasterized along their length: each feature is sampled every half grid cell, and
+#          each sample carries the feature's value in proportion to the length it covers.  Metrics are
+#          written to the feature store under the same names as calcMiscMetrics.py and calcRdMetrics.py,
+#          so each metric is only written once it agrees with the near table path for a random sample
+#          of batches (see validateConvolutionMetrics.py for agreement on a synthetic road network)
+
+# import libraries
+import os
+import sys
+import numpy as np
+import shapely
+import featureStore
+import focalStatistics
+import metricPlanner
+import bufferAggregation
+import roadAttributeStore
+import calcMiscMetrics
+import calcRdMetrics
+
+# near tables are written by the preprocessing stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PreprocessPredictionDatasets'))
+import nearTableCSR
+import nearTableEngine
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+# define global constants
+POINT_STORE_FOLDER = "H:/Noise/implementation/pointStore/"
+FEATURE_STORE_FOLDER = "H:/Noise/implementation/featureStore/" # metrics are written to one column per metric
+ROADS = "H:/Noise/implementation/PDX10m.shp" # road network partitioned into 10m segments
+ROAD_STORE_FOLDER = "H:/Noise/implementation/roadStore/" # road attributes created by roadAttributeStore.py
+MISC_SOURCES = { # misc predictor layers, keyed by the abbreviations in calcMiscMetrics.ABBREV
+    'er':"H:/Noise/buffers/int/Portland_Emergency_Transportation_Routes10m.shp",
+    'bi':"H:/Noise/buffers/int/Recommended_Bicycle_Routes10m.shp",
+    'tm':"H:/Noise/buffers/int/tm_routes10m.shp",
+    'sl':"H:/Noise/LUR/PredictorData/Street_Lights/Street_Lights.shp"
+}
+ROAD_METRICS = calcRdMetrics.METRICS_TO_KEEP # unshielded road metrics used in the land use regression model
+MIN_DIST = 5 # distances less than 5 meters are rounded up, matching the near table path
+SAMPLES_PER_CELL = 2 # number of samples per grid cell along line features
+MIN_COUNT = 1e-6 # road segment counts below this are FFT round off, and grid points are treated as having no roads
+N_CHECK_BATCHES = 20 # number of randomly sampled batches compared against near table metrics
+AGREEMENT_TOLERANCE = 0.02 # relative difference under which a grid point's metrics are considered equal.  Set
+                           # from the discretization error measured by validateConvolutionMetrics.py (0.013
+                           # for pcca700mdp at the 99th percentile of grid points)
+MIN_AGREEMENT = 0.99 # fraction of compared grid points that must agree before a metric is written
+RANDOM_SEED = 1 # seed for sampling batches, so agreement checks are reproducible
+
+########## HELPER FUNCTIONS #############
+
+# calculate the ground distance (meters) between neighbouring grid points.  Buffer distances are in
+# meters, but the grid crs (e.g. EPSG:3857) may not be, so grid spacing is measured at the grid center
+# in the crs near tables are calculated in
+# INPUTS:
+#    meta (dict) - grid metadata from the point store
+# OUTPUTS:
+#    float distance between neighbouring grid points, in meters
+def calcCellSize(meta):
+    centerX = meta['minX'] + meta['nCols']*meta['resolution']/2
+    centerY = meta['minY'] + meta['nRows']*meta['resolution']/2
+    x, y = nearTableEngine.projectPoints([centerX,centerX + meta['resolution'],centerX],
+                                         [centerY,centerY,centerY + meta['resolution']],meta['crs'])
+    colSpacing = np.hypot(x[1] - x[0],y[1] - y[0])
+    rowSpacing = np.hypot(x[2] - x[0],y[2] - y[0])
+    return((colSpacing + rowSpacing)/2)
+
+# load a feature layer and sample points along each feature.  Line features are sampled at the
+# centers of equal length pieces no longer than sampleDist, and each sample is weighted by the fraction
+# of the feature's length it covers.  Other features (e.g. street lights) are a single sample at their
+# centroid with weight 1, so the weights of every feature sum to 1
+# INPUTS:
+#    shapefile (str) - absolute filepath to the feature layer
+#    meta (dict) - grid metadata from the point store
+#    sampleDist (float) - maximum distance between samples, in the grid crs units
+# OUTPUTS:
+#    ids (int array) - feature ids (FID), matching NEAR_FID in near tables
+#    sampleFeature (int array) - position in ids of the feature each sample belongs to
+#    x (float array), y (float array) - location of each sample, in the grid crs
+#    weights (float array) - fraction of the feature covered by each sample
+def loadFeatureSamples(shapefile,meta,sampleDist):
+    layer = nearTableEngine.loadNearLayer(shapefile,crs=meta['crs'])
+    geometry = layer['geometry']
+    isLine = np.isin(shapely.get_type_id(geometry),[shapely.GeometryType.LINESTRING,shapely.GeometryType.MULTILINESTRING])
+    nSamples = np.ones(len(geometry),dtype=np.int64)
+    nSamples[isLine] = np.maximum(np.ceil(shapely.length(geometry[isLine])/sampleDist),1)
+    sampleFeature = np.repeat(np.arange(len(geometry)),nSamples)
+    sampleRank = np.arange(len(sampleFeature)) - np.repeat(np.cumsum(nSamples) - nSamples,nSamples)
+    points = np.empty(len(sampleFeature),dtype=object)
+    isLineSample = isLine[sampleFeature]
+    points[isLineSample] = shapely.line_interpolate_point(geometry[sampleFeature[isLineSample]],
+                                                          (sampleRank[isLineSample] + 0.5)/nSamples[sampleFeature[isLineSample]],normalized=True)
+    points[~isLineSample] = shapely.centroid(geometry[sampleFeature[~isLineSample]])
+    return(layer['ids'],sampleFeature,shapely.get_x(points),shapely.get_y(points),1/nSamples[sampleFeature])
+
+# sum feature values in each grid cell.  The raster covers the grid extent plus a halo on every side,
+# so features just outside the grid still contribute to grid points near the edge
+# INPUTS:
+#    x (float array), y (float array) - feature coordinates, in the grid crs
+#    weights (float array) - value added to the feature's cell.  NaN values are skipped
+#    meta (dict) - grid metadata from the point store
+#    halo (int) - number of cells added to each side of the grid extent
+# OUTPUTS:
+#    float32 array ((nRows + 2*halo) x (nCols + 2*halo)), row 0 at the southern edge like grid rows
+def rasterizeFeatures(x,y,weights,meta,halo):
+    nRows, nCols = meta['nRows'] + 2*halo, meta['nCols'] + 2*halo
+    row = np.rint((np.asarray(y) - meta['minY'])/meta['resolution']).astype(np.int64) + halo
+    col = np.rint((np.asarray(x) - meta['minX'])/meta['resolution']).astype(np.int64) + halo
+    keep = (row >= 0) & (row < nRows) & (col >= 0) & (col < nCols) & ~np.isnan(weights)
+    cellSums = np.bincount(row[keep]*nCols + col[keep],weights=weights[keep],minlength=nRows*nCols)
+    return(cellSums.reshape(nRows,nCols).astype(np.float32))
+
+# create a buffer kernel, either a disk or a disk weighted by inverse distance to the center pixel
+# INPUTS:
+#    radius (float) - buffer distance, in meters
+#    cellSize (float) - distance between neighbouring grid points, in meters
+#    halfWidth (int) - number of pixels from the kernel center to its edge
+#    weightChar (char) - 'u' for unweighted, 'd' for normalized by distance
+# OUTPUTS:
+#    float64 kernel (2*halfWidth + 1 x 2*halfWidth + 1)
+def createBufferKernel(radius,cellSize,halfWidth,weightChar):
+    kernel = focalStatistics.createDiskKernel(radius,cellSize,halfWidth)
+    if(weightChar == 'd'):
+        offsets = np.arange(-halfWidth,halfWidth + 1)*cellSize
+        dists = np.sqrt(offsets[:,None]**2 + offsets[None,:]**2)
+        kernel = kernel/np.maximum(dists,MIN_DIST)
+    return(kernel)
+
+# calculate misc metrics (feature counts within a buffer) for every grid point
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+# OUTPUTS:
+#    dict mapping each misc metric name (see calcMiscMetrics.listMetricNames) to an array with one
+#    value for each grid point
+def calcMiscConvolution(store):
+    meta = store['meta']
+    cellSize = calcCellSize(meta)
+    metrics = {}
+    for index, abbrev in enumerate(calcMiscMetrics.ABBREV):
+        bufferDist = calcMiscMetrics.BUFFER_DISTANCES[index]
+        halfWidth = int(np.ceil(bufferDist/cellSize))
+        ids, sampleFeature, x, y, weights = loadFeatureSamples(MISC_SOURCES[abbrev],meta,meta['resolution']/SAMPLES_PER_CELL)
+        counts = rasterizeFeatures(x,y,weights*calcMiscMetrics.MULTIPLIER[index],meta,halfWidth)
+        kernel = createBufferKernel(bufferDist,cellSize,halfWidth,'u')
+        results = focalStatistics.convolveAtPoints([counts],[kernel],np.asarray(store['row']) + halfWidth,
+                                                   np.asarray(store['col']) + halfWidth)
+        metrics[calcMiscMetrics.createMetricName(abbrev,bufferDist)] = results[:,0,0]
+    return(metrics)
+
+# calculate unshielded road metrics (mean or sum, unweighted or normalized by distance) for every grid
+# point.  Quantile and shield-modified metrics cannot be written as convolutions, and are reported and skipped
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    metricNames (str array) - road metric names (e.g. pcca700mdp)
+# OUTPUTS:
+#    dict mapping each metric name to an array with one value for each grid point.  Grid points without
+#    road segments in the buffer are 0
+def calcRoadConvolution(store,metricNames):
+    meta = store['meta']
+    cellSize = calcCellSize(meta)
+    roadStore = roadAttributeStore.loadRoadStore(ROAD_STORE_FOLDER)
+    ids, sampleFeature, x, y, weights = loadFeatureSamples(ROADS,meta,meta['resolution']/SAMPLES_PER_CELL)
+    values, roadType = roadAttributeStore.gatherRoadAttributes(roadStore,ids)
+    values, roadType = values[sampleFeature], roadType[sampleFeature]
+    metrics = {}
+    for metricName in metricNames:
+        request = metricPlanner.parseMetricName(metricName)
+        if request is None or request['prefix'] != '' or request['statistic'] == 'q':
+            print("cannot calculate %s by convolution: only unshielded mean and sum road metrics are supported" %(metricName))
+            continue
+
+        # rasterize road values and road segment counts for the road classification.  Segments with
+        # missing values are excluded from both, matching means of the near table path
+        halfWidth = int(np.ceil(request['radius']/cellSize))
+        inRoadType = np.isin(roadType,bufferAggregation.ROAD_TYPES[request['roadType']])
+        roadValues = np.where(inRoadType,values[:,request['variable']],np.nan)
+        valueRaster = rasterizeFeatures(x,y,roadValues*weights,meta,halfWidth)
+        countRaster = rasterizeFeatures(x,y,np.where(np.isnan(roadValues),np.nan,weights),meta,halfWidth)
+        kernels = [createBufferKernel(request['radius'],cellSize,halfWidth,request['weighting']),
+                   createBufferKernel(request['radius'],cellSize,halfWidth,'u')]
+        results = focalStatistics.convolveAtPoints([valueRaster,countRaster],kernels,np.asarray(store['row']) + halfWidth,
+                                                   np.asarray(store['col']) + halfWidth)
+        sums = results[:,0,0]
+        if(request['statistic'] == 's'):
+            metrics[metricName] = sums
+            continue
+        counts = results[:,1,1]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            metrics[metricName] = np.where(counts > MIN_COUNT,sums/counts,0)
+    return(metrics)
+
+# compare convolution metrics against metrics calculated from near tables, for a random sample of
+# batches.  Differences are expected where features straddle the buffer edge, since near tables
+# measure distance to the nearest part of each feature and convolution uses samples along each feature
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    metrics (dict) - metrics returned by calcMiscConvolution and calcRoadConvolution
+#    nBatches (int) - number of batches to compare
+#    seed (int) - random number generator seed
+# OUTPUTS:
+#    dict mapping each compared metric name to the number of grid points compared, the fraction that
+#    agree within AGREEMENT_TOLERANCE, and the mean and max absolute difference
+def checkAgreement(store,metrics,nBatches,seed=RANDOM_SEED):
+    miscNames = [name for name in calcMiscMetrics.listMetricNames() if name in metrics]
+    roadNames = [name for name in calcRdMetrics.METRICS_TO_KEEP if name in metrics]
+    calcRdMetrics.initWorker()
+    fileSigs = gridPointStore.listBatchSigs(store)
+    fileSigs = [fileSigs[index] for index in np.random.default_rng(seed).permutation(len(fileSigs))]
+    convValues = {name:[] for name in miscNames + roadNames}
+    tableValues = {name:[] for name in miscNames + roadNames}
+    nCompared = 0
+    for fileSig in fileSigs:
+        if(nCompared >= nBatches):
+            break
+        # only batches with every near table are compared
+        roadDistFile = calcRdMetrics.NEAR_FOLDER + fileSig + nearTableCSR.FILE_EXTENSION
+        nearFiles = [calcMiscMetrics.NEAR_FOLDER + abbrev + "/" + fileSig + nearTableCSR.FILE_EXTENSION for abbrev in calcMiscMetrics.ABBREV]
+        if not(all(nearTableCSR.isNearTableComplete(nearFile) for nearFile in nearFiles + [roadDistFile])):
+            continue
+        tableMetrics = calcMiscMetrics.calcBatchMetrics(fileSig)
+        tableMetrics.update(calcRdMetrics.calcBatchMetrics(roadDistFile))
+        startId, endId = gridPointStore.batchSigToRange(fileSig,store['meta']['batchSize'])
+        for name in convValues:
+            convValues[name].append(metrics[name][startId:startId + len(tableMetrics[name])])
+            tableValues[name].append(tableMetrics[name])
+        nCompared += 1
+
+    # summarize differences for each metric
+    agreement = {}
+    for name in convValues:
+        if(nCompared == 0):
+            break
+        conv = np.concatenate(convValues[name])
+        table = np.concatenate(tableValues[name])
+        diff = np.abs(conv - table)
+        agreement[name] = {
+            'nPoints':len(diff),
+            'fracAgree':float(np.mean(diff <= AGREEMENT_TOLERANCE*np.maximum(np.abs(table),1))),
+            'meanDiff':float(diff.mean()),
+            'maxDiff':float(diff.max())
+        }
+        print("%s: %i grid points, %.4f agree, mean abs diff %.6f, max abs diff %.6f" %(
+            name,agreement[name]['nPoints'],agreement[name]['fracAgree'],agreement[name]['meanDiff'],agreement[name]['maxDiff']))
+    if(nCompared == 0):
+        print("cannot check agreement: no batches with complete near tables")
+    return(agreement)
+
+
+# select the convolution metrics that agree with near table metrics.  Metrics that are not selected
+# are reported
+# INPUTS:
+#    metrics (dict) - metrics returned by calcMiscConvolution and calcRoadConvolution
+#    agreement (dict) - agreement returned by checkAgreement
+# OUTPUTS:
+#    dict with the metrics that agree for at least MIN_AGREEMENT of compared grid points
+def selectAgreedMetrics(metrics,agreement):
+    agreedMetrics = {}
+    for metricName in metrics:
+        if metricName not in agreement:
+            print("%s was not written: no near table metrics to compare against" %(metricName))
+        elif(agreement[metricName]['fracAgree'] < MIN_AGREEMENT):
+            print("%s was not written: %.4f of grid points agree with the near table metric" %(
+                metricName,agreement[metricName]['fracAgree']))
+        else:
+            agreedMetrics[metricName] = metrics[metricName]
+    return(agreedMetrics)
+
+
+####################### MAIN FUNCTION ##################
+if __name__ == '__main__':
+    pointStore = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    convMetrics = calcMiscConvolution(pointStore)
+    convMetrics.update(calcRoadConvolution(pointStore,ROAD_METRICS))
+
+    # convolution metrics replace model inputs, so each metric is only written if it reproduces the
+    # near table metric for the sampled batches
+    agreedMetrics = selectAgreedMetrics(convMetrics,checkAgreement(pointStore,convMetrics,N_CHECK_BATCHES))
+    if(len(agreedMetrics) > 0):
+        featureStore.createFeatureColumns(FEATURE_STORE_FOLDER,list(agreedMetrics.keys()),pointStore['meta']['nPoints'])
+        featureStore.writeFeatureBatch(FEATURE_STORE_FOLDER,agreedMetrics,0)
+        print("calculated %s for %i grid points" %(', '.join(agreedMetrics.keys()),pointStore['meta']['nPoints']))
@@ -0,0 +1,110 @@
+# featureStore.py
+# Summary: A memory-mapped store of predictor variables.  Each predictor (e.g. ushsped250qur) is one
+#          float32 .npy column with one row for every grid point, aligned to the global point ids of
+#          the grid point store.  Metric stages write batches of rows into their own columns, and the
+#          prediction stage reads a dense feature matrix without joins.  Rows that have not been
+#          calculated yet are NaN, so a single predictor can be recalculated without touching the others
+
+# import libraries
+import os
+import numpy as np
+
+# define global constants
+FEATURE_DTYPE = np.float32
+
+########## HELPER FUNCTIONS #############
+
+# get the filepath of a predictor column
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the feature store
+#    name (str) - predictor name
+# OUTPUTS:
+#    absolute filepath to the column
+def getColumnPath(storeFolder,name):
+    return(os.path.join(storeFolder,name + '.npy'))
+
+# check whether a predictor column exists
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the feature store
+#    name (str) - predictor name
+# OUTPUTS:
+#    True if the column has been created
+def hasFeatureColumn(storeFolder,name):
+    return(os.path.exists(getColumnPath(storeFolder,name)))
+
+# create predictor columns that do not exist yet.  Every row starts as NaN (not yet calculated).
+# Must be called before worker processes write to the columns.  Existing columns must have one row
+# for every grid point, otherwise the column was created for a different point store
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the feature store
+#    names (str array) - predictor names
+#    nPoints (int) - number of grid points in the point store
+def createFeatureColumns(storeFolder,names,nPoints):
+    if not(os.path.exists(storeFolder)):
+        os.makedirs(storeFolder)
+    for name in names:
+        if hasFeatureColumn(storeFolder,name):
+            nRows = len(openFeatureColumn(storeFolder,name))
+            if(nRows != nPoints):
+                raise ValueError("feature column %s has %i rows but the point store has %i points" %(name,nRows,nPoints))
+            continue
+        columnPath = getColumnPath(storeFolder,name)
+
+        # columns are filled under a temporary name so a partially created column is never opened
+        column = np.lib.format.open_memmap(columnPath + '.tmp',mode='w+',dtype=FEATURE_DTYPE,shape=(nPoints,))
+        column[:] = np.nan
+        column.flush()
+        del column
+        os.replace(columnPath + '.tmp',columnPath)
+
+# open a predictor column
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the feature store
+#    name (str) - predictor name
+#    mode (str) - memory-map mode. 'r' for read only, 'r+' to write rows
+# OUTPUTS:
+#    memory-mapped float32 array with one value for each grid point
+def openFeatureColumn(storeFolder,name,mode='r'):
+    return(np.load(getColumnPath(storeFolder,name),mmap_mode=mode))
+
+# write predictor values for a batch of consecutive grid points.  Batches write disjoint rows, so
+# worker processes can write to the same column at once
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the feature store
+#    features (dict) - maps predictor names to arrays with one value for each grid point in the batch
+#    startId (int) - point id of the first grid point in the batch
+def writeFeatureBatch(storeFolder,features,startId):
+    for name, values in features.items():
+        column = openFeatureColumn(storeFolder,name,mode='r+')
+        column[startId:startId + len(values)] = values
+        column.flush()
+
+# check whether predictors have been calculated for every grid point in a range
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the feature store
+#    names (str array) - predictor names
+#    startId (int) - first point id in the range (inclusive)
+#    endId (int) - last point id in the range (exclusive)
+# OUTPUTS:
+#    True if every column exists and has no NaN rows in the range
+def isFeatureBatchComplete(storeFolder,names,startId,endId):
+    for name in names:
+        if not(hasFeatureColumn(storeFolder,name)):
+            return(False)
+        if np.isnan(openFeatureColumn(storeFolder,name)[startId:endId]).any():
+            return(False)
+    return(True)
+
+# read a dense feature matrix for a range of grid points
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the feature store
+#    names (str array) - predictor names, one matrix column for each
+#    startId (int) - first point id in the range (inclusive)
+#    endId (int) - last point id in the range (exclusive)
+# OUTPUTS:
+#    float32 array (points x names)
+def loadFeatureMatrix(storeFolder,names,startId,endId):
+    features = np.empty((endId - startId,len(names)),dtype=FEATURE_DTYPE)
+    for colIndex, name in enumerate(names):
+        features[:,colIndex] = openFeatureColumn(storeFolder,name)[startId:endId]
+    return(features)
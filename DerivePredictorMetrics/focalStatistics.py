@@ -0,0 +1,151 @@
+# focalStatistics.py
+# Summary: calculate circular buffer (focal) sums and means of a raster for any list of buffer
+#          distances, and sample them at grid points.  The raster is processed in square tiles with a
+#          halo as wide as the largest buffer.  Each tile is convolved with a disk kernel for every
+#          buffer distance using FFTs, and only grid points inside the tile are sampled, so focal
+#          rasters for the whole city are never held in memory.  The same tiled convolution is used
+#          with other kernels for rasterized features (see convolutionMetrics.py)
+
+# import libraries
+import numpy as np
+
+# define global constants
+TILE_SIZE = 1024 # number of raster rows and columns in the core of each tile, excluding the halo
+
+########## HELPER FUNCTIONS #############
+
+# find the raster pixel containing each point
+# INPUTS:
+#    geotransform (float array) - raster geotransform, in gdal coefficient order
+#    x (float array) - x coordinates of points, in the raster crs
+#    y (float array) - y coordinates of points, in the raster crs
+# OUTPUTS:
+#    row (int array), col (int array) - pixel indices of each point.  Points outside the raster have
+#    indices outside the raster shape
+def calcPixelIndex(geotransform,x,y):
+
+    # invert the geotransform: x = x0 + col*dxCol + row*dxRow, y = y0 + col*dyCol + row*dyRow
+    x0, dxCol, dxRow, y0, dyCol, dyRow = geotransform
+    det = dxCol*dyRow - dxRow*dyCol
+    xOffset = np.asarray(x) - x0
+    yOffset = np.asarray(y) - y0
+    col = np.floor((dyRow*xOffset - dxRow*yOffset)/det).astype(np.int64)
+    row = np.floor((dxCol*yOffset - dyCol*xOffset)/det).astype(np.int64)
+    return(row,col)
+
+# create a disk kernel.  Pixels are inside the disk if their center is within the buffer distance of
+# the center pixel
+# INPUTS:
+#    radius (float) - buffer distance, in crs units
+#    cellSize (float) - raster pixel width, in crs units
+#    halfWidth (int) - number of pixels from the kernel center to its edge.  Kernels for several
+#                      buffer distances share the same shape when given the same halfWidth
+# OUTPUTS:
+#    float64 array (2*halfWidth + 1 x 2*halfWidth + 1), 1 inside the disk and 0 outside
+def createDiskKernel(radius,cellSize,halfWidth):
+    offsets = np.arange(-halfWidth,halfWidth + 1)*cellSize
+    return((offsets[:,None]**2 + offsets[None,:]**2 <= radius**2).astype(np.float64))
+
+# find the smallest FFT length at least n whose only prime factors are 2, 3 and 5.  FFTs of these
+# lengths are much faster than FFTs of lengths with large prime factors
+# INPUTS:
+#    n (int) - minimum length
+# OUTPUTS:
+#    int FFT length
+def calcFastLength(n):
+    bestLength = 2**int(np.ceil(np.log2(n)))
+    power5 = 1
+    while power5 < bestLength:
+        power35 = power5
+        while power35 < bestLength:
+            length = power35*2**max(int(np.ceil(np.log2(n/power35))),0)
+            bestLength = min(bestLength,length)
+            power35 *= 3
+        power5 *= 5
+    return(bestLength)
+
+# calculate the FFT shape used for tiles.  The shape holds the full (linear) convolution of a tile
+# and its halo with the kernel.  Tiles are padded to this shape, so kernel FFTs are calculated once
+# and reused for every tile
+# INPUTS:
+#    tileSize (int) - number of rows and columns in the tile core
+#    halfWidth (int) - halo width, in pixels
+# OUTPUTS:
+#    tuple with the number of FFT rows and columns
+def calcFFTShape(tileSize,halfWidth):
+    fftLength = calcFastLength(tileSize + 4*halfWidth)
+    return((fftLength,fftLength))
+
+# convolve rasters with kernels and sample the results at points.  The rasters are processed in
+# tiles with a halo as wide as the kernels, and each tile is convolved with every kernel using FFTs.
+# Pixels beyond the raster edge are treated as 0
+# INPUTS:
+#    layers (float array list) - rasters to convolve (rows x cols), all with the same shape and without NaN
+#    kernels (float array list) - convolution kernels, all with the same odd square shape
+#    row (int array) - raster row of each point (see calcPixelIndex)
+#    col (int array) - raster column of each point
+#    tileSize (int) - number of raster rows and columns in the core of each tile
+# OUTPUTS:
+#    float64 array (points x layers x kernels) of convolved values.  Points outside the raster are NaN
+def convolveAtPoints(layers,kernels,row,col,tileSize=TILE_SIZE):
+    nRows, nCols = layers[0].shape
+    halfWidth = kernels[0].shape[0]//2
+    fftShape = calcFFTShape(tileSize,halfWidth)
+    kernelFFTs = [np.fft.rfft2(kernel,fftShape) for kernel in kernels]
+    results = np.full((len(row),len(layers),len(kernels)),np.nan)
+
+    # group points by tile.  Points outside the raster are not assigned to a tile
+    isInside = (row >= 0) & (row < nRows) & (col >= 0) & (col < nCols)
+    nTileCols = (nCols - 1)//tileSize + 1
+    tileKeys = np.where(isInside,(row//tileSize)*nTileCols + col//tileSize,-1)
+    order = np.argsort(tileKeys,kind='stable')
+    uniqueKeys, tileStarts = np.unique(tileKeys[order],return_index=True)
+    tileEnds = np.append(tileStarts[1:],len(order))
+    for tileKey, start, end in zip(uniqueKeys,tileStarts,tileEnds):
+        if(tileKey < 0):
+            continue
+        pointIndex = order[start:end]
+        rowStart = (tileKey//nTileCols)*tileSize - halfWidth
+        colStart = (tileKey%nTileCols)*tileSize - halfWidth
+        srcRows = slice(max(rowStart,0),min(rowStart + tileSize + 2*halfWidth,nRows))
+        srcCols = slice(max(colStart,0),min(colStart + tileSize + 2*halfWidth,nCols))
+
+        # the full convolution is offset by halfWidth, so window pixel (r, c) is at (r + halfWidth, c + halfWidth)
+        pointRow = row[pointIndex] - rowStart + halfWidth
+        pointCol = col[pointIndex] - colStart + halfWidth
+        for layerIndex, layer in enumerate(layers):
+
+            # read the tile and its halo
+            window = np.zeros((tileSize + 2*halfWidth,tileSize + 2*halfWidth))
+            window[srcRows.start - rowStart:srcRows.stop - rowStart,srcCols.start - colStart:srcCols.stop - colStart] = layer[srcRows,srcCols]
+            layerFFT = np.fft.rfft2(window,fftShape)
+            for kernelIndex, kernelFFT in enumerate(kernelFFTs):
+                results[pointIndex,layerIndex,kernelIndex] = np.fft.irfft2(layerFFT*kernelFFT,fftShape)[pointRow,pointCol]
+    return(results)
+
+# calculate focal sums and means of a raster at points, for every buffer distance.  Nodata pixels
+# are excluded from sums and means
+# INPUTS:
+#    values (float array) - raster pixel values (rows x cols), with nodata as NaN
+#    cellSize (float) - raster pixel width, in crs units
+#    radii (float array) - buffer distances, in crs units
+#    row (int array) - raster row of each point (see calcPixelIndex)
+#    col (int array) - raster column of each point
+#    tileSize (int) - number of raster rows and columns in the core of each tile
+# OUTPUTS:
+#    sums (float64 array) - focal sum for each point and buffer distance (points x radii)
+#    means (float64 array) - focal mean for each point and buffer distance (points x radii).  Points
+#                            outside the raster, and points without valid pixels in the buffer, are NaN
+def calcFocalStats(values,cellSize,radii,row,col,tileSize=TILE_SIZE):
+    halfWidth = int(np.ceil(max(radii)/cellSize))
+    kernels = [createDiskKernel(radius,cellSize,halfWidth) for radius in radii]
+
+    # nodata pixels are removed from sums by setting them to 0, and from counts by a validity layer
+    isValid = ~np.isnan(values)
+    layers = [np.where(isValid,values,0).astype(np.float32),isValid.astype(np.float32)]
+    results = convolveAtPoints(layers,kernels,row,col,tileSize)
+    sums = results[:,0,:]
+    counts = np.rint(results[:,1,:])
+    with np.errstate(divide='ignore',invalid='ignore'):
+        means = np.where(counts > 0,sums/counts,np.nan)
+    return(sums,means)
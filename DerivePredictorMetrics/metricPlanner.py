@@ -0,0 +1,89 @@
+# metricPlanner.py
+# Summary: parse road metric names used by the land use regression model (e.g. ushsped250qur) into
+#          the shielding, variable, buffer distance, statistic, weighting and road type they describe,
+#          and group them so metric scripts only calculate the metrics the model uses
+
+# import libraries
+import re
+import bufferAggregation
+
+# define global constants
+METRIC_PATTERN = re.compile(r'^(sh|ush|)([a-z]{4})(\d+)([msq])([ud])([ptra])$')
+VARIABLE_ALIASES = {'emme':'emhe'} # heavy truck emissions are named emme in the regression model
+
+########## HELPER FUNCTIONS #############
+
+# parse a road metric name that conforms to the designated nomenclature scheme
+# INPUTS:
+#    metricName (str) - metric name, e.g. ushsped250qur
+# OUTPUTS:
+#    metric request (dict) with the metric name, shielding prefix ('sh', 'ush' or '' for all roads),
+#    variable index (see bufferAggregation.ROAD_VARIABLES), buffer distance, statistic character
+#    ('m' mean, 's' sum or 'q' quantile), weighting character ('u' unweighted or 'd' normalized by
+#    distance), and road type code.  None if the name is not a road metric
+def parseMetricName(metricName):
+    match = METRIC_PATTERN.match(metricName)
+    if match is None:
+        return(None)
+    prefix, varCode, radius, statistic, weighting, roadType = match.groups()
+    varCode = VARIABLE_ALIASES.get(varCode,varCode)
+    if varCode not in bufferAggregation.VARIABLE_CODES:
+        return(None)
+    request = {
+        'name':metricName,
+        'prefix':prefix,
+        'variable':bufferAggregation.VARIABLE_CODES.index(varCode),
+        'radius':int(radius),
+        'statistic':statistic,
+        'weighting':weighting,
+        'roadType':roadType
+    }
+    return(request)
+
+# select the road metrics with the given shielding prefixes from the variables used by the
+# regression models (e.g. the variables of models/LEQ.json)
+# INPUTS:
+#    prefixes (str array) - shielding prefixes to include ('sh', 'ush' or '' for all roads)
+#    modelVariables (str array) - names of variables used by the regression models
+# OUTPUTS:
+#    list of unique metric names, in model variable order
+def listModelMetrics(prefixes,modelVariables):
+    metricNames = []
+    for variable in modelVariables:
+        request = parseMetricName(variable)
+        if request is not None and request['prefix'] in prefixes and variable not in metricNames:
+            metricNames.append(variable)
+    return(metricNames)
+
+# group metric requests by shielding prefix and road type.  All metrics in a group are calculated
+# from the same subset of near table pairs
+# INPUTS:
+#    metricNames (str array) - names of metrics to calculate
+# OUTPUTS:
+#    dict mapping (prefix, roadType) to a list of metric requests.  Names that are not road metrics
+#    are reported and skipped
+def planMetrics(metricNames):
+    plan = {}
+    for metricName in metricNames:
+        request = parseMetricName(metricName)
+        if request is None:
+            print("cannot plan metric %s: name is not a road metric" %(metricName))
+            continue
+        plan.setdefault((request['prefix'],request['roadType']),[]).append(request)
+    return(plan)
+
+# list the names of all metrics in a plan
+# INPUTS:
+#    plan (dict) - metric requests grouped by planMetrics
+# OUTPUTS:
+#    list of metric names
+def listMetricNames(plan):
+    return([request['name'] for requests in plan.values() for request in requests])
+
+# list the buffer distances needed by a group of metric requests
+# INPUTS:
+#    requests (dict array) - metric requests returned by parseMetricName
+# OUTPUTS:
+#    sorted list of unique buffer distances
+def listRadii(requests):
+    return(sorted({request['radius'] for request in requests}))
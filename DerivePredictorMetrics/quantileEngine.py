@@ -0,0 +1,192 @@
+# quantileEngine.py
+# Summary: calculate a quantile (e.g. 90th percentile) of road variables within each buffer distance,
+#          for every grid point in a batch.  Work is shared across buffer distances: the exact mode
+#          sorts each grid point's values once, and the sketch mode adds each road segment to a
+#          per point histogram once, as buffers widen
+
+# import libraries
+import numpy as np
+
+# define global constants
+QUANTILE = 0.90
+SKETCH_BINS = 256 # number of histogram bins used by the sketch mode
+SKETCH_SAMPLE_SIZE = 100000 # number of values sampled to set histogram bin edges
+LOOKUP_CELLS = 65536 # number of equal width cells used to assign values to histogram bins
+
+########## HELPER FUNCTIONS #############
+
+# find the smallest buffer each pair falls within.  A pair is within buffer k and every larger buffer
+# INPUTS:
+#    dist (float array) - distance for each pair
+#    radii (int array) - buffer distances, in increasing order
+# OUTPUTS:
+#    int array of buffer indices, len(radii) for pairs beyond the largest buffer
+def calcRadiusIndex(dist,radii):
+    return(np.searchsorted(np.asarray(radii,dtype=np.float64),dist,side='left'))
+
+# linearly interpolate between the two values closest to the quantile rank, matching pandas
+# INPUTS:
+#    counts (int array) - number of values for each grid point
+#    quantile (float) - quantile to calculate, between 0 and 1
+# OUTPUTS:
+#    lower (int array) - 0 based rank of the value below the quantile, for each grid point
+#    upper (int array) - 0 based rank of the value above the quantile, for each grid point
+#    frac (float array) - interpolation weight of the upper value, for each grid point
+def calcQuantileRanks(counts,quantile):
+    h = np.maximum(counts - 1,0)*quantile
+    lower = np.floor(h).astype(np.int64)
+    upper = np.minimum(lower + 1,np.maximum(counts - 1,0))
+    return(lower,upper,h - lower)
+
+# arrange pairs into one row for each grid point, so values can be sorted within each point at once.
+# Pairs must be grouped by grid point, as in near tables
+# INPUTS:
+#    inFid (int array) - grid point for each pair
+#    nPoints (int) - number of grid points in the batch
+# OUTPUTS:
+#    rowShape (tuple) - number of grid points and the largest number of pairs for any grid point
+#    pairCol (int array) - column of each pair within its grid point's row
+def calcPointRows(inFid,nPoints):
+    counts = np.bincount(inFid,minlength=nPoints)
+    offsets = np.cumsum(counts) - counts
+    pairCol = np.arange(len(inFid)) - offsets[inFid]
+    return((nPoints,max(np.max(counts,initial=0),1)),pairCol)
+
+# calculate quantiles exactly.  Values are sorted within each grid point once, and for each buffer
+# the values of pairs within the buffer are selected from each point's sorted row by rank
+# INPUTS:
+#    inFid (int array) - grid point for each pair.  Pairs must be grouped by grid point
+#    dist (float array) - distance for each pair
+#    values (float array) - variable values (pairs x variables).  Missing values are excluded
+#    nPoints (int) - number of grid points in the batch
+#    radii (int array) - buffer distances, in increasing order
+#    quantile (float) - quantile to calculate, between 0 and 1
+# OUTPUTS:
+#    float64 array (points x radii x variables).  Grid points without values in a buffer are NaN
+def calcExactQuantiles(inFid,dist,values,nPoints,radii,quantile=QUANTILE):
+    quantiles = np.full((nPoints,len(radii),values.shape[1]),np.nan)
+    if(len(radii) == 0):
+        return(quantiles)
+
+    # only pairs within the largest buffer are sorted
+    radiusIndex = calcRadiusIndex(dist,radii)
+    inBuffer = np.flatnonzero(radiusIndex < len(radii))
+    inFid, values, radiusIndex = inFid[inBuffer], values[inBuffer], radiusIndex[inBuffer]
+    rowShape, pairCol = calcPointRows(inFid,nPoints)
+    rowIndex = inFid.astype(np.int64)*rowShape[1] + pairCol
+    for varIndex in range(values.shape[1]):
+
+        # missing values and row padding are sorted to the end of each row and never included.  Padding
+        # with infinity rather than NaN keeps numpy's fast sorting path
+        isValid = ~np.isnan(values[:,varIndex])
+        rowValues = np.full(rowShape,np.inf)
+        rowValues.ravel()[rowIndex[isValid]] = values[isValid,varIndex]
+        rowRadius = np.full(rowShape,len(radii),dtype=np.int16)
+        rowRadius.ravel()[rowIndex[isValid]] = radiusIndex[isValid]
+        order = np.argsort(rowValues,axis=1)
+        rowValues = np.take_along_axis(rowValues,order,axis=1)
+        rowRadius = np.take_along_axis(rowRadius,order,axis=1)
+        for radiusPos in range(len(radii)):
+
+            # cumulative count of pairs within the buffer, in sorted order.  The k-th smallest value
+            # for a grid point is where the count first exceeds k
+            cumIncluded = np.cumsum(rowRadius <= radiusPos,axis=1,dtype=np.int32)
+            counts = cumIncluded[:,-1]
+            lower, upper, frac = calcQuantileRanks(counts,quantile)
+            hasValues = np.flatnonzero(counts > 0)
+            lowerValue = rowValues[hasValues,np.argmax(cumIncluded[hasValues] > lower[hasValues,None],axis=1)]
+            upperValue = rowValues[hasValues,np.argmax(cumIncluded[hasValues] > upper[hasValues,None],axis=1)]
+            quantiles[hasValues,radiusPos,varIndex] = lowerValue + (upperValue - lowerValue)*frac[hasValues]
+    return(quantiles)
+
+# assign values to histogram bins.  Values are first placed in a fine grid of equal width cells, and
+# each cell is looked up to the bin containing the cell's lower edge.  Only values in cells that span
+# several bin edges are located by binary search, which is much faster than searching the edges for
+# every value
+# INPUTS:
+#    values (float array) - values to assign.  Values must be between the first and last edge
+#    edges (float array) - bin edges, in increasing order
+#    nCells (int) - number of equal width cells
+# OUTPUTS:
+#    int array of bin indices, between 0 and len(edges) - 2
+def calcBinIndex(values,edges,nCells=LOOKUP_CELLS):
+    lastBin = max(len(edges) - 2,0)
+    scale = nCells/max(edges[-1] - edges[0],np.finfo(np.float64).tiny)
+    cellIndex = np.clip(((values - edges[0])*scale).astype(np.int64),0,nCells - 1)
+    cellBins = np.clip(np.searchsorted(edges,edges[0] + np.arange(nCells + 1)/scale,side='right') - 1,0,lastBin)
+    binIndex = cellBins[cellIndex]
+
+    # cells containing one edge need a single comparison.  Cells containing several edges are searched
+    binIndex += values >= edges[np.minimum(binIndex + 1,len(edges) - 1)]
+    binIndex = np.minimum(binIndex,lastBin)
+    isSplit = np.flatnonzero(cellBins[cellIndex + 1] - cellBins[cellIndex] > 1)
+    binIndex[isSplit] = np.clip(np.searchsorted(edges,values[isSplit],side='right') - 1,0,lastBin)
+    return(binIndex)
+
+# approximate quantiles with a histogram for each grid point.  Bin edges are quantiles of all values
+# in the batch, so bins are narrow where values are common.  Pairs are added to the histograms one
+# buffer shell at a time, so each pair is only counted once across all buffers.  The estimate is
+# interpolated within the bin containing the quantile rank, so its rank among a grid point's values
+# differs from the quantile rank by at most the number of the point's values in that bin (about one
+# rank for most points, as bins are narrow where values are common).  The error is a rank bound, not
+# a value bound: a bin spanning a gap between values can place the estimate far from the exact quantile
+# INPUTS:
+#    inFid (int array) - grid point for each pair
+#    dist (float array) - distance for each pair
+#    values (float array) - variable values (pairs x variables).  Missing values are excluded
+#    nPoints (int) - number of grid points in the batch
+#    radii (int array) - buffer distances, in increasing order
+#    quantile (float) - quantile to calculate, between 0 and 1
+#    nBins (int) - maximum number of histogram bins
+# OUTPUTS:
+#    float64 array (points x radii x variables).  Grid points without values in a buffer are NaN
+def calcSketchQuantiles(inFid,dist,values,nPoints,radii,quantile=QUANTILE,nBins=SKETCH_BINS):
+    quantiles = np.full((nPoints,len(radii),values.shape[1]),np.nan)
+    if(len(radii) == 0):
+        return(quantiles)
+
+    # order pairs by buffer shell, so the pairs in each shell are a contiguous slice.  Pairs beyond
+    # the largest buffer are dropped
+    radiusIndex = calcRadiusIndex(dist,radii)
+    shellOrder = np.argsort(radiusIndex,kind='stable')
+    shellEnds = np.searchsorted(radiusIndex[shellOrder],np.arange(len(radii) + 1),side='left')
+    shellOrder = shellOrder[:shellEnds[-1]]
+    pointKeys = inFid[shellOrder].astype(np.int64)
+    pointIndex = np.arange(nPoints)
+    for varIndex in range(values.shape[1]):
+        shellValues = values[shellOrder,varIndex]
+        isValid = ~np.isnan(shellValues)
+        if not(isValid.any()):
+            continue
+
+        # bin edges are estimated from an evenly spaced sample of values.  Edges only set the bin widths,
+        # so sampling does not change the rank bound
+        validValues = shellValues[isValid]
+        sample = validValues[::max(len(validValues)//SKETCH_SAMPLE_SIZE,1)]
+        edges = np.unique(np.concatenate([[np.min(validValues)],np.quantile(sample,np.linspace(0,1,nBins + 1))[1:-1],
+                                          [np.max(validValues)]]))
+        nVarBins = max(len(edges) - 1,1)
+        widths = np.diff(edges) if len(edges) > 1 else np.zeros(1)
+
+        # missing values are counted in an extra bin beyond the last grid point, which is discarded
+        histKeys = np.full(len(shellValues),nPoints*nVarBins,dtype=np.int64)
+        histKeys[isValid] = pointKeys[isValid]*nVarBins + calcBinIndex(validValues,edges)
+        hist = np.zeros((nPoints,nVarBins))
+        for radiusPos in range(len(radii)):
+
+            # add pairs in the shell between the previous and current buffer
+            shellKeys = histKeys[shellEnds[radiusPos]:shellEnds[radiusPos + 1]]
+            hist += np.bincount(shellKeys,minlength=nPoints*nVarBins + 1)[:-1].reshape(nPoints,nVarBins)
+            cumHist = np.cumsum(hist,axis=1)
+            counts = cumHist[:,-1]
+            hasValues = counts > 0
+
+            # locate the bin containing the quantile rank, and interpolate within the bin
+            rank = np.maximum(counts - 1,0)*quantile
+            quantileBin = np.argmax(cumHist > rank[:,None],axis=1)
+            binCounts = hist[pointIndex,quantileBin]
+            before = cumHist[pointIndex,quantileBin] - binCounts
+            with np.errstate(divide='ignore',invalid='ignore'):
+                estimate = edges[quantileBin] + (rank - before)/binCounts*widths[quantileBin]
+            quantiles[hasValues,radiusPos,varIndex] = estimate[hasValues]
+    return(quantiles)
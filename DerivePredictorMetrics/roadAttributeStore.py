@@ -0,0 +1,72 @@
+# roadAttributeStore.py
+# Summary: A memory-mapped store of road segment attributes.  Each road variable is saved as one
+#          contiguous float32 .npy array, and roadType as an int8 array, indexed directly by road
+#          segment id (OID_).  Attaching attributes to near table pairs is an array gather, rather
+#          than re-reading the road network csv and merging for every batch
+
+# import libraries
+import os
+import numpy as np
+import pandas as ps
+
+# define global constants
+ROADS = "H:/Noise/implementation/PDX10m.csv" # road network partitioned into 10m segments
+ROAD_STORE_FOLDER = "H:/Noise/implementation/roadStore/"
+ROAD_VARIABLES = ['speed','ADTVolume','PctCars','PctHeavyTr','PctMedTruc','emissionHT']
+MISSING_ROAD_TYPE = -1 # roadType for ids without a road segment
+
+########## HELPER FUNCTIONS #############
+
+# convert the road network csv into a road attribute store.  Ids without a road segment are
+# assigned NaN variables and MISSING_ROAD_TYPE
+# INPUTS:
+#    roadsCsv (str) - absolute filepath to the road network csv, with OID_, roadType and ROAD_VARIABLES columns
+#    storeFolder (str) - absolute folderpath where the road store will be written
+def createRoadStore(roadsCsv,storeFolder):
+    if not(os.path.exists(storeFolder)):
+        os.makedirs(storeFolder)
+    roadData = ps.read_csv(roadsCsv,usecols=['OID_','roadType'] + ROAD_VARIABLES)
+    roadIds = roadData['OID_'].to_numpy(dtype=np.int64)
+    nIds = int(roadIds.max()) + 1
+    for name in ROAD_VARIABLES:
+        values = np.full(nIds,np.nan,dtype=np.float32)
+        values[roadIds] = roadData[name].to_numpy(dtype=np.float32)
+        np.save(os.path.join(storeFolder,name + '.npy'),values)
+    roadType = np.full(nIds,MISSING_ROAD_TYPE,dtype=np.int8)
+    roadType[roadIds] = roadData['roadType'].to_numpy()
+    np.save(os.path.join(storeFolder,'roadType.npy'),roadType)
+
+# open a road attribute store.  Arrays are memory-mapped, so worker processes share the same pages
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the road store
+# OUTPUTS:
+#    roadStore (dict) - memory-mapped arrays for each road variable, plus 'roadType'
+def loadRoadStore(storeFolder):
+    roadStore = {}
+    for name in ROAD_VARIABLES + ['roadType']:
+        roadStore[name] = np.load(os.path.join(storeFolder,name + '.npy'),mmap_mode='r')
+    return(roadStore)
+
+# attach road attributes to each near table pair
+# INPUTS:
+#    roadStore (dict) - road store returned by loadRoadStore
+#    nearFid (int array) - road segment id for each pair
+# OUTPUTS:
+#    values (float64 array) - road variables for each pair (pairs x ROAD_VARIABLES).  NaN where missing
+#    roadType (int8 array) - roadType for each pair, MISSING_ROAD_TYPE for ids not in the store
+def gatherRoadAttributes(roadStore,nearFid):
+    nIds = len(roadStore['roadType'])
+    isFound = (nearFid >= 0) & (nearFid < nIds)
+    roadIndex = np.where(isFound,nearFid,0)
+    values = np.empty((len(nearFid),len(ROAD_VARIABLES)))
+    for varIndex, name in enumerate(ROAD_VARIABLES):
+        values[:,varIndex] = np.asarray(roadStore[name])[roadIndex]
+    roadType = np.asarray(roadStore['roadType'])[roadIndex]
+    values[~isFound] = np.nan
+    roadType[~isFound] = MISSING_ROAD_TYPE
+    return(values,roadType)
+
+
+####################### MAIN FUNCTION ##################
+if __name__ == '__main__':
+    createRoadStore(ROADS,ROAD_STORE_FOLDER)
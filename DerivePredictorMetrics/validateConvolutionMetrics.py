@@ -0,0 +1,175 @@
+# validateConvolutionMetrics.py
+# Summary: check the agreement gate of convolutionMetrics.py on a synthetic road network.  A small grid,
+#          a street network split into 10m road segments, misc predictor layers, a road attribute store and
+#          near tables for every batch are created in a temporary folder.  Convolution metrics are compared
+#          against near table metrics for every batch, the relative difference at the 99th percentile of
+#          grid points is reported for each metric (the discretization error AGREEMENT_TOLERANCE is set
+#          from), and at least one metric must pass the agreement gate
+
+# import libraries
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as ps
+import geopandas as gpd
+import shapely
+import convolutionMetrics
+import calcMiscMetrics
+import calcRdMetrics
+import roadAttributeStore
+
+# near tables are written by the preprocessing stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PreprocessPredictionDatasets'))
+import nearTableCSR
+import nearTableEngine
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+# define global constants
+GRID_CRS = 'EPSG:3857'
+GRID_ORIGIN = (-13656000,5704000) # south west corner of the synthetic grid, in Portland
+GRID_SHAPE = (100,100) # number of grid rows and columns
+RESOLUTION = 10
+BATCH_SIZE = 1000
+STREET_SPACING = 80 # distance between parallel streets, in meters
+NETWORK_EXTENT = 1200 # streets extend this far from the grid center, in meters
+SEGMENT_LENGTH = 10 # streets are split into 10m road segments, as in PDX10m.shp
+LIGHT_SPACING = 30 # distance between street lights along a street, in meters
+ROAD_SEARCH_RADIUS = 800 # near table search radius for roads.  Covers the 700m buffer of pcca700mdp
+RANDOM_SEED = 1
+
+########## HELPER FUNCTIONS #############
+
+# split a straight street into road segments
+# INPUTS:
+#    start (float tuple), end (float tuple) - street end points, in the near crs
+# OUTPUTS:
+#    list of line geometries, each SEGMENT_LENGTH long
+def splitStreet(start,end):
+    nSegments = int(round(np.hypot(end[0] - start[0],end[1] - start[1])/SEGMENT_LENGTH))
+    fractions = np.linspace(0,1,nSegments + 1)
+    x = start[0] + (end[0] - start[0])*fractions
+    y = start[1] + (end[1] - start[1])*fractions
+    return([shapely.LineString([(x[i],y[i]),(x[i + 1],y[i + 1])]) for i in range(nSegments)])
+
+# create a grid of streets around a center point.  Streets run north-south and east-west, and are
+# offset from the grid points so road segments do not pass through grid points
+# INPUTS:
+#    centerX (float), centerY (float) - center of the street network, in the near crs
+# OUTPUTS:
+#    list of streets, each a list of road segment geometries
+def createStreets(centerX,centerY):
+    streets = []
+    for offset in np.arange(-NETWORK_EXTENT,NETWORK_EXTENT + 1,STREET_SPACING) + 3.7:
+        streets.append(splitStreet((centerX + offset,centerY - NETWORK_EXTENT),(centerX + offset,centerY + NETWORK_EXTENT)))
+        streets.append(splitStreet((centerX - NETWORK_EXTENT,centerY + offset),(centerX + NETWORK_EXTENT,centerY + offset)))
+    return(streets)
+
+# write a feature layer as a shapefile.  Feature ids (FID) are row order
+# INPUTS:
+#    geometry (list) - feature geometries, in the near crs
+#    shapefile (str) - absolute filepath where the layer will be written
+def writeLayer(geometry,shapefile):
+    gpd.GeoDataFrame(geometry=geometry,crs=nearTableEngine.NEAR_CRS).to_file(shapefile)
+
+# write a near table for every batch of grid points
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    shapefile (str) - absolute filepath to the feature layer
+#    outputFolder (str) - absolute folderpath where near tables are written
+#    radius (float) - search radius, in meters
+def writeNearTables(store,shapefile,outputFolder,radius):
+    os.makedirs(outputFolder)
+    layer = nearTableEngine.loadNearLayer(shapefile)
+    for fileSig in gridPointStore.listBatchSigs(store):
+        batch = gridPointStore.getBatch(store,fileSig)
+        x, y = nearTableEngine.projectPoints(batch['x'],batch['y'],store['meta']['crs'],layer['crs'])
+        nearTable = nearTableEngine.queryNearTable(layer,x,y,radius)
+        nearTableCSR.writeNearTable(outputFolder + fileSig + nearTableCSR.FILE_EXTENSION,nearTable['IN_FID'],
+                                    nearTable['NEAR_FID'],nearTable['NEAR_DIST'],len(batch['x']))
+
+# create the synthetic grid, road network, misc layers, road attribute store and near tables, and
+# point the convolution and near table stages at them
+# INPUTS:
+#    folder (str) - absolute folderpath where the synthetic datasets are written
+def createSyntheticInputs(folder):
+    rng = np.random.default_rng(RANDOM_SEED)
+    rows, cols = np.meshgrid(np.arange(GRID_SHAPE[0]),np.arange(GRID_SHAPE[1]),indexing='ij')
+    x = GRID_ORIGIN[0] + cols.ravel()*RESOLUTION
+    y = GRID_ORIGIN[1] + rows.ravel()*RESOLUTION
+    gridPointStore.createPointStoreFromArrays(folder + "pointStore/",x,y,GRID_CRS,RESOLUTION,BATCH_SIZE)
+    store = gridPointStore.loadPointStore(folder + "pointStore/")
+
+    # each street has one road type and one value of each road variable
+    centerX, centerY = nearTableEngine.projectPoints([x.mean()],[y.mean()],GRID_CRS,nearTableEngine.NEAR_CRS)
+    streets = createStreets(float(centerX[0]),float(centerY[0]))
+    roads, roadData = [], []
+    for street in streets:
+        streetData = {'roadType':int(rng.integers(0,4))}
+        streetData.update({name:float(rng.uniform(1,100)) for name in roadAttributeStore.ROAD_VARIABLES})
+        roads += street
+        roadData += [streetData]*len(street)
+    writeLayer(roads,folder + "roads.shp")
+    roadData = ps.DataFrame(roadData)
+    roadData['OID_'] = np.arange(len(roadData))
+    roadData.to_csv(folder + "roads.csv",index=False)
+    roadAttributeStore.createRoadStore(folder + "roads.csv",folder + "roadStore/")
+    writeNearTables(store,folder + "roads.shp",folder + "near/",ROAD_SEARCH_RADIUS)
+
+    # misc line layers are random subsets of streets, and street lights are spaced along every street
+    for abbrev in ['er','bi','tm']:
+        isIncluded = rng.random(len(streets)) < 0.3
+        writeLayer([segment for street, include in zip(streets,isIncluded) if include for segment in street],folder + abbrev + ".shp")
+    lights = [shapely.line_interpolate_point(shapely.line_merge(shapely.MultiLineString(street)),distance)
+              for street in streets for distance in np.arange(LIGHT_SPACING/2,SEGMENT_LENGTH*len(street),LIGHT_SPACING)]
+    writeLayer(lights,folder + "sl.shp")
+    for index, abbrev in enumerate(calcMiscMetrics.ABBREV):
+        writeNearTables(store,folder + abbrev + ".shp",folder + "nearMisc/" + abbrev + "/",calcMiscMetrics.BUFFER_DISTANCES[index])
+
+    convolutionMetrics.ROADS = folder + "roads.shp"
+    convolutionMetrics.ROAD_STORE_FOLDER = folder + "roadStore/"
+    convolutionMetrics.MISC_SOURCES = {abbrev:folder + abbrev + ".shp" for abbrev in calcMiscMetrics.ABBREV}
+    calcMiscMetrics.NEAR_FOLDER = folder + "nearMisc/"
+    calcRdMetrics.NEAR_FOLDER = folder + "near/"
+    calcRdMetrics.ROAD_STORE_FOLDER = folder + "roadStore/"
+    calcRdMetrics.POINT_STORE_FOLDER = folder + "pointStore/"
+
+# calculate the relative difference between convolution and near table metrics at a percentile of grid points
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    metrics (dict) - convolution metrics for every grid point
+#    percentile (float) - percentile of grid points, between 0 and 100
+# OUTPUTS:
+#    dict mapping each metric name to the relative difference, using the same scale as checkAgreement
+def calcRelativeDifference(store,metrics,percentile):
+    calcRdMetrics.initWorker()
+    tableMetrics = {}
+    for fileSig in gridPointStore.listBatchSigs(store):
+        batchMetrics = calcMiscMetrics.calcBatchMetrics(fileSig)
+        batchMetrics.update(calcRdMetrics.calcBatchMetrics(calcRdMetrics.NEAR_FOLDER + fileSig + nearTableCSR.FILE_EXTENSION))
+        for name in batchMetrics:
+            tableMetrics.setdefault(name,[]).append(batchMetrics[name])
+    relDiff = {}
+    for name in metrics:
+        table = np.concatenate(tableMetrics[name])
+        relDiff[name] = float(np.percentile(np.abs(metrics[name] - table)/np.maximum(np.abs(table),1),percentile))
+    return(relDiff)
+
+####################### MAIN FUNCTION ##################
+if __name__ == '__main__':
+    folder = tempfile.mkdtemp().replace('\\','/') + "/"
+    createSyntheticInputs(folder)
+    pointStore = gridPointStore.loadPointStore(folder + "pointStore/")
+    convMetrics = convolutionMetrics.calcMiscConvolution(pointStore)
+    convMetrics.update(convolutionMetrics.calcRoadConvolution(pointStore,convolutionMetrics.ROAD_METRICS))
+
+    relDiff = calcRelativeDifference(pointStore,convMetrics,100*convolutionMetrics.MIN_AGREEMENT)
+    for name in relDiff:
+        print("%s: relative difference at the %.0fth percentile of grid points %.4f" %(name,100*convolutionMetrics.MIN_AGREEMENT,relDiff[name]))
+    agreement = convolutionMetrics.checkAgreement(pointStore,convMetrics,len(gridPointStore.listBatchSigs(pointStore)))
+    agreedMetrics = convolutionMetrics.selectAgreedMetrics(convMetrics,agreement)
+    assert len(agreedMetrics) > 0, "no convolution metric passed the agreement gate"
+    print("%s passed the agreement gate" %(', '.join(agreedMetrics.keys())))
@@ -0,0 +1,104 @@
+# validateSketchQuantiles.py
+# Summary: compare sketch quantiles (see quantileEngine.py) against exact quantiles for every quantile
+#          metric used by the model specs, on a random sample of batches with real near tables.  A grid
+#          point agrees if its sketch estimate is within SKETCH_TOLERANCE (relative) of the exact quantile.
+#          calcShieldingMetrics.py only uses the sketch when QUANTILE_SKETCH_RADIUS is set, which should
+#          only be done once every metric agrees for at least MIN_AGREEMENT of grid points
+
+# import libraries
+import os
+import sys
+import numpy as np
+import calcShieldingMetrics
+import metricPlanner
+import bufferAggregation
+
+# near tables are written by the preprocessing stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PreprocessPredictionDatasets'))
+import nearTableCSR
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+# model variables are read from the regression model specs of the prediction stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','PredictLEQAndDNL'))
+import predictionEngine
+
+# define global constants
+N_CHECK_BATCHES = 20 # number of randomly sampled batches compared
+SKETCH_TOLERANCE = 0.001 # relative difference under which a sketch estimate is considered equal to the exact quantile
+MIN_AGREEMENT = 0.99 # fraction of grid points that must agree before the sketch is used
+RANDOM_SEED = 1 # seed for sampling batches, so checks are reproducible
+
+########## HELPER FUNCTIONS #############
+
+# calculate every requested quantile metric for a batch, exactly and with the sketch
+# INPUTS:
+#    fileSig (str) - unique identifier for a batch of grid points (e.g. b1000 for points 1000-1999)
+#    plan (dict) - metric plan returned by metricPlanner.planMetrics
+# OUTPUTS:
+#    exact (dict), sketch (dict) - map each quantile metric name to an array with one value for
+#    each grid point in the batch
+def calcBatchQuantiles(fileSig,plan):
+    roadDistFile = calcShieldingMetrics.NEAR_FOLDER + fileSig + nearTableCSR.FILE_EXTENSION
+    nearData = bufferAggregation.loadNeighbours(roadDistFile,calcShieldingMetrics.roadStore,1)
+    shieldedData = calcShieldingMetrics.loadIsShieldedForSig(fileSig)
+    exact, sketch = {}, {}
+    for (prefix, roadType), requests in plan.items():
+        qRequests = [request for request in requests if request['statistic'] == 'q']
+        if(len(qRequests) == 0):
+            continue
+        pairMask = calcShieldingMetrics.selectPairs(nearData,roadType,shieldedData,prefix)
+        radii = metricPlanner.listRadii(qRequests)
+        columns = sorted({(request['variable'],request['weighting']) for request in qRequests})
+        exactQuantiles = calcShieldingMetrics.extractQuantileEstimates(radii,nearData,pairMask,columns,sketchRadius=None)
+        sketchQuantiles = calcShieldingMetrics.extractQuantileEstimates(radii,nearData,pairMask,columns,sketchRadius=0)
+        for request in qRequests:
+            radiusPos, colIndex = radii.index(request['radius']), columns.index((request['variable'],request['weighting']))
+            exact[request['name']] = exactQuantiles[:,radiusPos,colIndex]
+            sketch[request['name']] = sketchQuantiles[:,radiusPos,colIndex]
+    return(exact,sketch)
+
+####################### MAIN FUNCTION ##################
+if __name__ == '__main__':
+    modelVariables = predictionEngine.compileModels(predictionEngine.loadModelSpecs())['variables']
+    plan = metricPlanner.planMetrics(metricPlanner.listModelMetrics(calcShieldingMetrics.SHIELDING_PREFIXES,modelVariables))
+    calcShieldingMetrics.initWorker(plan)
+    pointStore = gridPointStore.loadPointStore(calcShieldingMetrics.POINT_STORE_FOLDER)
+    fileSigs = gridPointStore.listBatchSigs(pointStore)
+    fileSigs = [fileSigs[index] for index in np.random.default_rng(RANDOM_SEED).permutation(len(fileSigs))]
+
+    # only batches with near tables and shielding filters are compared
+    exactValues, sketchValues = {}, {}
+    nCompared = 0
+    for fileSig in fileSigs:
+        if(nCompared >= N_CHECK_BATCHES):
+            break
+        if not(calcShieldingMetrics.checkForFiles(fileSig)):
+            continue
+        exact, sketch = calcBatchQuantiles(fileSig,plan)
+        for metricName in exact:
+            exactValues.setdefault(metricName,[]).append(exact[metricName])
+            sketchValues.setdefault(metricName,[]).append(sketch[metricName])
+        nCompared += 1
+    if(nCompared == 0):
+        print("cannot check sketch quantiles: no batches with near tables and shielding filters")
+
+    # summarize differences for each metric.  Grid points without roads in the buffer are NaN in both
+    isAgreement = nCompared > 0
+    for metricName in exactValues:
+        exact = np.concatenate(exactValues[metricName])
+        sketch = np.concatenate(sketchValues[metricName])
+        isAgree = np.isclose(sketch,exact,rtol=SKETCH_TOLERANCE,atol=0,equal_nan=True)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            relDiff = np.abs(sketch - exact)/np.abs(exact)
+        fracAgree = float(np.mean(isAgree))
+        print("%s: %i grid points, %.4f agree, max relative diff %.6f" %(
+            metricName,len(exact),fracAgree,np.nanmax(np.where(exact == sketch,0,relDiff),initial=0)))
+        if(fracAgree < MIN_AGREEMENT):
+            isAgreement = False
+    if isAgreement:
+        print("sketch quantiles agree with exact quantiles for every metric, and can be used")
+    else:
+        print("sketch quantiles do not agree with exact quantiles.  Keep QUANTILE_SKETCH_RADIUS = None")
@@ -0,0 +1,128 @@
+# predictGridPoints.py
+# Summary: predict LEQ and DNL values for every grid point using previously developed linear
+#          regression models.  The feature matrix of each batch is read from the feature store once,
+#          and every model listed in MODEL_SPECS is applied together (see predictionEngine.py).
+#          Batches are predicted in parallel by a pool of workers, and a single writer appends each
+#          batch to a binary prediction output in batch order, so memory use does not grow with the
+#          number of grid points.  A compact csv can be exported for GIS use
+
+# import libraries
+from multiprocessing import Pool
+import os
+import sys
+import numpy as np
+import predictionEngine
+import predictionWriter
+
+# predictor variables are written to the feature store by the metric stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','DerivePredictorMetrics'))
+import featureStore
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+# define global constants
+FEATURE_STORE_FOLDER = "H:/Noise/implementation/featureStore/"
+POINT_STORE_FOLDER = "H:/Noise/implementation/pointStore/"
+OUTPUT_FOLDER = "H:/Noise/implementation/predictions/"
+PREDICTION_FOLDER = OUTPUT_FOLDER + "predictionStore/" # binary prediction output, one .npy array per column
+EXPORT_CSV = True # also export predictions to a compact csv (point id, lat/long and predictions)
+MODEL_SPECS = predictionEngine.MODEL_SPECS # json model specs to predict.  Add specs to compare refitted models
+WRITE_CONTRIBUTIONS = False # also save the contribution of each model term (e.g. LEQ_x0)
+N_CPUS = 8
+IMAP_CHUNK_SIZE = 16 # number of batches sent to a worker at once
+
+# compiled models and grid points, loaded once per worker process
+compiledModels = None
+pointStore = None
+
+########## HELPER FUNCTIONS #############
+
+# compile models and open the point store.  Called once when each worker process starts
+def initWorker():
+    global compiledModels, pointStore
+    compiledModels = predictionEngine.compileModels(predictionEngine.loadModelSpecs(MODEL_SPECS))
+    pointStore = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+
+# identify which grid points have all predictor variables derived.  Every variable used by the
+# model specs must have a feature store column, so batches are never predicted with missing predictors
+# INPUTS:
+#    variables (str array) - model variable names
+# OUTPUTS:
+#    array of filenames for grid points that are ready for prediction
+def getFinishedSigs(variables):
+    finishedSigs = []
+    missingVariables = [variable for variable in variables if not(featureStore.hasFeatureColumn(FEATURE_STORE_FOLDER,variable))]
+    if(len(missingVariables) > 0):
+        print("feature store has no column for model variables: %s" %(', '.join(missingVariables)))
+        return(finishedSigs)
+    for fileSig in gridPointStore.listBatchSigs(pointStore):
+        startId, endId = gridPointStore.batchSigToRange(fileSig,pointStore['meta']['batchSize'])
+        if(featureStore.isFeatureBatchComplete(FEATURE_STORE_FOLDER,variables,startId,endId)):
+            finishedSigs.append(fileSig)
+    return(finishedSigs)
+
+# list the columns written to the prediction output, and the datatype of each column
+# INPUTS:
+#    compiled (dict) - models returned by predictionEngine.compileModels
+# OUTPUTS:
+#    dict mapping column names to numpy datatypes
+def listOutputColumns(compiled):
+    columns = {'pointId':np.int64}
+    for modelIndex, modelName in enumerate(compiled['names']):
+        columns[modelName] = np.int32 if compiled['round'][modelIndex] == 0 else np.float64
+        if WRITE_CONTRIBUTIONS:
+            for termIndex in range(len(compiled['termBasis'][modelIndex])):
+                columns[modelName + '_x' + str(termIndex)] = np.float32
+    return(columns)
+
+# load data and predict every compiled model for a batch of grid points.  Grid points removed by
+# screening (e.g. points within buildings or water bodies) are not predicted
+# INPUTS:
+#    fileSig (str) - unique identifier for the batch of grid points
+#    (e.g. b1000 for grid points 1000-1999)
+# OUTPUTS:
+#    modelPredictions (dict) - global point id, predictions of each model and (optionally) term
+#                              contributions, with one value for each screened grid point in the batch
+def processFileSig(fileSig):
+    batch = gridPointStore.getBatch(pointStore,fileSig)
+    pointId = np.asarray(batch['pointId'])
+
+    # road, shielding, misc and NDVI metrics are stored by global point id, so rows line up with the batch
+    features = predictionEngine.loadFeatures(FEATURE_STORE_FOLDER,compiledModels['variables'],batch['startId'],
+                                             batch['startId'] + len(pointId))
+    isScreened = gridPointStore.isScreened(batch)
+    features = features[isScreened]
+    modelPredictions = predictionEngine.predictModels(features,compiledModels)
+    modelPredictions['pointId'] = pointId[isScreened]
+    if WRITE_CONTRIBUTIONS:
+        for modelIndex, modelName in enumerate(compiledModels['names']):
+            contributions = predictionEngine.calcContributions(features,compiledModels,modelIndex)
+            for termIndex in range(contributions.shape[1]):
+                modelPredictions[modelName + '_x' + str(termIndex)] = contributions[:,termIndex]
+    return(modelPredictions)
+
+####################### MAIN FUNCTION ##################
+if __name__ == '__main__':
+
+    # compile all models, and get list of grid point batches that are ready to be analyzed
+    initWorker()
+    sigsToProcess = getFinishedSigs(compiledModels['variables'])
+    print("found %i grid point batches to process" %(len(sigsToProcess)))
+
+    # workers predict batches in parallel.  imap returns batches in the order they were submitted,
+    # so a single writer appends predictions in batch order
+    writer = predictionWriter.openPredictionWriter(PREDICTION_FOLDER,listOutputColumns(compiledModels))
+    pool = Pool(processes=N_CPUS,initializer=initWorker)
+    for index, batchPredictions in enumerate(pool.imap(processFileSig,sigsToProcess,chunksize=IMAP_CHUNK_SIZE)):
+        if(index%500==0):
+            print("completed predictions for %i gridPoints" %(index*pointStore['meta']['batchSize']))
+        predictionWriter.appendPredictions(writer,batchPredictions)
+    pool.close()
+    pool.join()
+    predictionWriter.closePredictionWriter(writer)
+
+    # export a compact csv for GIS tools
+    if EXPORT_CSV:
+        predictionWriter.exportCSV(predictionWriter.loadPredictions(PREDICTION_FOLDER),pointStore,OUTPUT_FOLDER + "predictions.csv")
@@ -0,0 +1,177 @@
+# predictionEngine.py
+# Summary: predict noise levels from the feature store with any number of linear regression models.
+#          Models are described by json spec files (see models/LEQ.json) and compiled into one stacked
+#          coefficient matrix.  The feature matrix for a batch of grid points is read once as a
+#          contiguous float32 array, and every model is applied in a single matrix product.
+#
+#          Model spec format:
+#            name (str) - model name, used as the prediction column name (e.g. LEQ)
+#            description (str) - optional description of the model
+#            intercept (float) - model intercept
+#            round (int) - optional number of decimals predictions are rounded to.  0 gives integer predictions
+#            terms (list) - one entry per predictor, each with a variable name (feature store column), a
+#                           coefficient, and an optional transform (see TERM_TRANSFORMS)
+
+# import libraries
+import os
+import sys
+import json
+import numpy as np
+
+# predictor variables are written to the feature store by the metric stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','DerivePredictorMetrics'))
+import featureStore
+
+# define global constants
+MODEL_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),'models')
+MODEL_SPECS = [os.path.join(MODEL_FOLDER,'LEQ.json'),os.path.join(MODEL_FOLDER,'DNL.json')]
+
+# term transforms, applied to the contribution (coefficient * variable) of a term.  Clipping at 0 is
+# linear in the positive or negative part of a variable: min(coef*value,0) equals coef*max(value,0) when
+# coef is negative and coef*min(value,0) when coef is positive.  Each transform maps the sign of the
+# coefficient to the part of the variable ('value', 'positive' or 'negative') it multiplies
+TERM_TRANSFORMS = {
+    'identity':{True:'value',False:'value'}, # keyed by coef >= 0
+    'clipUpper':{True:'negative',False:'positive'}, # contribution clipped at 0 from above (e.g. NDVI)
+    'clipLower':{True:'positive',False:'negative'} # contribution clipped at 0 from below
+}
+BASIS_FUNCTIONS = {
+    'value':lambda values: values,
+    'positive':lambda values: np.maximum(values,0),
+    'negative':lambda values: np.minimum(values,0)
+}
+
+########## HELPER FUNCTIONS #############
+
+# read and check a model spec file
+# INPUTS:
+#    specFile (str) - absolute filepath to a json model spec
+# OUTPUTS:
+#    spec (dict) - model spec, with defaults filled in.  None if the spec is not valid
+def loadModelSpec(specFile):
+    with open(specFile,'r') as inFile:
+        spec = json.load(inFile)
+    for key in ['name','intercept','terms']:
+        if key not in spec:
+            print("cannot load model spec %s: missing %s" %(specFile,key))
+            return(None)
+    spec.setdefault('round',None)
+    for term in spec['terms']:
+        term.setdefault('transform','identity')
+        if not('variable' in term and 'coef' in term) or term['transform'] not in TERM_TRANSFORMS:
+            print("cannot load model spec %s: invalid term %s" %(specFile,str(term)))
+            return(None)
+    return(spec)
+
+# read model spec files.  Invalid specs are reported and skipped
+# INPUTS:
+#    specFiles (str array) - absolute filepaths to json model specs
+# OUTPUTS:
+#    list of model specs
+def loadModelSpecs(specFiles=MODEL_SPECS):
+    specs = [loadModelSpec(specFile) for specFile in specFiles]
+    return([spec for spec in specs if spec is not None])
+
+# compile model specs into one stacked coefficient matrix.  Rows are basis columns (a variable, or its
+# positive or negative part) shared by all models, and columns are models
+# INPUTS:
+#    specs (dict array) - model specs returned by loadModelSpecs
+# OUTPUTS:
+#    compiled (dict) - model names, rounding for each model, unique variable names, basis columns
+#                      (variable index, basis name), float32 coefficient matrix (basis columns x models),
+#                      intercepts, and the basis column and coefficient of each term for each model
+def compileModels(specs):
+    variables = []
+    basis = []
+    termBasis = []
+    for spec in specs:
+        modelBasis = []
+        for term in spec['terms']:
+            if term['variable'] not in variables:
+                variables.append(term['variable'])
+            basisKey = (variables.index(term['variable']),TERM_TRANSFORMS[term['transform']][term['coef'] >= 0])
+            if basisKey not in basis:
+                basis.append(basisKey)
+            modelBasis.append(basis.index(basisKey))
+        termBasis.append(modelBasis)
+
+    # terms that share a basis column within a model are summed
+    coef = np.zeros((len(basis),len(specs)))
+    for modelIndex, spec in enumerate(specs):
+        for term, basisIndex in zip(spec['terms'],termBasis[modelIndex]):
+            coef[basisIndex,modelIndex] += term['coef']
+    compiled = {
+        'names':[spec['name'] for spec in specs],
+        'round':[spec['round'] for spec in specs],
+        'variables':variables,
+        'basis':basis,
+        'coef':np.ascontiguousarray(coef,dtype=np.float32),
+        'intercept':np.array([spec['intercept'] for spec in specs],dtype=np.float64),
+        'termBasis':termBasis,
+        'termCoef':[np.array([term['coef'] for term in spec['terms']],dtype=np.float32) for spec in specs]
+    }
+    return(compiled)
+
+# read the feature matrix for a range of grid points.  Every variable must have a feature store
+# column, and every row in the range must have been calculated (not NaN), so models are never
+# applied to missing predictors
+# INPUTS:
+#    storeFolder (str) - absolute folderpath to the feature store
+#    variables (str array) - predictor variable names, one matrix column for each
+#    startId (int) - first point id in the range (inclusive)
+#    endId (int) - last point id in the range (exclusive)
+# OUTPUTS:
+#    float32 array (points x variables)
+def loadFeatures(storeFolder,variables,startId,endId):
+    missingVariables = [variable for variable in variables if not(featureStore.hasFeatureColumn(storeFolder,variable))]
+    if(len(missingVariables) > 0):
+        raise ValueError("feature store has no column for model variables: %s" %(', '.join(missingVariables)))
+    features = featureStore.loadFeatureMatrix(storeFolder,variables,startId,endId)
+    isIncomplete = np.isnan(features).any(axis=0)
+    if(isIncomplete.any()):
+        raise ValueError("model variables not calculated for every grid point in %i-%i: %s"
+                         %(startId,endId,', '.join(np.array(variables)[isIncomplete])))
+    return(features)
+
+# expand a feature matrix into the basis columns of compiled models
+# INPUTS:
+#    features (float32 array) - feature matrix (points x compiled variables) returned by loadFeatures
+#    compiled (dict) - models returned by compileModels
+# OUTPUTS:
+#    float32 array (points x basis columns)
+def expandBasis(features,compiled):
+    basisMatrix = np.empty((features.shape[0],len(compiled['basis'])),dtype=np.float32)
+    for basisIndex, (varIndex, basisName) in enumerate(compiled['basis']):
+        basisMatrix[:,basisIndex] = BASIS_FUNCTIONS[basisName](features[:,varIndex])
+    return(basisMatrix)
+
+# apply every compiled model to a feature matrix in one matrix product
+# INPUTS:
+#    features (float32 array) - feature matrix (points x compiled variables) returned by loadFeatures
+#    compiled (dict) - models returned by compileModels
+# OUTPUTS:
+#    dict mapping each model name to its predictions.  Models rounded to 0 decimals give int32
+#    predictions, others give float64
+def predictModels(features,compiled):
+    predictions = expandBasis(features,compiled) @ compiled['coef'] + compiled['intercept']
+    modelPredictions = {}
+    for modelIndex, modelName in enumerate(compiled['names']):
+        decimals = compiled['round'][modelIndex]
+        if decimals is None:
+            modelPredictions[modelName] = predictions[:,modelIndex]
+        elif decimals == 0:
+            modelPredictions[modelName] = np.rint(predictions[:,modelIndex]).astype(np.int32)
+        else:
+            modelPredictions[modelName] = np.round(predictions[:,modelIndex],decimals)
+    return(modelPredictions)
+
+# calculate the contribution of each term to one model's predictions
+# INPUTS:
+#    features (float32 array) - feature matrix (points x compiled variables) returned by loadFeatures
+#    compiled (dict) - models returned by compileModels
+#    modelIndex (int) - position of the model in the compiled models
+# OUTPUTS:
+#    float32 array of contributions (points x model terms)
+def calcContributions(features,compiled,modelIndex):
+    basisMatrix = expandBasis(features,compiled)
+    return(basisMatrix[:,compiled['termBasis'][modelIndex]]*compiled['termCoef'][modelIndex])
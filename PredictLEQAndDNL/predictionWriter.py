@@ -0,0 +1,89 @@
+# predictionWriter.py
+# Summary: stream predictions to disk in bounded memory.  Each batch of predictions is appended to one
+#          raw binary file per column (point id, each model, and optional term contributions) as soon as
+#          it is predicted, so memory use does not grow with the number of grid points.  Columns are
+#          converted to memory-mapped .npy arrays when the output is closed, and can be exported to a
+#          compact csv (point id, lat/long and predictions) one chunk at a time
+
+# import libraries
+import os
+import sys
+import json
+import numpy as np
+import pandas as ps
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+import arrayIO
+
+# define global constants
+PREDICTION_META_FILE = 'predictionMeta.json'
+CSV_CHUNK_SIZE = 1000000 # number of grid points exported to csv at once.  Bounds memory use
+
+########## HELPER FUNCTIONS #############
+
+# open a prediction output for writing.  Existing columns in the output folder are overwritten
+# INPUTS:
+#    outputFolder (str) - absolute folderpath where prediction columns will be written
+#    columns (dict) - maps column names to numpy datatypes.  Must include pointId
+# OUTPUTS:
+#    writer (dict) - output folder, column datatypes, open raw files and number of rows written
+def openPredictionWriter(outputFolder,columns):
+    if not(os.path.exists(outputFolder)):
+        os.makedirs(outputFolder)
+    writer = {'folder':outputFolder,'columns':columns,'files':{},'nRows':0}
+    for name in columns:
+        writer['files'][name] = open(os.path.join(outputFolder,name + '.raw'),'wb')
+    return(writer)
+
+# append a batch of predictions to the output
+# INPUTS:
+#    writer (dict) - output returned by openPredictionWriter
+#    batchValues (dict) - maps each column name to an array with one value for each grid point in the batch
+def appendPredictions(writer,batchValues):
+    for name, dtype in writer['columns'].items():
+        writer['files'][name].write(np.ascontiguousarray(batchValues[name],dtype=dtype).tobytes())
+    writer['nRows'] += len(batchValues['pointId'])
+
+# close a prediction output, convert raw columns into .npy arrays and save the output metadata
+# INPUTS:
+#    writer (dict) - output returned by openPredictionWriter
+def closePredictionWriter(writer):
+    for name, dtype in writer['columns'].items():
+        writer['files'][name].close()
+        arrayIO.rawToNpy(os.path.join(writer['folder'],name + '.raw'),os.path.join(writer['folder'],name + '.npy'),
+                         dtype,writer['nRows'])
+    meta = {'columns':list(writer['columns'].keys()),'nRows':writer['nRows']}
+    with open(os.path.join(writer['folder'],PREDICTION_META_FILE),'w') as metaFile:
+        json.dump(meta,metaFile,indent=2)
+
+# open a closed prediction output.  Columns are memory-mapped
+# INPUTS:
+#    outputFolder (str) - absolute folderpath of the prediction output
+# OUTPUTS:
+#    predictions (dict) - memory-mapped arrays for each column, plus metadata under 'meta'
+def loadPredictions(outputFolder):
+    with open(os.path.join(outputFolder,PREDICTION_META_FILE),'r') as metaFile:
+        predictions = {'meta':json.load(metaFile)}
+    for name in predictions['meta']['columns']:
+        predictions[name] = np.load(os.path.join(outputFolder,name + '.npy'),mmap_mode='r')
+    return(predictions)
+
+# export predictions to a csv file with point id, lat/long coords and every prediction column, one
+# chunk of grid points at a time
+# INPUTS:
+#    predictions (dict) - prediction output returned by loadPredictions
+#    pointStore (dict) - point store returned by gridPointStore.loadPointStore
+#    csvFile (str) - absolute filepath where the csv will be written
+#    chunkSize (int) - number of grid points written at once
+def exportCSV(predictions,pointStore,csvFile,chunkSize=CSV_CHUNK_SIZE):
+    valueColumns = [name for name in predictions['meta']['columns'] if name != 'pointId']
+    for start in range(0,max(predictions['meta']['nRows'],1),chunkSize):
+        pointId = np.asarray(predictions['pointId'][start:start + chunkSize])
+        points = {'x':pointStore['x'][pointId],'y':pointStore['y'][pointId]}
+        longitude, latitude = gridPointStore.getBatchLonLat(pointStore,points)
+        chunk = ps.DataFrame({'pointId':pointId,'longitude':longitude,'latitude':latitude})
+        for name in valueColumns:
+            chunk[name] = np.asarray(predictions[name][start:start + chunkSize])
+        chunk.to_csv(csvFile,mode='w' if start == 0 else 'a',header=(start == 0),index=False)
@@ -0,0 +1,263 @@
+# angularBins.py
+# Summary: assign features (e.g. road segments, building edges) to 1 degree bearing bins around
+#          grid points, computed directly from vector bearings.  Bin a covers compass bearings
+#          [a - 0.5, a + 0.5), matching the 360 radial wedge polygons per grid point that were
+#          previously intersected with features to find their angles
+
+# import libraries
+import numpy as np
+import shapely
+from pyproj import Proj, Transformer
+
+# define global constants
+N_BINS = 360
+
+########## HELPER FUNCTIONS #############
+
+# calculate the angle between true north and grid north for a projected crs.  Adding the
+# convergence to a bearing measured from grid north gives the bearing from true north
+# INPUTS:
+#    crs (str) - projected coordinate reference system (e.g. EPSG:32610)
+#    lon (float) - longitude where convergence is calculated (e.g. center of the city)
+#    lat (float) - latitude where convergence is calculated
+# OUTPUTS:
+#    convergence angle, in degrees
+def calcConvergence(crs,lon,lat):
+    return(float(Proj(crs).get_factors(lon,lat).meridian_convergence))
+
+# calculate the convergence at the center of the prediction grid.  Convergence varies by less than
+# a degree across the city, so a single value is used for every grid point
+# INPUTS:
+#    meta (dict) - grid metadata (crs, resolution, minX, minY, nRows, nCols) from the point store
+#    crs (str) - projected coordinate reference system bearings are calculated in
+# OUTPUTS:
+#    convergence angle, in degrees
+def calcGridConvergence(meta,crs):
+    centerX = meta['minX'] + meta['nCols']*meta['resolution']/2
+    centerY = meta['minY'] + meta['nRows']*meta['resolution']/2
+    lon, lat = Transformer.from_crs(meta['crs'],'EPSG:4326',always_xy=True).transform(centerX,centerY)
+    return(calcConvergence(crs,lon,lat))
+
+# calculate compass bearings (degrees clockwise from north) from points to vertices
+# INPUTS:
+#    px, py (float arrays) - point coordinates, in a projected crs
+#    vx, vy (float arrays) - vertex coordinates, in the same crs
+#    convergence (float) - degrees added to grid bearings to convert them to true bearings
+# OUTPUTS:
+#    float64 array of bearings in [0, 360)
+def calcBearings(px,py,vx,vy,convergence=0.0):
+    bearings = np.degrees(np.arctan2(np.asarray(vx) - px,np.asarray(vy) - py)) + convergence
+    return(np.mod(bearings,360.0))
+
+# convert bearings to 1 degree bins
+# INPUTS:
+#    bearings (float array) - bearings in degrees.  Values outside [0, 360) are wrapped
+# OUTPUTS:
+#    int16 array of bins in [0, 359]
+def bearingToBin(bearings):
+    return(np.mod(np.floor(np.asarray(bearings) + 0.5),N_BINS).astype(np.int16))
+
+# flatten feature geometries into vertex arrays.  Polygon vertices are the vertices of their rings
+# INPUTS:
+#    geoms (shapely geometry array) - features, in a projected crs
+# OUTPUTS:
+#    segments (dict) - vertex x and y arrays, and offsets where vertices for feature i are stored
+#                      in [offsets[i], offsets[i+1])
+def prepareSegments(geoms):
+    geoms = np.asarray(geoms)
+    coords, featureIndex = shapely.get_coordinates(geoms,return_index=True)
+    offsets = np.zeros(len(geoms) + 1,dtype=np.int64)
+    np.cumsum(np.bincount(featureIndex,minlength=len(geoms)),out=offsets[1:])
+    return({'x':coords[:,0],'y':coords[:,1],'offsets':offsets})
+
+# expand point/feature pairs into one row per feature vertex
+# INPUTS:
+#    segments (dict) - vertex arrays returned by prepareSegments
+#    pairFeature (int array) - feature index for each pair
+# OUTPUTS:
+#    vertexPair (int array) - pair index for each vertex row
+#    vertexIndex (int array) - index into the segments vertex arrays for each vertex row
+#    pairStarts (int array) - first vertex row for each pair
+def expandPairVertices(segments,pairFeature):
+    starts = segments['offsets'][pairFeature]
+    counts = segments['offsets'][pairFeature + 1] - starts
+    pairStarts = np.zeros(len(pairFeature),dtype=np.int64)
+    np.cumsum(counts[:-1],out=pairStarts[1:])
+    vertexPair = np.repeat(np.arange(len(pairFeature)),counts)
+    vertexIndex = np.repeat(starts - pairStarts,counts) + np.arange(counts.sum())
+    return(vertexPair,vertexIndex,pairStarts)
+
+# calculate the range of bearing bins covered by each point/feature pair.  Bearings to consecutive
+# vertices are unwrapped, so features that cross north are handled, and a feature that surrounds
+# the point covers all 360 bins.  Multipart features are assigned the smallest arc covering all parts
+# INPUTS:
+#    px, py (float arrays) - grid point coordinates, in the segments crs
+#    segments (dict) - vertex arrays returned by prepareSegments
+#    pairPoint (int array) - grid point index for each pair
+#    pairFeature (int array) - feature index for each pair
+#    convergence (float) - degrees added to grid bearings to convert them to true bearings
+# OUTPUTS:
+#    startBin (int16 array) - first bin covered by each pair
+#    nBins (int16 array) - number of consecutive bins (clockwise from startBin) covered by each pair
+def calcBinRanges(px,py,segments,pairPoint,pairFeature,convergence=0.0):
+    pairPoint = np.asarray(pairPoint)
+    pairFeature = np.asarray(pairFeature)
+    if(len(pairFeature) == 0):
+        return(np.zeros(0,dtype=np.int16),np.zeros(0,dtype=np.int16))
+    vertexPair, vertexIndex, pairStarts = expandPairVertices(segments,pairFeature)
+    vertexPoint = pairPoint[vertexPair]
+    bearings = calcBearings(np.asarray(px)[vertexPoint],np.asarray(py)[vertexPoint],
+                            segments['x'][vertexIndex],segments['y'][vertexIndex],convergence)
+
+    # unwrap bearings along each feature, relative to the bearing of the feature's first vertex
+    deltas = np.zeros(len(bearings))
+    deltas[1:] = np.mod(np.diff(bearings) + 180.0,360.0) - 180.0
+    deltas[pairStarts] = 0.0
+    unwrapped = np.cumsum(deltas)
+    unwrapped += np.repeat(bearings[pairStarts] - unwrapped[pairStarts],np.diff(np.append(pairStarts,len(bearings))))
+
+    minBearing = np.minimum.reduceat(unwrapped,pairStarts)
+    maxBearing = np.maximum.reduceat(unwrapped,pairStarts)
+    firstBin = np.floor(minBearing + 0.5)
+    lastBin = np.floor(maxBearing + 0.5)
+    nBins = np.minimum(lastBin - firstBin + 1,N_BINS)
+    startBin = np.where(nBins >= N_BINS,0,np.mod(firstBin,N_BINS))
+    return(startBin.astype(np.int16),nBins.astype(np.int16))
+
+# expand bin ranges into one row for each pair and bin
+# INPUTS:
+#    startBin (int array) - first bin covered by each pair
+#    nBins (int array) - number of bins covered by each pair
+# OUTPUTS:
+#    pairIndex (int array) - pair index for each row
+#    angleBin (int16 array) - bin for each row
+def expandBinRanges(startBin,nBins):
+    nBins = np.asarray(nBins,dtype=np.int64)
+    pairIndex = np.repeat(np.arange(len(nBins)),nBins)
+    rowStarts = np.cumsum(nBins) - nBins
+    withinPair = np.arange(nBins.sum()) - np.repeat(rowStarts,nBins)
+    angleBin = np.mod(np.repeat(np.asarray(startBin,dtype=np.int64),nBins) + withinPair,N_BINS)
+    return(pairIndex,angleBin.astype(np.int16))
+
+# split polygon features into straight edges.  Edges connect consecutive vertices of each ring,
+# so holes and the parts of multipart features are kept as separate closed rings
+# INPUTS:
+#    geoms (shapely polygon array) - features, in a projected crs
+# OUTPUTS:
+#    edges (dict) - edge start (x0, y0) and end (x1, y1) coordinate arrays, and offsets where
+#                   edges for feature i are stored in [offsets[i], offsets[i+1])
+def prepareEdges(geoms):
+    geoms = np.asarray(geoms)
+    parts, partFeature = shapely.get_parts(geoms,return_index=True)
+    rings, ringPart = shapely.get_rings(parts,return_index=True)
+    coords, vertexRing = shapely.get_coordinates(rings,return_index=True)
+
+    # an edge joins each vertex to the next vertex of the same ring
+    isEdge = vertexRing[:-1] == vertexRing[1:]
+    edgeFeature = partFeature[ringPart[vertexRing[:-1][isEdge]]]
+    offsets = np.zeros(len(geoms) + 1,dtype=np.int64)
+    np.cumsum(np.bincount(edgeFeature,minlength=len(geoms)),out=offsets[1:])
+    edges = {
+        'x0':coords[:-1,0][isEdge],
+        'y0':coords[:-1,1][isEdge],
+        'x1':coords[1:,0][isEdge],
+        'y1':coords[1:,1][isEdge],
+        'offsets':offsets
+    }
+    return(edges)
+
+# calculate the distance from points to the part of each edge within each bearing bin the edge covers.
+# The nearest point of an edge within a bin is an edge endpoint inside the bin, the crossing of the
+# edge with one of the bin's two boundary rays, or the foot of the perpendicular from the point
+# INPUTS:
+#    px, py (float arrays) - grid point coordinates, in the edges crs
+#    edges (dict) - edge arrays returned by prepareEdges
+#    pairPoint (int array) - grid point index for each pair
+#    pairFeature (int array) - feature index for each pair
+#    convergence (float) - degrees added to grid bearings to convert them to true bearings
+# OUTPUTS:
+#    rowPoint (int array) - grid point index for each row
+#    angleBin (int16 array) - bin for each row
+#    dist (float64 array) - distance from the grid point to the edge within the bin
+def calcEdgeBinDistances(px,py,edges,pairPoint,pairFeature,convergence=0.0):
+    pairPoint = np.asarray(pairPoint)
+    starts = edges['offsets'][np.asarray(pairFeature)]
+    counts = edges['offsets'][np.asarray(pairFeature) + 1] - starts
+    edgePoint = np.repeat(pairPoint,counts)
+    edgeIndex = np.repeat(starts - (np.cumsum(counts) - counts),counts) + np.arange(counts.sum())
+
+    # edge endpoints relative to the grid point
+    ax = edges['x0'][edgeIndex] - np.asarray(px)[edgePoint]
+    ay = edges['y0'][edgeIndex] - np.asarray(py)[edgePoint]
+    dx = edges['x1'][edgeIndex] - edges['x0'][edgeIndex]
+    dy = edges['y1'][edgeIndex] - edges['y0'][edgeIndex]
+
+    # bins covered by each edge.  Bearings along a straight edge change monotonically
+    bearingA = calcBearings(0.0,0.0,ax,ay,convergence)
+    bearingB = calcBearings(0.0,0.0,ax + dx,ay + dy,convergence)
+    sweep = np.mod(bearingB - bearingA + 180.0,360.0) - 180.0
+    firstBin = np.floor(np.minimum(bearingA,bearingA + sweep) + 0.5)
+    lastBin = np.floor(np.maximum(bearingA,bearingA + sweep) + 0.5)
+    rowEdge, angleBin = expandBinRanges(np.mod(firstBin,N_BINS),lastBin - firstBin + 1)
+    ax, ay, dx, dy = ax[rowEdge], ay[rowEdge], dx[rowEdge], dy[rowEdge]
+    binA = bearingToBin(bearingA[rowEdge])
+    binB = bearingToBin(bearingB[rowEdge])
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+
+        # edge endpoints that fall inside the bin
+        dist = np.where(binA == angleBin,np.hypot(ax,ay),np.inf)
+        dist = np.where(binB == angleBin,np.minimum(dist,np.hypot(ax + dx,ay + dy)),dist)
+
+        # crossings of the edge with the rays bounding the bin
+        for side in [-0.5,0.5]:
+            theta = np.radians(angleBin + side - convergence)
+            ux, uy = np.sin(theta), np.cos(theta)
+            denom = ux*dy - uy*dx
+            t = (ax*uy - ay*ux)/denom
+            s = (ax*dy - ay*dx)/denom
+            valid = (t >= 0) & (t <= 1) & (s >= 0)
+            dist = np.where(valid,np.minimum(dist,s),dist)
+
+        # foot of the perpendicular from the grid point, when it lies on the edge and inside the bin
+        t = -(ax*dx + ay*dy)/(dx*dx + dy*dy)
+        fx, fy = ax + t*dx, ay + t*dy
+        valid = (t > 0) & (t < 1) & (bearingToBin(calcBearings(0.0,0.0,fx,fy,convergence)) == angleBin)
+        dist = np.where(valid,np.minimum(dist,np.hypot(fx,fy)),dist)
+    return(edgePoint[rowEdge],angleBin,dist)
+
+# find the nearest feature distance within each bearing bin around each grid point, a 1D z-buffer
+# over bearing.  Points that touch or fall inside a feature are 0m from a feature in every bin
+# INPUTS:
+#    px, py (float arrays) - grid point coordinates, in the edges crs
+#    edges (dict) - edge arrays returned by prepareEdges
+#    pairPoint (int array) - grid point index for each pair
+#    pairFeature (int array) - feature index for each pair
+#    pairDist (float array) - distance between the grid point and the whole feature for each pair
+#    maxDist (float) - distance assigned to bins without a feature closer than maxDist
+#    convergence (float) - degrees added to grid bearings to convert them to true bearings
+# OUTPUTS:
+#    float32 array with one row for each grid point and one column for each bin
+def calcNearestBinDistances(px,py,edges,pairPoint,pairFeature,pairDist,maxDist,convergence=0.0):
+    nearest = np.full((len(px),N_BINS),maxDist,dtype=np.float32)
+    isInside = np.asarray(pairDist) <= 0
+    rowPoint, angleBin, dist = calcEdgeBinDistances(px,py,edges,np.asarray(pairPoint)[~isInside],
+                                                    np.asarray(pairFeature)[~isInside],convergence)
+    np.minimum.at(nearest.reshape(-1),rowPoint*N_BINS + angleBin,dist.astype(np.float32))
+    nearest[np.asarray(pairPoint)[isInside]] = 0
+    return(nearest)
+
+# find the bearing bins covered by each feature around a single grid point
+# INPUTS:
+#    px, py (float) - grid point coordinates, in a projected crs
+#    geoms (shapely geometry array) - features, in the same crs
+#    convergence (float) - degrees added to grid bearings to convert them to true bearings
+# OUTPUTS:
+#    featureIndex (int array) - index of the feature in geoms for each row
+#    angleBin (int16 array) - bin for each row.  Features covering several bins have several rows
+def calcFeatureBins(px,py,geoms,convergence=0.0):
+    segments = prepareSegments(geoms)
+    pairFeature = np.arange(len(segments['offsets']) - 1)
+    startBin, nBins = calcBinRanges(np.array([px]),np.array([py]),segments,
+                                    np.zeros(len(pairFeature),dtype=np.int64),pairFeature,convergence)
+    return(expandBinRanges(startBin,nBins))
@@ -2,198 +2,113 @@
 # Author: Andrew Larkin
 # Date Created: March 22, 2024
 # Summary: Find the nearest building at each angular degreee for a large set of grid points n=6.5 million).
-# To speed up computation, the grid is partitioned into subset shapefiles with 1000 points in each shapefile.  
-# Subsets can then be independently processed (data parallelism)
+# To speed up computation, the grid is partitioned into batches with 1000 points in each batch.
+# Subsets can then be independently processed (data parallelism).  Within a batch, distances for all
+# 360 degrees are calculated in a single angular sweep over the edges of nearby buildings
 
 # import libraries
 from multiprocessing import Pool
 import os
-import time
+import sys
 import random
-import warnings
-warnings.simplefilter(action='ignore', category=FutureWarning)
-
-# needed when using the ArcGIS license for a large # of parallel threads
-sucessfulImport = False
-while(sucessfulImport == False):
-    try:
-        import arcpy
-        from arcpy.ia import * 
-        from arcpy import env
-        from arcpy.sa import *
-        arcpy.env.overwriteOutput = True
-        arcpy.CheckOutExtension("Spatial")
-        sucessfulImport = True
-    except Exception as e:
-        print("couldn't import arcgis: %s" %(str(e)))
-        time.sleep(1)
-
-# my current version of Arcpy doesn't correctly import unless it preceeds the pandas import
-import pandas as ps
+import numpy as np
+import nearTableEngine
+import angularBins
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
 
 
 # define global constants
 BUILDINGS = "H:/Noise/building/buildingMergedDissolve2/buildingMergedDissolve2.shp"
-POINT_ANGLE_FOLDER = "J:/w2"
-POINT_PARTITION_FOLDER = "J:/screenedFishnet/"
+POINT_STORE_FOLDER = "J:/pointStore/"
 OUTPUT_FOLDER = "Z:/Noise/bldgDist/"
+SEARCH_RADIUS = 2000 # distance assigned to angles without a building within 2000m
+POINT_CHUNK_SIZE = 25 # number of grid points swept at once.  Bounds memory used by building edges
 N_CPUS = 12
 
+# distances are calculated in a local projected crs (UTM zone 10N) rather than geodesically.
+# Planar and geodesic distances differ by far less than 1m within 2km (see validatePlanarDistances.py)
+
+# buildings, spatial index, building edges, and grid convergence, loaded once per worker process
+bldgLayer = None
+bldgEdges = None
+convergence = None
+
 ########## HELPER FUNCTIONS #############
 
-# given a single point within a grid and a single angle, determine closest building that intersects the angle
-# INPUTS:
-#    angleFile (str) - absolute filepath of shapefile containing polygons that represent
-#                      radial angles of a point
-#    monitorFile (str) - absolute filepath of shapefile containing points of interest
-#    buildings (str) - absolute filepath of shapefile containing building footprints
-#    outputFile (str) - absolute filepath where results should be stored in .csv format
-#    fileSig (str) - nomenclature indicating which batch of points is currently being analyzed (e.g. b1000 for points 1000-1999)
-def calcDistToNearestBldg(angleFile,monitorFile,monitorNum,buildings,outputFile,fileSig):
-    
-    monitorIndicator = 'FID_w' + str(monitorNum) # attribute field value extracted from the angleFile attribute table
-
-    # select the current grid point from the shapefile containing 1000 grid points
-    selectedGridPoint = arcpy.management.SelectLayerByAttribute(
-        in_layer_or_view=monitorFile,
-        selection_type="NEW_SELECTION",
-        where_clause="FID = " + str(monitorNum),
-        invert_where_clause=None
-    )
-
-    # select only buildings within 2000m of the selected grid point
-    buildingSubset = arcpy.management.SelectLayerByLocation(
-        in_layer=buildings,
-        overlap_type="WITHIN_A_DISTANCE",
-        select_features=selectedGridPoint,
-        search_distance="2000 Meters",
-        selection_type="NEW_SELECTION",
-        invert_spatial_relationship="NOT_INVERT"
-    )
-
-    #intersect the selected buildings and radial angles - this assigns one or more radial angles to each building
-    intersects = "in_memory/testJoin".format(fileSig)
-    arcpy.analysis.Intersect([buildingSubset,angleFile], intersects, "", "", "INPUT")
-
-    # convert the intersect analysis from a feature class to a pandas dataframe
-    cols = ['FID','FID_buildingMergedDissolve2',monitorIndicator]
-    intersectData = ps.DataFrame(arcpy.da.FeatureClassToNumPyArray(in_table=intersects, field_names=cols, skip_nulls=False, null_value=-99999))
-
-    # calculate distance between selected buildings and the selected grid point
-    TempTab = 'in_memory\\{}_Table'.format(fileSig)
-    arcpy.analysis.GenerateNearTable(
-        in_features=selectedGridPoint,
-        near_features=intersects,
-        out_table=TempTab,
-        search_radius='#',
-        location="NO_LOCATION",
-        angle="NO_ANGLE",
-        closest="ALL",
-        closest_count='#',
-        method="GEODESIC",
-        distance_unit="Meters"
-        )
-    
-    # conver the distance calculation to a pandas dataframe
-    cols = ['NEAR_FID', 'NEAR_DIST']
-    dists = ps.DataFrame(arcpy.da.FeatureClassToNumPyArray(in_table=TempTab, field_names=cols, skip_nulls=False, null_value=-99999))
-
-    # join the distance and identified angle dataframes
-    merged = intersectData.merge(dists,how='right',left_on='FID',right_on='NEAR_FID')
-    merged.sort_values(by=['NEAR_DIST',monitorIndicator],ascending=True,inplace=True)
-    merged.drop_duplicates(subset=[monitorIndicator],inplace=True)
-    merged.sort_values(by=[monitorIndicator],ascending=True,inplace=True)
-    merged['angle'] = merged[monitorIndicator]
-    merged['dist'] = merged['NEAR_DIST']
-    merged = merged[['angle','dist']]
-
-    # for angles without any buildings within 2000m, assign a default value of 2000
-    filler = ps.DataFrame({
-        'angle': [x for x in range(360)],
-        'dist':[2000 for x in range(360)]
-    })
-    merged = ps.concat([merged,filler])
-    merged.sort_values(by=['dist','angle'],ascending=True,inplace=True)
-    merged.drop_duplicates(subset=['angle'],inplace=True)
-    merged.sort_values(by=['angle'],ascending=True,inplace=True)
-    merged['monitor'] = [monitorNum for x in range(360)]
-
-    # arcpy for some reason can hang onto intermediate files even after the function instance is closed. 
-    # prevent memory leaks by explicitly deleting intermediate files
-    arcpy.management.Delete(TempTab)
-    arcpy.management.Delete(intersects)
-    arcpy.management.Delete(selectedGridPoint)
-    arcpy.management.Delete(buildingSubset)
-
-    # save distance and angle information to csv
-    merged.to_csv(outputFile,index=False)
-
-# given an absolute folder filepath, find files within the folder
-# with a 'shp' extension, and return the absolute filepaths to 'shp' files
+# load buildings into memory, build the spatial index, and split buildings into edges.  Called once
+# when each worker process starts
+def initWorker():
+    global bldgLayer, bldgEdges, convergence
+    bldgLayer = nearTableEngine.loadNearLayer(BUILDINGS)
+    bldgEdges = angularBins.prepareEdges(bldgLayer['geometry'])
+    convergence = angularBins.calcGridConvergence(gridPointStore.loadMeta(POINT_STORE_FOLDER),bldgLayer['crs'])
+
+# calculate distance to the nearest building in each radial angle, for a set of grid points
 # INPUTS:
-#    folder (str) - absolute filepath to the folder containing the shp files
+#    x (float array) - x coordinates of grid points, in the building layer crs
+#    y (float array) - y coordinates of grid points, in the building layer crs
+#    layer (dict) - building layer returned by nearTableEngine.loadNearLayer.  May be a subset of buildings
+#    edges (dict) - building edges returned by angularBins.prepareEdges, in layer order
+#    convergence (float) - degrees added to grid bearings to convert them to true bearings
+#    pointChunkSize (int) - number of grid points swept at once
 # OUTPUTS:
-#    an array of absolute filepaths to 'shp' files within the folder
-def findShapefiles(folder):
-    candidateFiles = os.listdir(folder)
-    screenedFiles = []
-    for file in candidateFiles:
-        if file[-3:] == 'shp':
-            screenedFiles.append(folder + "/" + file)
-    return(screenedFiles)
-
-# given a shapefile with 1000 points, calculate distance to nearest building for each radial angle,
-# for each point in the shapefile
+#    float32 array with one row for each grid point and one column for each angle (0-359).
+#    Angles without a building within SEARCH_RADIUS are assigned SEARCH_RADIUS
+def calcNearestBldgDists(x,y,layer,edges,convergence,pointChunkSize=POINT_CHUNK_SIZE):
+    bldgDists = np.zeros((len(x),angularBins.N_BINS),dtype=np.float32)
+    for start in range(0,len(x),pointChunkSize):
+        end = min(start + pointChunkSize,len(x))
+
+        # buildings within 2000m of each grid point in the chunk.  Building ids are converted to
+        # positions in the layer, as the layer may only contain a subset of buildings
+        nearTable = nearTableEngine.queryNearTable(layer,x[start:end],y[start:end],SEARCH_RADIUS)
+        bldgDists[start:end] = angularBins.calcNearestBinDistances(
+            x[start:end],y[start:end],edges,nearTable['IN_FID'],
+            nearTableEngine.getFeaturePositions(layer,nearTable['NEAR_FID']),nearTable['NEAR_DIST'],SEARCH_RADIUS,convergence
+        )
+    return(bldgDists)
+
+# given a batch of 1000 points, calculate distance to nearest building for each radial angle,
+# for each point in the batch
 # INPUTS:
-#    fileSig (str) - unique identifier for each shapefile in a set of shapefiles, all contained within 
-#                    the same folder (e.g. b1000 for points 1000-1999)
+#    fileSig (str) - unique identifier for each batch of grid points in the point store
+#                    (e.g. b1000 for points 1000-1999)
 def calcDistToNearestBldgSig(fileSig):
 
-    # each point in the shapefile has a second shapefile containing triangle polygons, one polygon for
-    # each radial angle
-    shpFiles = findShapefiles(POINT_ANGLE_FOLDER + "/" + fileSig)
-
-    # shapefile containing the 1000 grid points
-    monitorFile =  POINT_PARTITION_FOLDER + fileSig + ".shp"
-    outputFolder = OUTPUT_FOLDER + fileSig
-    if not(os.path.exists(outputFolder)):
-        os.mkdir(outputFolder)
-
-    # for each of the 1000 grid points, identify the buildings for each radial angle, and calculate
-    # distance to nearest building within each angle
-    for index in range(1000):
-
-        # print progress indicator to screen for every 100 points (10%) that are processed
-        if(index%100==0):
-            print("processing monitor %i for file Sig %s" %(index,fileSig))
-
-        angleFile = POINT_ANGLE_FOLDER + "/" + fileSig + "/w" + str(index) + ".shp"
-        if(angleFile in shpFiles):
-            outputFile = outputFolder + "/bldg" + str(index) + ".csv"
-            if not(os.path.exists(outputFile)):
-                calcDistToNearestBldg(
-                    angleFile,
-                    monitorFile,
-                    index,
-                    BUILDINGS,
-                    outputFile,
-                    fileSig
-                )
-        
+    # if the batch has already been processed, return early to avoid redundant processing
+    outputFile = OUTPUT_FOLDER + fileSig + ".npy"
+    if os.path.exists(outputFile):
+        print("%s has already been processed" %(fileSig))
+        return
+    print("processing file Sig %s" %(fileSig))
+
+    # project the batch of grid points into the building layer crs
+    store = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    batch = gridPointStore.getBatch(store,fileSig)
+    x, y = nearTableEngine.projectPoints(batch['x'],batch['y'],store['meta']['crs'],bldgLayer['crs'])
+    bldgDists = calcNearestBldgDists(x,y,bldgLayer,bldgEdges,convergence)
+
+    # write under a temporary name so partially written batches are never mistaken as complete
+    with open(outputFile + '.tmp','wb') as outFile:
+        np.save(outFile,bldgDists)
+    os.replace(outputFile + '.tmp',outputFile)
+
 ####################### MAIN FUNCTION ##################
 
 if __name__ == '__main__':
 
-    # get list of point subset shapefiles
-    fileSigs = os.listdir(POINT_ANGLE_FOLDER)
+    # get list of grid point batches
+    fileSigs = gridPointStore.listBatchSigs(gridPointStore.loadPointStore(POINT_STORE_FOLDER))
 
-    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload 
+    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload
     # uniformly across cpus when the error is corrected and the script is restarted
     random.shuffle(fileSigs)
 
-    # create a pool of workers, one worker for each free CPU.  I wouldn't recommend going above the CPU
-    # count via hyperthreading, arcpy performance doesn't seem to work well when worker count goes above
-    # physical core count
-    pool = Pool(processes=N_CPUS)
+    # create a pool of workers, one worker for each free CPU.  Each worker loads and indexes the
+    # buildings once, and reuses them for every batch it processes
+    pool = Pool(processes=N_CPUS,initializer=initWorker)
     res = pool.map_async(calcDistToNearestBldgSig,fileSigs)
-    res.get()
\ No newline at end of file
+    res.get()
@@ -2,116 +2,98 @@
 # Author: Andrew Larkin
 # Date Created: March 25th, 2024
 # Summary: For each point in a grid, calculate the angular relationship between
-#          the point and all 10m road segments within 2km
+#          the point and all 10m road segments within 2km.  Angle bins are calculated
+#          for a whole batch of grid points at once from the batch's road near table,
+#          and saved as one file per batch
 
 # import libraries
 from multiprocessing import Pool
 import os
-import time
-import math 
-import numpy as np
+import sys
 import random
-import pandas as ps
-import warnings
-warnings.simplefilter(action='ignore', category=FutureWarning)
+import numpy as np
+import nearTableEngine
+import nearTableCSR
+import angularBins
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
 
 # define global constants
-ANGLE_PARENT_FOLDER = "E:/Noise/wind/"
+NEAR_FOLDER = "F:/Noise/near/" # road near tables created by genNearTableParallel.py
 OUTPUT_PARENT_FOLDER = "E:/Noise/rdAngle/"
-OUTPUT_BACKUP_FOLDER = "Y:/Noise/rdAngle/" # needed because files were too large to store on a single drive
-GRID_FOLDER = "D:/Noise/screenedFishnet/"
+POINT_STORE_FOLDER = "D:/Noise/pointStore/"
 ROAD_NETWORK = "D:/Noise/Roads/PDX10m.shp"
+PAIR_CHUNK_SIZE = 2000000 # number of point/road pairs processed at once.  Bounds memory use
+N_CPUS = 16
 
-# needed when using the ArcGIS license for a large # of parallel threads
-sucessfulImport = False
-while(sucessfulImport == False):
-    try:
-        #print("try again")
-        import arcpy
-        from arcpy.ia import * 
-        from arcpy import env
-        from arcpy.sa import *
-        arcpy.env.overwriteOutput = True
-        arcpy.CheckOutExtension("Spatial")
-        sucessfulImport = True
-    except Exception as e:
-        print("couldn't import arcgis: %s" %(str(e)))
-        time.sleep(1)
-
+# road ids, road segment vertices and grid convergence, loaded once per worker process
+roadLayer = None
+roadSegments = None
+convergence = None
 
 ########## HELPER FUNCTIONS #############
 
-# calculate angles between a single monitor and all road segments within 2km
+# load road segment vertices into memory.  Called once when each worker process starts
+def initWorker():
+    global roadLayer, roadSegments, convergence
+    roadLayer = nearTableEngine.loadNearLayer(ROAD_NETWORK)
+    roadSegments = angularBins.prepareSegments(roadLayer['geometry'])
+
+    # bearings are measured from true north, matching the geodesic wedges used previously
+    convergence = angularBins.calcGridConvergence(gridPointStore.loadMeta(POINT_STORE_FOLDER),roadLayer['crs'])
+
+# calculate the angle bins covered by each road segment in a batch's near table
+# INPUTS:
+#    x (float array) - x coordinates of grid points in the batch, in the road network crs
+#    y (float array) - y coordinates of grid points in the batch, in the road network crs
+#    nearTable (dict) - road near table for the batch, returned by nearTableCSR.openNearTable
+#    pairChunkSize (int) - number of point/road pairs processed at once
+# OUTPUTS:
+#    int16 array with one row for each near table pair, in near table order.  Column 0 is the
+#    first angle bin covered by the road segment, column 1 is the number of consecutive bins covered
+def calcBatchRoadAngles(x,y,nearTable,pairChunkSize=PAIR_CHUNK_SIZE):
+    inFid = nearTableCSR.getInFid(nearTable)
+    rdAngles = np.zeros((nearTable['nPairs'],2),dtype=np.int16)
+    for start in range(0,nearTable['nPairs'],pairChunkSize):
+        end = start + pairChunkSize
+
+        # road ids are converted to positions in the road layer
+        pairFeature = nearTableEngine.getFeaturePositions(roadLayer,nearTable['NEAR_FID'][start:end])
+        startBin, nBins = angularBins.calcBinRanges(x,y,roadSegments,inFid[start:end],pairFeature,convergence)
+        rdAngles[start:end,0] = startBin
+        rdAngles[start:end,1] = nBins
+    return(rdAngles)
+
+# claculate angles between road segments and all grid points in a batch
 # INPUTS:
-#    monitorNum (int) - monitor index within the shapefile (e.g. 1,2,...999)
-#    monitorShp (str) - absolute filepath to shapefile containing grid points
-#    roadFile (str) - absolute filepath to shapefile containing road network
-#    angleFile (str) - absolute filepath to shapefile containing angular degrees
-#                      radiating outward from the selected grid point
-#    outputFile (str) - absolute filepath where results should be stored in .csv format
-#    fileSig (str) - unique indicator for the shapefile 
-#                    (e.g. b1000 for shapefile containing gird points 1000-1999)
-def calcRoadAngle(pointNum,monitorShp,roadFile,angleFile,outputFile,fileSig):
-
-    # unique identifier in attribute tables for the selected point
-    pointIndicator = 'FID_w' + str(pointNum)
-
-    # select the point of interest from the grid shapefile
-    selectedPoint = arcpy.management.SelectLayerByAttribute(
-        in_layer_or_view=monitorShp,
-        selection_type="NEW_SELECTION",
-        where_clause="FID = " + str(pointNum),
-        invert_where_clause=None
-    )
-
-    # restrict roads to within 2km of the selected point
-    roadSubset = arcpy.management.SelectLayerByLocation(
-        in_layer=roadFile,
-        overlap_type="WITHIN_A_DISTANCE",
-        select_features=selectedPoint,
-        search_distance="2000 Meters",
-        selection_type="NEW_SELECTION",
-        invert_spatial_relationship="NOT_INVERT"
-    )
-
-    # overlap road segments with angles radiating outward from grid point.
-    # this gets the angle of each road segment relative to the grid point
-    intersects = "in_memory/RdJoin".format(fileSig)
-    arcpy.analysis.Intersect([roadSubset,angleFile], intersects, "", "", "INPUT")
-    
-    # convert the columns of interest to a pandas dataframe 
-    cols = ['osm_id','FID_PDX10m',pointIndicator]
-    rdAngles = ps.DataFrame(arcpy.da.FeatureClassToNumPyArray(in_table=intersects, field_names=cols, skip_nulls=False, null_value=-99999))
-    rdAngles.sort_values(by=[pointIndicator,'FID_PDX10m'],inplace=True)
-    rdAngles.rename(columns={pointIndicator:'angle'},inplace=True)
-    rdAngles.to_csv(outputFile,index=False)
-
-    # clean up. Can't count on arcpy to release intermediates after exiting the function
-    arcpy.management.Delete(roadSubset)
-    arcpy.management.Delete(selectedPoint)
-    arcpy.management.Delete(intersects)
-
-# claculate angles between road segments and all grid points in a shapefile
+#    fileSig (str) - unique identifier for a batch of grid points (e.g. b1000 for points 1000-1999)
 def processSingleSig(fileSig):
+
+    # if the batch has already between processed, return early to avoid redundant processing
+    outputFile = OUTPUT_PARENT_FOLDER + fileSig + ".npy"
+    if os.path.exists(outputFile):
+        print("%s has already been processed" %(fileSig))
+        return
+
+    # road segments within 2km of each grid point are listed in the batch's near table
+    nearFile = NEAR_FOLDER + fileSig + nearTableCSR.FILE_EXTENSION
+    if not(nearTableCSR.isNearTableComplete(nearFile)):
+        print("can't calculate road angles for fileSig %s: dist to road not available" %(fileSig))
+        return
     print("processing fileSig %s" %(fileSig))
-    angleFolder = ANGLE_PARENT_FOLDER+ fileSig + "/"
-    outputFolder = OUTPUT_PARENT_FOLDER + fileSig + "/"
-    pointsShp = GRID_FOLDER + fileSig + ".shp"
-    if not os.path.exists(outputFolder):
-        os.mkdir(outputFolder)
-
-    # each shapefile contains up to 1000 grid points.
-    # for each point, calculate the angles between nearby roads and the point
-    for monitorNum in range(1000):
-        windFile = angleFolder + "w" + str(monitorNum) + ".shp"
-        outputFile = outputFolder + "a" + str(monitorNum) + ".csv" 
-        fileBackup = OUTPUT_BACKUP_FOLDER + fileSig + "/" + str(monitorNum) + ".csv"
-
-        # if the monitor has already between processed, continue to the next monitor to avoid
-        # redundant processing
-        if os.path.exists(windFile) and not os.path.exists(outputFile):
-            if not(os.path.exists(fileBackup)):
-                calcRoadAngle(monitorNum,pointsShp,ROAD_NETWORK,windFile,outputFile,fileSig)
+
+    # project the batch of grid points into the road network crs
+    store = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    batch = gridPointStore.getBatch(store,fileSig)
+    x, y = nearTableEngine.projectPoints(batch['x'],batch['y'],store['meta']['crs'],nearTableEngine.NEAR_CRS)
+    rdAngles = calcBatchRoadAngles(x,y,nearTableCSR.openNearTable(nearFile))
+
+    # write under a temporary name so partially written batches are never mistaken as complete
+    with open(outputFile + '.tmp','wb') as outFile:
+        np.save(outFile,rdAngles)
+    os.replace(outputFile + '.tmp',outputFile)
     print("completed processing filesig %s" %(fileSig))
 
 
@@ -119,16 +101,15 @@ def processSingleSig(fileSig):
 ####################### MAIN FUNCTION ##################
 if __name__ == '__main__':
 
-    # get list of point subset shapefiles
-    fileSigs = os.listdir(ANGLE_PARENT_FOLDER)
+    # get list of grid point batches
+    fileSigs = gridPointStore.listBatchSigs(gridPointStore.loadPointStore(POINT_STORE_FOLDER))
 
-    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload 
+    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload
     # uniformly across cpus when the error is corrected and the script is restarted
     random.shuffle(fileSigs)
 
-    # create a pool of workers, one worker for each free CPU.  I wouldn't recommend going above the CPU
-    # count via hyperthreading, arcpy performance doesn't seem to work well when worker count goes above
-    # physical core count
-    pool = Pool(processes=50)
+    # create a pool of workers, one worker for each free CPU.  Each worker loads the road network
+    # once, and reuses it for every batch it processes
+    pool = Pool(processes=N_CPUS,initializer=initWorker)
     res = pool.map_async(processSingleSig,fileSigs)
-    res.get()
\ No newline at end of file
+    res.get()
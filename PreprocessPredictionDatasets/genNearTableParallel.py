@@ -1,110 +1,78 @@
 # genNearTableParallel.py
 # Author: Andrew Larkin
 # Date Created: March 25th, 2024
-# Summary: calculate distance to road segments within a set distance 
-#          from each grid point.  Used for deriving buffer variable 
-#          estimates.  
+# Summary: calculate distance to road segments within a set distance
+#          from each grid point.  Used for deriving buffer variable
+#          estimates.  The road network is loaded and spatially indexed
+#          once per worker, and does not require an ArcGIS license
 
 # import libraries
 from multiprocessing import Pool
 import os
-import time
+import sys
 import random
+import nearTableEngine
+import nearTableCSR
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
 
 # define global constants
-INPUT_FOLDER = "H:/Noise/implementation/screenedFishnet/"
+POINT_STORE_FOLDER = "H:/Noise/implementation/pointStore/"
 NEAR_FOLDER = "F:/Noise/near/"
 ROADS = "H:/Noise/implementation/PDX10m.shp"
+SEARCH_RADIUS = 2000 # maximum distance between grid points and road segments, in meters
 N_CPUS = 16
 
-sucessfulImport = False
-# needed when using the ArcGIS license for a large # of parallel threads
-while(sucessfulImport == False):
-    try:
-        #print("try again")
-        import arcpy
-        from arcpy.ia import * 
-        from arcpy import env
-        from arcpy.sa import *
-        arcpy.env.overwriteOutput = True
-        arcpy.CheckOutExtension("Spatial")
-        sucessfulImport = True
-    except Exception as e:
-        print("couldn't import arcgis: %s" %(str(e)))
-        time.sleep(1)
-
-# my current version of Arcpy doesn't correctly import unless it preceeds the pandas import
-import pandas as ps
-
+# road network and spatial index, loaded once per worker process
+roadLayer = None
 
 ########## HELPER FUNCTIONS #############
 
+# load the road network into memory and build the spatial index.  Called once when each
+# worker process starts
+def initWorker():
+    global roadLayer
+    roadLayer = nearTableEngine.loadNearLayer(ROADS)
 
-# calculate distance between grid points and road segments 
+# calculate distance between grid points and road segments
 # INPUTS:
-#    pointsShapefile (str) - relative filepath to shapefile containing grid points
-def generateNearTableSingle(pointsShapefile):
+#    fileSig (str) - unique identifier for a batch of grid points (e.g. b1000 for points 1000-1999)
+def generateNearTableSingle(fileSig):
 
-    # look to see if the shapefile has already been processed.  
+    # look to see if the batch has already been processed.
     # If so, return early to avoid redundant processing
-    outputFile = NEAR_FOLDER + pointsShapefile[:-4] + ".csv"
-    if(os.path.exists(outputFile)):
-        nearData = ps.read_csv(outputFile)
-        if(999 in list(set(nearData['IN_FID'])) or pointsShapefile == 'b0.shp'):
-            print("%s has already been processed" %(pointsShapefile))
-            return
-
-    # calculate distance between road network and grid points 
-    nearFeatures = "in_memory/inMemoryFeatureClass" + pointsShapefile[:-4]
-    #arcpy.CopyFeatures_management(ROADS, nearFeatures)
-    a = arcpy.analysis.GenerateNearTable(
-        in_features=INPUT_FOLDER + pointsShapefile,
-        near_features=ROADS,
-        out_table= outputFile,
-        search_radius='2000 Meters',
-        location="NO_LOCATION",
-        angle="NO_ANGLE",
-        closest="ALL",
-        closest_count='#',
-        method="GEODESIC",
-        distance_unit="Meters"
-    )
+    outputFile = NEAR_FOLDER + fileSig + nearTableCSR.FILE_EXTENSION
+    if(nearTableCSR.isNearTableComplete(outputFile)):
+        print("%s has already been processed" %(fileSig))
+        return
 
-    # clean up.  Arcpy doesn't always remove temporary variables after completing the function call
-    arcpy.management.Delete(nearFeatures)
+    # project the batch of grid points into the road network crs
+    store = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    batch = gridPointStore.getBatch(store,fileSig)
+    x, y = nearTableEngine.projectPoints(batch['x'],batch['y'],store['meta']['crs'],roadLayer['crs'])
 
-    nearData = ps.read_csv(outputFile)
-    nearData = nearData[['IN_FID','NEAR_FID','NEAR_DIST']]
-    nearData.to_csv(outputFile,index=False)
-
-# given an array of filenames, find only files with a 'shp' extension
-# INPUTS:
-#    filesToProcess (str array) - list of files to filter
-# OUTPUTS:
-#    list of files with an 'shp' extension
-def processFiles(filesToProcess):
-    screenedFiles = []
-    for file in filesToProcess:
-        if file[-3:] == 'shp':
-            screenedFiles.append(file)
-    return(screenedFiles)
+    # calculate distance between road network and grid points
+    nearTable = nearTableEngine.queryNearTable(roadLayer,x,y,SEARCH_RADIUS)
+    nearTableCSR.writeNearTable(outputFile,nearTable['IN_FID'],nearTable['NEAR_FID'],
+                                nearTable['NEAR_DIST'],len(batch['x']))
 
 ####################### MAIN FUNCTION ##################
 if __name__ == '__main__':
-    
-    # get list of point subset shapefiles 
-    filesToProcess = processFiles(os.listdir(INPUT_FOLDER))
-    # filesToProcess = ['b0.shp','b1000.shp','b2000.shp','b3000.shp','b4000.shp',
-    #                   'b5000.shp','b6000.shp','b7000.shp','b8000.shp','b9000.shp',
-    #                   'b10000.shp']
 
-    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload 
+    # get list of grid point batches
+    filesToProcess = gridPointStore.listBatchSigs(gridPointStore.loadPointStore(POINT_STORE_FOLDER))
+    # filesToProcess = ['b0','b1000','b2000','b3000','b4000',
+    #                   'b5000','b6000','b7000','b8000','b9000',
+    #                   'b10000']
+
+    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload
     # uniformly across cpus when the error is corrected and the script is restarted
     random.shuffle(filesToProcess)
-    
-    # create a pool of workers, one worker for each free CPU.  I wouldn't recommend going above the CPU
-    # count via hyperthreading, arcpy performance doesn't seem to work well when worker count goes above
-    # physical core count
-    pool = Pool(processes=N_CPUS)
+
+    # create a pool of workers, one worker for each free CPU.  Each worker loads and indexes
+    # the road network once, and reuses it for every batch it processes
+    pool = Pool(processes=N_CPUS,initializer=initWorker)
     res = pool.map_async(generateNearTableSingle,filesToProcess)
     res.get()
@@ -0,0 +1,141 @@
+# nearTableCSR.py
+# Summary: read and write near tables in a compact binary layout (compressed sparse rows).
+#          Each file holds the near table for one batch of grid points:
+#              header (64 bytes) - format tag, number of points, number of point/feature pairs
+#              offsets (int64, nPoints + 1) - pairs for point i are stored in [offsets[i], offsets[i+1])
+#              NEAR_FID (int32, nPairs) - feature id of each pair
+#              NEAR_DIST (float32, nPairs) - distance of each pair, sorted ascending within each point
+#          Files are memory-mapped when read, so selecting the features near a point is a slice
+
+# import libraries
+import os
+import numpy as np
+import pandas as ps
+
+# define global constants
+FORMAT_TAG = b'PDXNEAR1'
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([('tag','S8'),('nPoints','<i8'),('nPairs','<i8')])
+FILE_EXTENSION = '.near'
+
+########## HELPER FUNCTIONS #############
+
+# write a near table to disk.  The file is written under a temporary name and renamed once
+# complete, so an existing file with a valid header is always a finished near table
+# INPUTS:
+#    outputFile (str) - absolute filepath where the near table will be written
+#    inFid (int array) - position of the grid point in the batch for each pair
+#    nearFid (int array) - feature id for each pair
+#    nearDist (float array) - distance between the grid point and feature for each pair
+#    nPoints (int) - number of grid points in the batch, including points without any pairs
+def writeNearTable(outputFile,inFid,nearFid,nearDist,nPoints):
+    inFid = np.asarray(inFid,dtype=np.int64)
+    nearDist = np.asarray(nearDist,dtype=np.float32)
+
+    # sort pairs by grid point, then by distance, unless they are already sorted
+    if(len(inFid) > 1):
+        isSorted = np.all((np.diff(inFid) > 0) | ((np.diff(inFid) == 0) & (np.diff(nearDist) >= 0)))
+        if not(isSorted):
+            order = np.lexsort((nearDist,inFid))
+            inFid, nearDist = inFid[order], nearDist[order]
+            nearFid = np.asarray(nearFid)[order]
+    offsets = np.zeros(nPoints + 1,dtype=np.int64)
+    np.cumsum(np.bincount(inFid,minlength=nPoints),out=offsets[1:])
+
+    header = np.zeros(1,dtype=HEADER_DTYPE)
+    header['tag'] = FORMAT_TAG
+    header['nPoints'] = nPoints
+    header['nPairs'] = len(inFid)
+    tempFile = outputFile + '.tmp'
+    with open(tempFile,'wb') as outFile:
+        outFile.write(header.tobytes().ljust(HEADER_SIZE,b'\0'))
+        outFile.write(offsets.tobytes())
+        outFile.write(np.ascontiguousarray(nearFid,dtype='<i4').tobytes())
+        outFile.write(np.ascontiguousarray(nearDist,dtype='<f4').tobytes())
+    os.replace(tempFile,outputFile)
+
+# read the header of a near table file
+# INPUTS:
+#    nearFile (str) - absolute filepath to the near table
+# OUTPUTS:
+#    nPoints (int), nPairs (int) - number of grid points and point/feature pairs in the file,
+#    or None if the file does not exist or is not a near table
+def readHeader(nearFile):
+    if not(os.path.exists(nearFile)):
+        return(None)
+    with open(nearFile,'rb') as inFile:
+        headerBytes = inFile.read(HEADER_DTYPE.itemsize)
+    if(len(headerBytes) < HEADER_DTYPE.itemsize):
+        return(None)
+    header = np.frombuffer(headerBytes,dtype=HEADER_DTYPE)[0]
+    if(header['tag'] != FORMAT_TAG):
+        return(None)
+    return(int(header['nPoints']),int(header['nPairs']))
+
+# test if a near table has been completely written.  Only the header is read
+# INPUTS:
+#    nearFile (str) - absolute filepath to the near table
+# OUTPUTS:
+#    True if the near table is complete, False otherwise
+def isNearTableComplete(nearFile):
+    return(readHeader(nearFile) is not None)
+
+# open a near table.  Arrays are memory-mapped rather than read into memory
+# INPUTS:
+#    nearFile (str) - absolute filepath to the near table
+# OUTPUTS:
+#    nearTable (dict) - nPoints, nPairs, and offsets, NEAR_FID, and NEAR_DIST arrays
+def openNearTable(nearFile):
+    nPoints, nPairs = readHeader(nearFile)
+    offsetsStart = HEADER_SIZE
+    fidStart = offsetsStart + 8*(nPoints + 1)
+    distStart = fidStart + 4*nPairs
+    nearTable = {
+        'nPoints':nPoints,
+        'nPairs':nPairs,
+        'offsets':np.memmap(nearFile,dtype='<i8',mode='r',offset=offsetsStart,shape=(nPoints + 1,)),
+        'NEAR_FID':np.memmap(nearFile,dtype='<i4',mode='r',offset=fidStart,shape=(nPairs,)) if nPairs > 0 else np.zeros(0,dtype=np.int32),
+        'NEAR_DIST':np.memmap(nearFile,dtype='<f4',mode='r',offset=distStart,shape=(nPairs,)) if nPairs > 0 else np.zeros(0,dtype=np.float32)
+    }
+    return(nearTable)
+
+# get the position of the grid point in the batch for every pair in a near table
+# INPUTS:
+#    nearTable (dict) - near table returned by openNearTable
+# OUTPUTS:
+#    int32 array of grid point positions (IN_FID), one for each pair
+def getInFid(nearTable):
+    counts = np.diff(nearTable['offsets'])
+    return(np.repeat(np.arange(nearTable['nPoints'],dtype=np.int32),counts))
+
+# get the features near a single grid point
+# INPUTS:
+#    nearTable (dict) - near table returned by openNearTable
+#    pointNum (int) - position of the grid point within the batch (e.g. 1,2,...999)
+# OUTPUTS:
+#    NEAR_FID and NEAR_DIST arrays for the grid point, sorted by distance
+def getPointSlice(nearTable,pointNum):
+    start, end = nearTable['offsets'][pointNum], nearTable['offsets'][pointNum + 1]
+    return(nearTable['NEAR_FID'][start:end],nearTable['NEAR_DIST'][start:end])
+
+# convert a near table to a pandas dataframe with the same columns as arcpy near tables
+# INPUTS:
+#    nearTable (dict) - near table returned by openNearTable
+# OUTPUTS:
+#    pandas dataframe with IN_FID, NEAR_FID, and NEAR_DIST columns
+def nearTableToFrame(nearTable):
+    return(ps.DataFrame({
+        'IN_FID':getInFid(nearTable),
+        'NEAR_FID':np.asarray(nearTable['NEAR_FID']),
+        'NEAR_DIST':np.asarray(nearTable['NEAR_DIST'])
+    }))
+
+# convert a near table previously saved in csv format to the binary layout
+# INPUTS:
+#    csvFile (str) - absolute filepath to csv with IN_FID, NEAR_FID, and NEAR_DIST columns
+#    outputFile (str) - absolute filepath where the binary near table will be written
+#    nPoints (int) - number of grid points in the batch
+def convertCSV(csvFile,outputFile,nPoints):
+    nearData = ps.read_csv(csvFile,usecols=['IN_FID','NEAR_FID','NEAR_DIST'])
+    writeNearTable(outputFile,nearData['IN_FID'].values,nearData['NEAR_FID'].values,
+                   nearData['NEAR_DIST'].values,nPoints)
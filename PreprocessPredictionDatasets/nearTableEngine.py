@@ -0,0 +1,160 @@
+# nearTableEngine.py
+# Summary: calculate near tables (distance from grid points to all features within a search
+#          radius) without an ArcGIS license.  Features are loaded and indexed in an STRtree
+#          once per worker, and all points in a batch are queried in bulk.  Returns the same
+#          IN_FID, NEAR_FID, and NEAR_DIST content as arcpy GenerateNearTable
+
+# import libraries
+import numpy as np
+import geopandas as gpd
+import shapely
+from pyproj import Transformer, Geod
+
+# define global constants
+NEAR_CRS = 'EPSG:32610' # UTM zone 10N.  Planar distances in meters across Portland, OR
+QUERY_CHUNK_SIZE = 100 # number of points queried at once.  Bounds memory used by candidate pairs
+GEODESIC_DENSIFY = 0.5 # vertex spacing (m) when searching features for the geodesic nearest point
+GEODESIC_CHUNK_SIZE = 2000000 # number of densified feature vertices measured at once.  Bounds memory use
+
+########## HELPER FUNCTIONS #############
+
+# load a feature layer (e.g. 10m road segments) and build a spatial index for near queries
+# INPUTS:
+#    shapefile (str) - absolute filepath to the feature layer
+#    crs (str) - projected coordinate reference system distances are calculated in
+#    bbox (geopandas GeoSeries) - optional area of interest.  Only features intersecting the bounding box
+#                                 are loaded
+# OUTPUTS:
+#    layer (dict) - feature geometries, feature ids (FID, row order in the shapefile),
+#                   and an STRtree spatial index of the geometries
+def loadNearLayer(shapefile,crs=NEAR_CRS,bbox=None):
+    features = gpd.read_file(shapefile,bbox=bbox,fid_as_index=True).to_crs(crs)
+    geometry = np.asarray(features.geometry.values)
+    layer = {
+        'crs':crs,
+        'geometry':geometry,
+        'ids':features.index.values.astype(np.int32),
+        'tree':shapely.STRtree(geometry)
+    }
+    return(layer)
+
+# convert feature ids (e.g. NEAR_FID in a near table) to positions in a near layer.  Layer ids are in
+# shapefile order, so they are sorted even when the layer only contains a subset of features
+# INPUTS:
+#    layer (dict) - feature layer returned by loadNearLayer
+#    featureIds (int array) - feature ids to convert
+# OUTPUTS:
+#    int array with the position of each feature in the layer.  Raises ValueError if a feature id
+#    is not in the layer
+def getFeaturePositions(layer,featureIds):
+    featureIds = np.asarray(featureIds)
+    positions = np.searchsorted(layer['ids'],featureIds)
+    isFound = positions < len(layer['ids'])
+    isFound[isFound] = layer['ids'][positions[isFound]] == featureIds[isFound]
+    if not(isFound.all()):
+        raise ValueError("%i feature ids are not in the layer (e.g. %i)" %(
+            (~isFound).sum(),featureIds[~isFound][0]))
+    return(positions)
+
+# project point coordinates into the coordinate reference system of a near layer
+# INPUTS:
+#    x (float array) - x coordinates of points
+#    y (float array) - y coordinates of points
+#    srcCrs (str) - coordinate reference system of the input coordinates
+#    dstCrs (str) - coordinate reference system to project into
+# OUTPUTS:
+#    projected x and y coordinates
+def projectPoints(x,y,srcCrs,dstCrs=NEAR_CRS):
+    transformer = Transformer.from_crs(srcCrs,dstCrs,always_xy=True)
+    return(transformer.transform(np.asarray(x,dtype=np.float64),np.asarray(y,dtype=np.float64)))
+
+# calculate distance from points to all features within a search radius
+# INPUTS:
+#    layer (dict) - feature layer returned by loadNearLayer
+#    points (shapely point array) - points to query, in the layer crs
+#    radius (float) - search radius, in meters
+#    chunkSize (int) - number of points queried at once
+# OUTPUTS:
+#    nearTable (dict) - IN_FID (position of the point in the input arrays), NEAR_FID (feature id),
+#                       and NEAR_DIST (distance in meters) arrays, sorted by IN_FID and then NEAR_DIST
+def queryPoints(layer,points,radius,chunkSize=QUERY_CHUNK_SIZE):
+    inFids, nearFids, nearDists = [], [], []
+    for start in range(0,len(points),chunkSize):
+        chunk = points[start:start + chunkSize]
+        pointIndex, featureIndex = layer['tree'].query(chunk,predicate='dwithin',distance=radius)
+        dists = shapely.distance(chunk[pointIndex],layer['geometry'][featureIndex])
+
+        # order pairs by point, then by distance, to match the layout of downstream readers
+        order = np.lexsort((dists,pointIndex))
+        inFids.append((pointIndex[order] + start).astype(np.int32))
+        nearFids.append(layer['ids'][featureIndex[order]])
+        nearDists.append(dists[order])
+    nearTable = {
+        'IN_FID':np.concatenate(inFids) if inFids else np.zeros(0,dtype=np.int32),
+        'NEAR_FID':np.concatenate(nearFids) if nearFids else np.zeros(0,dtype=np.int32),
+        'NEAR_DIST':np.concatenate(nearDists) if nearDists else np.zeros(0,dtype=np.float64)
+    }
+    return(nearTable)
+
+# calculate distance from points to all features within a search radius
+# INPUTS:
+#    layer (dict) - feature layer returned by loadNearLayer
+#    x (float array) - x coordinates of points, in the layer crs
+#    y (float array) - y coordinates of points, in the layer crs
+#    radius (float) - search radius, in meters
+#    chunkSize (int) - number of points queried at once
+# OUTPUTS:
+#    nearTable (dict) - IN_FID, NEAR_FID, and NEAR_DIST arrays (see queryPoints)
+def queryNearTable(layer,x,y,radius,chunkSize=QUERY_CHUNK_SIZE):
+    points = shapely.points(np.asarray(x,dtype=np.float64),np.asarray(y,dtype=np.float64))
+    return(queryPoints(layer,points,radius,chunkSize))
+
+# calculate distance from points to features in several layers, each with its own search radius.
+# Point geometries are created once and reused for every layer.  All layers must share a crs
+# INPUTS:
+#    layers (dict array) - feature layers returned by loadNearLayer
+#    x (float array) - x coordinates of points, in the layer crs
+#    y (float array) - y coordinates of points, in the layer crs
+#    radii (float array) - search radius for each layer, in meters
+# OUTPUTS:
+#    list of near tables, one for each layer (see queryPoints)
+def queryNearTables(layers,x,y,radii,chunkSize=QUERY_CHUNK_SIZE):
+    points = shapely.points(np.asarray(x,dtype=np.float64),np.asarray(y,dtype=np.float64))
+    return([queryPoints(layer,points,radius,chunkSize) for layer, radius in zip(layers,radii)])
+
+# calculate geodesic distances (WGS84 ellipsoid) between points and features, for validating
+# planar distances.  Features are densified so the nearest vertex is within a fraction of a
+# meter of the geodesic nearest point on the feature.  Pairs are measured in chunks of about
+# chunkSize densified vertices
+# INPUTS:
+#    layer (dict) - feature layer returned by loadNearLayer
+#    x (float array) - x coordinates of points, in the layer crs
+#    y (float array) - y coordinates of points, in the layer crs
+#    inFid (int array) - point index for each pair
+#    nearFid (int array) - feature id for each pair
+#    densifyDist (float) - maximum spacing between feature vertices, in meters
+#    chunkSize (int) - number of densified vertices measured at once
+# OUTPUTS:
+#    float64 array of geodesic distances, in meters, one for each pair
+def calcGeodesicDistances(layer,x,y,inFid,nearFid,densifyDist=GEODESIC_DENSIFY,chunkSize=GEODESIC_CHUNK_SIZE):
+    inFid = np.asarray(inFid)
+    geodesicDists = np.zeros(len(inFid),dtype=np.float64)
+    if(len(inFid) == 0):
+        return(geodesicDists)
+    toLonLat = Transformer.from_crs(layer['crs'],'EPSG:4326',always_xy=True)
+    pointLon, pointLat = toLonLat.transform(np.asarray(x,dtype=np.float64),np.asarray(y,dtype=np.float64))
+    geoms = layer['geometry'][getFeaturePositions(layer,nearFid)]
+
+    # split pairs into chunks using the number of vertices each feature will have once densified
+    cumVertices = np.cumsum(np.ceil(shapely.length(geoms)/densifyDist) + shapely.get_num_coordinates(geoms))
+    bounds = np.unique(np.concatenate([[0],np.searchsorted(cumVertices,np.arange(chunkSize,cumVertices[-1],chunkSize)),[len(geoms)]]))
+    for start, end in zip(bounds[:-1],bounds[1:]):
+        coords, pairIndex = shapely.get_coordinates(shapely.segmentize(geoms[start:end],densifyDist),return_index=True)
+        featureLon, featureLat = toLonLat.transform(coords[:,0],coords[:,1])
+        chunkFid = inFid[start:end][pairIndex]
+        _, _, vertexDists = Geod(ellps='WGS84').inv(pointLon[chunkFid],pointLat[chunkFid],featureLon,featureLat)
+
+        # nearest vertex of each feature.  Vertices are grouped by pair in increasing pair order
+        pairStarts = np.searchsorted(pairIndex,np.arange(end - start))
+        geodesicDists[start:end] = np.minimum.reduceat(vertexDists,pairStarts)
+    return(geodesicDists)
@@ -0,0 +1,253 @@
+# tileProcessing.py
+# Summary: calculate road angles and distance to the nearest building in each angle for square
+#          tiles of grid points (e.g. 100 x 100 points).  Roads and buildings within 2km of a tile
+#          are loaded once per tile, and every point in the tile is processed against the in-memory
+#          subset.  Results are written into the same per-batch files created by calcRdAngleParallel.py
+#          and calcBldgDistanceParallel.py
+
+# import libraries
+from multiprocessing import Pool
+import os
+import sys
+import random
+import numpy as np
+import geopandas as gpd
+import shapely
+import nearTableEngine
+import nearTableCSR
+import angularBins
+import calcBldgDistanceParallel
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+# define global constants
+POINT_STORE_FOLDER = "H:/Noise/implementation/pointStore/"
+NEAR_FOLDER = "F:/Noise/near/" # road near tables created by genNearTableParallel.py
+ROAD_NETWORK = "H:/Noise/implementation/PDX10m.shp"
+BUILDINGS = "H:/Noise/building/buildingMergedDissolve2/buildingMergedDissolve2.shp"
+RD_ANGLE_FOLDER = "E:/Noise/rdAngle/"
+BLDG_DIST_FOLDER = "Z:/Noise/bldgDist/"
+TILE_FOLDER = "E:/Noise/tiles/" # an empty marker file is written for each completed tile
+TILE_SIZE = 100 # number of grid rows and columns in each tile
+SEARCH_RADIUS = 2000 # roads and buildings within 2000m of a tile are loaded for the tile
+PAIR_CHUNK_SIZE = 2000000 # number of point/road pairs processed at once.  Bounds memory use
+N_CPUS = 16
+
+# point store and grid convergence, loaded once per worker process
+store = None
+convergence = None
+
+########## HELPER FUNCTIONS #############
+
+# load the point store and calculate grid convergence.  Called once when each worker process starts
+def initWorker():
+    global store, convergence
+    store = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    convergence = angularBins.calcGridConvergence(store['meta'],nearTableEngine.NEAR_CRS)
+
+# group grid points by tile.  Point ids are sorted by tile once, so the points in each tile are a
+# slice of the sorted ids rather than a scan of the whole point store
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    tileSize (int) - number of grid rows and columns in each tile
+# OUTPUTS:
+#    tileSigs (str list) - unique identifiers of all tiles containing grid points (e.g. ['t0_0','t0_1',...]),
+#                          named by tile row and tile column
+#    tilePoints (list of int64 arrays) - point ids in each tile, in increasing order
+def indexTiles(store,tileSize=TILE_SIZE):
+    nTileCols = store['meta']['nCols']//tileSize + 1
+    tileKeys = (np.asarray(store['row'])//tileSize).astype(np.int64)*nTileCols + np.asarray(store['col'])//tileSize
+    order = np.argsort(tileKeys,kind='stable')
+    uniqueKeys, offsets = np.unique(tileKeys[order],return_index=True)
+    tileSigs = ['t%i_%i' %(tileKey//nTileCols,tileKey%nTileCols) for tileKey in uniqueKeys]
+    return(tileSigs,np.split(order,offsets[1:]))
+
+# load features within the search radius of any grid point in a tile
+# INPUTS:
+#    shapefile (str) - absolute filepath to the feature layer
+#    x (float array) - x coordinates of grid points in the tile, in the near crs
+#    y (float array) - y coordinates of grid points in the tile, in the near crs
+#    radius (float) - search radius, in meters
+# OUTPUTS:
+#    feature layer for the tile (see nearTableEngine.loadNearLayer)
+def loadTileLayer(shapefile,x,y,radius=SEARCH_RADIUS):
+    envelope = shapely.box(np.min(x) - radius,np.min(y) - radius,np.max(x) + radius,np.max(y) + radius)
+
+    # densify so the envelope still covers the tile after projecting into the shapefile crs
+    envelope = gpd.GeoSeries([shapely.segmentize(envelope,radius/10)],crs=nearTableEngine.NEAR_CRS)
+    return(nearTableEngine.loadNearLayer(shapefile,bbox=envelope))
+
+# find the tiles that contain points from each batch
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    tileSigs (str list), tilePoints (list of int arrays) - tiles returned by indexTiles
+# OUTPUTS:
+#    dict mapping each batch signature (e.g. b1000) to a list of tile signatures
+def listBatchTiles(store,tileSigs,tilePoints):
+    batchSize = store['meta']['batchSize']
+    batchTiles = {fileSig:[] for fileSig in gridPointStore.listBatchSigs(store)}
+    for tileSig, pointIds in zip(tileSigs,tilePoints):
+        for startId in np.unique(pointIds//batchSize*batchSize):
+            batchTiles['b' + str(startId)].append(tileSig)
+    return(batchTiles)
+
+# create output files under a temporary name for every batch that does not already have a finished
+# output file.  Tiles write into the rows of each file that belong to their points.  When a new
+# temporary file is created, the markers of tiles overlapping the batch are removed, so those tiles
+# are processed again rather than leaving the new file empty
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    batchTiles (dict) - tiles overlapping each batch, returned by listBatchTiles
+def preallocateBatchFiles(store,batchTiles):
+    for fileSig, overlapTiles in batchTiles.items():
+        isCreated = False
+        nearFile = NEAR_FOLDER + fileSig + nearTableCSR.FILE_EXTENSION
+        rdAngleFile = RD_ANGLE_FOLDER + fileSig + ".npy"
+        if not(os.path.exists(rdAngleFile) or os.path.exists(rdAngleFile + ".tmp")) and nearTableCSR.isNearTableComplete(nearFile):
+            nPoints, nPairs = nearTableCSR.readHeader(nearFile)
+            np.lib.format.open_memmap(rdAngleFile + ".tmp",mode='w+',dtype=np.int16,shape=(nPairs,2)).flush()
+            isCreated = True
+        bldgFile = BLDG_DIST_FOLDER + fileSig + ".npy"
+        if not(os.path.exists(bldgFile) or os.path.exists(bldgFile + ".tmp")):
+            nPoints = len(gridPointStore.getBatch(store,fileSig)['x'])
+            np.lib.format.open_memmap(bldgFile + ".tmp",mode='w+',dtype=np.float32,shape=(nPoints,angularBins.N_BINS)).flush()
+            isCreated = True
+        if isCreated:
+            for tileSig in overlapTiles:
+                if os.path.exists(TILE_FOLDER + tileSig + ".done"):
+                    os.remove(TILE_FOLDER + tileSig + ".done")
+
+# rename the temporary files of each batch once every tile overlapping the batch is complete, so
+# partially filled files are never mistaken as complete.  Batches with finished output files are left unchanged
+# INPUTS:
+#    batchTiles (dict) - tiles overlapping each batch, returned by listBatchTiles
+def finalizeBatchFiles(batchTiles):
+    nIncomplete = 0
+    for fileSig, overlapTiles in batchTiles.items():
+        tempFiles = [outputFile + ".tmp" for outputFile in [RD_ANGLE_FOLDER + fileSig + ".npy",BLDG_DIST_FOLDER + fileSig + ".npy"]
+                     if os.path.exists(outputFile + ".tmp")]
+        if(len(tempFiles) == 0):
+            continue
+        if not(all(os.path.exists(TILE_FOLDER + tileSig + ".done") for tileSig in overlapTiles)):
+            nIncomplete += 1
+            continue
+        for tempFile in tempFiles:
+            os.replace(tempFile,tempFile[:-len(".tmp")])
+    if(nIncomplete > 0):
+        print("%i batches overlap tiles that have not been processed and were not finalized" %(nIncomplete))
+
+# calculate angle bins for all road segments near the tile points in a single batch
+# INPUTS:
+#    x (float array) - x coordinates of the tile points in the batch, in the near crs
+#    y (float array) - y coordinates of the tile points in the batch, in the near crs
+#    batchFid (int array) - position of each tile point within the batch
+#    nearTable (dict) - road near table for the batch, returned by nearTableCSR.openNearTable
+#    roadLayer (dict) - roads near the tile, returned by loadTileLayer
+#    segments (dict) - road vertex arrays returned by angularBins.prepareSegments, in roadLayer order
+# OUTPUTS:
+#    pairIndex (int array) - position of each pair in the batch near table
+#    rdAngles (int16 array) - start bin and number of bins for each pair (see calcRdAngleParallel.py)
+def calcTileRoadAngles(x,y,batchFid,nearTable,roadLayer,segments):
+    starts = np.asarray(nearTable['offsets'][batchFid])
+    counts = np.asarray(nearTable['offsets'][batchFid + 1]) - starts
+    pairIndex = np.repeat(starts - (np.cumsum(counts) - counts),counts) + np.arange(counts.sum())
+    pairPoint = np.repeat(np.arange(len(batchFid)),counts)
+    rdAngles = np.zeros((len(pairIndex),2),dtype=np.int16)
+    for start in range(0,len(pairIndex),PAIR_CHUNK_SIZE):
+        end = start + PAIR_CHUNK_SIZE
+
+        # road ids are converted to positions in the tile's subset of roads
+        pairFeature = nearTableEngine.getFeaturePositions(roadLayer,nearTable['NEAR_FID'][pairIndex[start:end]])
+        startBin, nBins = angularBins.calcBinRanges(x,y,segments,pairPoint[start:end],pairFeature,convergence)
+        rdAngles[start:end,0] = startBin
+        rdAngles[start:end,1] = nBins
+    return(pairIndex,rdAngles)
+
+# calculate road angles and distance to the nearest building in each angle for all points in a tile
+# INPUTS:
+#    tileSig (str) - unique identifier for a tile of grid points (e.g. t3_12)
+#    pointIds (int array) - point ids in the tile, in increasing order (see indexTiles)
+def processTile(tileSig,pointIds):
+
+    # if the tile has already been processed, return early to avoid redundant processing
+    doneFile = TILE_FOLDER + tileSig + ".done"
+    if os.path.exists(doneFile):
+        print("%s has already been processed" %(tileSig))
+        return
+
+    # road angles require the near tables of every batch the tile overlaps.  Batches with finished
+    # output files (e.g. from calcRdAngleParallel.py) are not written again
+    batchSize = store['meta']['batchSize']
+    fileSigs = ['b' + str(startId) for startId in np.unique(pointIds//batchSize*batchSize)]
+    for fileSig in fileSigs:
+        rdAngleFile = RD_ANGLE_FOLDER + fileSig + ".npy"
+        if not(os.path.exists(rdAngleFile) or os.path.exists(rdAngleFile + ".tmp")):
+            print("can't process tile %s: dist to road not available for %s" %(tileSig,fileSig))
+            return
+    print("processing tile %s" %(tileSig))
+
+    # load roads and buildings near the tile once, and reuse them for every point in the tile
+    x, y = nearTableEngine.projectPoints(store['x'][pointIds],store['y'][pointIds],store['meta']['crs'],nearTableEngine.NEAR_CRS)
+    roadLayer = loadTileLayer(ROAD_NETWORK,x,y)
+    segments = angularBins.prepareSegments(roadLayer['geometry'])
+    bldgLayer = loadTileLayer(BUILDINGS,x,y)
+    edges = angularBins.prepareEdges(bldgLayer['geometry'])
+
+    # write results into the rows of each unfinished batch file that belong to the tile points
+    for fileSig in fileSigs:
+        startId = int(fileSig[1:])
+        inBatch = (pointIds >= startId) & (pointIds < startId + batchSize)
+        batchFid = pointIds[inBatch] - startId
+
+        rdAngleTemp = RD_ANGLE_FOLDER + fileSig + ".npy.tmp"
+        if os.path.exists(rdAngleTemp):
+            nearTable = nearTableCSR.openNearTable(NEAR_FOLDER + fileSig + nearTableCSR.FILE_EXTENSION)
+            pairIndex, rdAngles = calcTileRoadAngles(x[inBatch],y[inBatch],batchFid,nearTable,roadLayer,segments)
+            rdAngleFile = np.load(rdAngleTemp,mmap_mode='r+')
+            rdAngleFile[pairIndex] = rdAngles
+            rdAngleFile.flush()
+
+        bldgTemp = BLDG_DIST_FOLDER + fileSig + ".npy.tmp"
+        if os.path.exists(bldgTemp):
+            bldgDists = calcBldgDistanceParallel.calcNearestBldgDists(x[inBatch],y[inBatch],bldgLayer,edges,convergence)
+            bldgFile = np.load(bldgTemp,mmap_mode='r+')
+            bldgFile[batchFid] = bldgDists
+            bldgFile.flush()
+
+    open(doneFile,'w').close()
+    print("completed processing tile %s" %(tileSig))
+
+
+# calculate road angles and building distances for every tile, and finalize the batch files.  Rerunning
+# after all tiles are complete leaves finished batch files unchanged
+# INPUTS:
+#    pointStore (dict) - point store returned by gridPointStore.loadPointStore
+#    nCpus (int) - number of worker processes.  Tiles are processed in the calling process if 1
+#    tileSize (int) - number of grid rows and columns in each tile
+def processAllTiles(pointStore,nCpus=N_CPUS,tileSize=TILE_SIZE):
+    tileSigs, tilePoints = indexTiles(pointStore,tileSize)
+    batchTiles = listBatchTiles(pointStore,tileSigs,tilePoints)
+    preallocateBatchFiles(pointStore,batchTiles)
+
+    # randomly shuffle.  If errors are uncountered and pools terminate early, this helps spread the workload
+    # uniformly across cpus when the error is corrected and the script is restarted
+    tilesToProcess = list(zip(tileSigs,tilePoints))
+    random.shuffle(tilesToProcess)
+
+    # create a pool of workers, one worker for each free CPU.  Each worker only holds the roads and
+    # buildings for one tile at a time, so memory use depends on tile size rather than city size
+    if(nCpus == 1):
+        initWorker()
+        for tileSig, pointIds in tilesToProcess:
+            processTile(tileSig,pointIds)
+    else:
+        pool = Pool(processes=nCpus,initializer=initWorker)
+        res = pool.starmap_async(processTile,tilesToProcess)
+        res.get()
+    finalizeBatchFiles(batchTiles)
+
+####################### MAIN FUNCTION ##################
+if __name__ == '__main__':
+    processAllTiles(gridPointStore.loadPointStore(POINT_STORE_FOLDER))
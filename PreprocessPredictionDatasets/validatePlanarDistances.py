@@ -0,0 +1,132 @@
+# validatePlanarDistances.py
+# Summary: compare planar distances (UTM zone 10N) used by the near table stages against
+#          geodesic distances for a random sample of grid points.  Reports the maximum
+#          distance difference and the number of point/feature pairs that change buffer
+#          membership for each buffer distance used in the land use regression model.  Roads, the
+#          misc predictor layers, and buildings are all validated.  Only pairs whose planar distance
+#          is near a buffer distance are measured geodesically, since only those pairs can change
+#          a metric
+
+# import libraries
+import os
+import sys
+import numpy as np
+import pandas as ps
+import shapely
+import nearTableEngine
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+# define global constants
+POINT_STORE_FOLDER = "H:/Noise/implementation/pointStore/"
+NEAR_LAYERS = { # every layer near tables or building distances are calculated for
+    'roads':"H:/Noise/implementation/PDX10m.shp",
+    'tm':"H:/Noise/buffers/int/tm_routes10m.shp",
+    'er':"H:/Noise/buffers/int/Portland_Emergency_Transportation_Routes10m.shp",
+    'bi':"H:/Noise/buffers/int/Recommended_Bicycle_Routes10m.shp",
+    'sl':"H:/Noise/LUR/PredictorData/Street_Lights/Street_Lights.shp",
+    'buildings':"H:/Noise/building/buildingMergedDissolve2/buildingMergedDissolve2.shp"
+}
+SEARCH_RADIUS = 2000
+BUFFER_DISTS = [10,20,50,250,450,700,800,1200,1400,2000] # buffer distances used by road and misc metrics
+N_SAMPLE_POINTS = 1000 # number of randomly sampled grid points to validate
+RANDOM_SEED = 1
+THRESHOLD_MARGIN = 5 # pairs with a planar distance within 5m of a buffer distance are measured geodesically
+POINT_CHUNK_SIZE = 50 # number of sampled grid points queried at once.  Bounds memory used by near tables
+
+########## HELPER FUNCTIONS #############
+
+# randomly sample grid points from the point store
+# INPUTS:
+#    store (dict) - point store returned by gridPointStore.loadPointStore
+#    nSample (int) - number of grid points to sample
+#    seed (int) - random number generator seed
+# OUTPUTS:
+#    x (float array), y (float array) - coordinates of sampled points, in the store crs
+def samplePoints(store,nSample,seed=RANDOM_SEED):
+    rng = np.random.default_rng(seed)
+    pointIds = np.sort(rng.choice(store['meta']['nPoints'],size=min(nSample,store['meta']['nPoints']),replace=False))
+    return(store['x'][pointIds],store['y'][pointIds])
+
+# replace polygon features with their boundaries.  Building distances are measured to building
+# edges, so planar and geodesic distances are both measured to the boundary, rather than planar
+# distance being 0 for points inside a polygon
+# INPUTS:
+#    layer (dict) - feature layer returned by nearTableEngine.loadNearLayer
+# OUTPUTS:
+#    feature layer with polygon boundaries in place of polygons, and a matching spatial index
+def toBoundaryLayer(layer):
+    isPolygon = np.isin(shapely.get_type_id(layer['geometry']),[shapely.GeometryType.POLYGON,shapely.GeometryType.MULTIPOLYGON])
+    if not(isPolygon.any()):
+        return(layer)
+    geometry = np.where(isPolygon,shapely.boundary(layer['geometry']),layer['geometry'])
+    return({**layer,'geometry':geometry,'tree':shapely.STRtree(geometry)})
+
+# compare planar and geodesic distances from sampled points to features.  Pairs whose planar distance
+# is more than margin from every buffer distance are counted but not measured geodesically, as they
+# cannot change buffer membership unless planar and geodesic distances differ by more than margin
+# INPUTS:
+#    layer (dict) - feature layer returned by nearTableEngine.loadNearLayer
+#    x (float array) - x coordinates of points, in the layer crs
+#    y (float array) - y coordinates of points, in the layer crs
+#    radius (float) - search radius, in meters
+#    bufferDists (int array) - buffer distances to test for changes in buffer membership
+#    margin (float) - pairs with a planar distance within margin of a buffer distance are measured
+# OUTPUTS:
+#    summary (pandas dataframe) - one row for each buffer distance, with the number of pairs within
+#                                 the buffer using each method, the number of pairs measured, the
+#                                 number of pairs that change membership, and the maximum distance
+#                                 difference of measured pairs
+def comparePlanarToGeodesic(layer,x,y,radius,bufferDists,margin=THRESHOLD_MARGIN):
+    nPairsPlanar = np.zeros(len(bufferDists),dtype=np.int64)
+    inFid, nearFid, planarDists = [], [], []
+    for start in range(0,len(x),POINT_CHUNK_SIZE):
+        nearTable = nearTableEngine.queryNearTable(layer,x[start:start + POINT_CHUNK_SIZE],y[start:start + POINT_CHUNK_SIZE],radius + margin)
+        isNearBuffer = np.zeros(len(nearTable['NEAR_DIST']),dtype=bool)
+        for index, bufferDist in enumerate(bufferDists):
+            nPairsPlanar[index] += int((nearTable['NEAR_DIST'] <= bufferDist).sum())
+            isNearBuffer |= np.abs(nearTable['NEAR_DIST'] - bufferDist) <= margin
+        inFid.append(nearTable['IN_FID'][isNearBuffer] + start)
+        nearFid.append(nearTable['NEAR_FID'][isNearBuffer])
+        planarDists.append(nearTable['NEAR_DIST'][isNearBuffer])
+    inFid, nearFid, planarDists = np.concatenate(inFid), np.concatenate(nearFid), np.concatenate(planarDists)
+    geodesicDists = nearTableEngine.calcGeodesicDistances(layer,x,y,inFid,nearFid)
+    absDiff = np.abs(planarDists - geodesicDists)
+    if(len(absDiff) > 0 and absDiff.max() > margin):
+        print("planar and geodesic distances differ by up to %.3f m, more than the %.1f m margin.  Membership changes may be undercounted" %(absDiff.max(),margin))
+
+    summary = []
+    for index, bufferDist in enumerate(bufferDists):
+        isMeasured = np.abs(planarDists - bufferDist) <= margin
+        inPlanar = planarDists[isMeasured] <= bufferDist
+        inGeodesic = geodesicDists[isMeasured] <= bufferDist
+        measuredDiff = absDiff[isMeasured]
+        summary.append({
+            'bufferDist':bufferDist,
+            'nPairsPlanar':int(nPairsPlanar[index]),
+            'nPairsGeodesic':int(nPairsPlanar[index] - (inPlanar & ~inGeodesic).sum() + (~inPlanar & inGeodesic).sum()),
+            'nPairsMeasured':int(isMeasured.sum()),
+            'nMembershipChanges':int((inPlanar != inGeodesic).sum()),
+            'maxAbsDiff':float(measuredDiff.max()) if isMeasured.any() else 0.0,
+            'maxRelDiff':float((measuredDiff/np.maximum(geodesicDists[isMeasured],1)).max()) if isMeasured.any() else 0.0
+        })
+    return(ps.DataFrame(summary))
+
+####################### MAIN FUNCTION ##################
+if __name__ == '__main__':
+    store = gridPointStore.loadPointStore(POINT_STORE_FOLDER)
+    sampleX, sampleY = samplePoints(store,N_SAMPLE_POINTS)
+    summaries = []
+    for layerName, shapefile in NEAR_LAYERS.items():
+        layer = toBoundaryLayer(nearTableEngine.loadNearLayer(shapefile))
+        x, y = nearTableEngine.projectPoints(sampleX,sampleY,store['meta']['crs'],layer['crs'])
+        summary = comparePlanarToGeodesic(layer,x,y,SEARCH_RADIUS,BUFFER_DISTS)
+        summary.insert(0,'layer',layerName)
+        summaries.append(summary)
+        print(summary.to_string(index=False))
+        print("%s: maximum planar vs geodesic distance difference: %.3f m" %(layerName,summary['maxAbsDiff'].max()))
+    summary = ps.concat(summaries,ignore_index=True)
+    print("all layers: maximum planar vs geodesic distance difference: %.3f m, %i buffer membership changes for %i grid points" %(
+        summary['maxAbsDiff'].max(),summary['nMembershipChanges'].sum(),len(sampleX)))
@@ -0,0 +1,107 @@
+# validateTileRerun.py
+# Summary: check that tileProcessing.py can be rerun safely.  A small synthetic grid, road network, and
+#          set of buildings are created in a temporary folder, and the tile driver is run twice.  The
+#          second run must leave every finished road angle and building distance file unchanged.  A
+#          finished file that was written before the first run (e.g. by calcBldgDistanceParallel.py)
+#          must also be left unchanged
+
+# import libraries
+import os
+import sys
+import tempfile
+import numpy as np
+import geopandas as gpd
+import shapely
+import nearTableEngine
+import nearTableCSR
+import tileProcessing
+
+# the grid point store is shared with the grid creation stage
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','CreatePredictionGrid'))
+import gridPointStore
+
+# define global constants
+GRID_CRS = 'EPSG:3857'
+GRID_ORIGIN = (-13656000,5704000) # south west corner of the synthetic grid, in Portland
+GRID_SHAPE = (30,30) # number of grid rows and columns
+RESOLUTION = 10
+BATCH_SIZE = 100
+TILE_SIZE = 10
+SEARCH_RADIUS = 2000
+
+########## HELPER FUNCTIONS #############
+
+# create a synthetic point store, road network, and buildings, and road near tables for every batch
+# INPUTS:
+#    folder (str) - absolute folderpath where the synthetic datasets are written
+def createSyntheticInputs(folder):
+    rows, cols = np.meshgrid(np.arange(GRID_SHAPE[0]),np.arange(GRID_SHAPE[1]),indexing='ij')
+    x = GRID_ORIGIN[0] + cols.ravel()*RESOLUTION
+    y = GRID_ORIGIN[1] + rows.ravel()*RESOLUTION
+    gridPointStore.createPointStoreFromArrays(folder + "pointStore/",x,y,GRID_CRS,RESOLUTION,BATCH_SIZE)
+
+    # roads are 10m segments along two streets, and buildings are squares scattered around the grid
+    centerX, centerY = nearTableEngine.projectPoints([x.mean()],[y.mean()],GRID_CRS,nearTableEngine.NEAR_CRS)
+    centerX, centerY = float(centerX[0]), float(centerY[0])
+    offsets = np.arange(-300,300,10)
+    roads = [shapely.LineString([(centerX + offset,centerY + 7),(centerX + offset + 10,centerY + 7)]) for offset in offsets]
+    roads += [shapely.LineString([(centerX - 53,centerY + offset),(centerX - 53,centerY + offset + 10)]) for offset in offsets]
+    rng = np.random.default_rng(1)
+    corners = rng.uniform(-250,250,(40,2))
+    buildings = [shapely.box(centerX + dx,centerY + dy,centerX + dx + 12,centerY + dy + 12) for dx, dy in corners]
+    gpd.GeoDataFrame(geometry=roads,crs=nearTableEngine.NEAR_CRS).to_file(folder + "roads.shp")
+    gpd.GeoDataFrame(geometry=buildings,crs=nearTableEngine.NEAR_CRS).to_file(folder + "buildings.shp")
+
+    store = gridPointStore.loadPointStore(folder + "pointStore/")
+    roadLayer = nearTableEngine.loadNearLayer(folder + "roads.shp")
+    os.makedirs(folder + "near/")
+    for fileSig in gridPointStore.listBatchSigs(store):
+        batch = gridPointStore.getBatch(store,fileSig)
+        batchX, batchY = nearTableEngine.projectPoints(batch['x'],batch['y'],GRID_CRS,roadLayer['crs'])
+        nearTable = nearTableEngine.queryNearTable(roadLayer,batchX,batchY,SEARCH_RADIUS)
+        nearTableCSR.writeNearTable(folder + "near/" + fileSig + nearTableCSR.FILE_EXTENSION,nearTable['IN_FID'],
+                                    nearTable['NEAR_FID'],nearTable['NEAR_DIST'],len(batch['x']))
+
+# read every finished output file
+# OUTPUTS:
+#    dict mapping each output filepath to its contents
+def readOutputs():
+    outputs = {}
+    for outputFolder in [tileProcessing.RD_ANGLE_FOLDER,tileProcessing.BLDG_DIST_FOLDER]:
+        for fileName in sorted(os.listdir(outputFolder)):
+            if fileName.endswith(".npy"):
+                outputs[outputFolder + fileName] = np.load(outputFolder + fileName)
+    return(outputs)
+
+####################### MAIN FUNCTION ##################
+if __name__ == '__main__':
+    folder = tempfile.mkdtemp().replace('\\','/') + "/"
+    createSyntheticInputs(folder)
+    tileProcessing.POINT_STORE_FOLDER = folder + "pointStore/"
+    tileProcessing.NEAR_FOLDER = folder + "near/"
+    tileProcessing.ROAD_NETWORK = folder + "roads.shp"
+    tileProcessing.BUILDINGS = folder + "buildings.shp"
+    tileProcessing.RD_ANGLE_FOLDER = folder + "rdAngle/"
+    tileProcessing.BLDG_DIST_FOLDER = folder + "bldgDist/"
+    tileProcessing.TILE_FOLDER = folder + "tiles/"
+    for outputFolder in [tileProcessing.RD_ANGLE_FOLDER,tileProcessing.BLDG_DIST_FOLDER,tileProcessing.TILE_FOLDER]:
+        os.makedirs(outputFolder)
+
+    # a building distance file finished before tiles are processed
+    store = gridPointStore.loadPointStore(tileProcessing.POINT_STORE_FOLDER)
+    finishedFile = tileProcessing.BLDG_DIST_FOLDER + "b0.npy"
+    np.save(finishedFile,np.full((BATCH_SIZE,360),-1,dtype=np.float32))
+
+    tileProcessing.processAllTiles(store,nCpus=1,tileSize=TILE_SIZE)
+    firstRun = readOutputs()
+    tileProcessing.processAllTiles(store,nCpus=1,tileSize=TILE_SIZE)
+    secondRun = readOutputs()
+
+    nBatches = len(gridPointStore.listBatchSigs(store))
+    assert len(firstRun) == 2*nBatches, "expected %i finished files, found %i" %(2*nBatches,len(firstRun))
+    assert np.all(firstRun[finishedFile] == -1), "a batch file finished before the first run was overwritten"
+    assert all(np.any(firstRun[outputFile] != 0) for outputFile in firstRun), "a finished batch file is empty"
+    assert firstRun.keys() == secondRun.keys()
+    for outputFile in firstRun:
+        assert np.array_equal(firstRun[outputFile],secondRun[outputFile]), "%s changed on the second run" %(outputFile)
+    print("%i batch files are unchanged after rerunning tile processing" %(len(firstRun)))